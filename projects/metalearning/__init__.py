@@ -2,10 +2,30 @@ from . import base_model
 from . import benchmarks
 from . import cnnmlp
 from . import dataset
+from . import image_cache
 from . import maml
+from . import manifest
+from . import metrics
+from . import normalization
+from . import profiling
+from . import samplers
+from . import storage
+from . import synthetic
+from . import tracing
+from . import variants
 
 from .base_model import *
 from .benchmarks import *
 from .cnnmlp import *
 from .dataset import *
+from .image_cache import *
 from .maml import *
+from .manifest import *
+from .metrics import *
+from .normalization import *
+from .profiling import *
+from .samplers import *
+from .storage import *
+from .synthetic import *
+from .tracing import *
+from .variants import *
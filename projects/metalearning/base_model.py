@@ -18,6 +18,9 @@ from datetime import datetime
 import pickle
 import os
 
+from .metrics import StreamingMetrics
+from .profiling import create_phase_timer
+
 DEFAULT_SAVE_DIR = 'drive/Research Projects/Meta-Learning/v1/models'
 DEFAULT_NUM_EPOCHS = 10
 DEFAULT_NUM_BATCHES_TO_PRINT = 10000
@@ -79,7 +82,7 @@ class BasicModel(nn.Module):
 
         self.results = defaultdict(list)
 
-    def train_(self, input_img, label, query=None):
+    def train_(self, input_img, label, query=None, metrics=None, timer=None):
         """
         Run a training batch. Take a set of input images, pass them forward, compute the loss,
         take a backward step using the optimizer, compute and return a few additional metrics,
@@ -87,7 +90,11 @@ class BasicModel(nn.Module):
             [batch_size x channels x width x height]
         :param label: the correct prediction for this image, used in order to compute the loss
         :param query: The query, if this model utilizes it
-        :return: A dict of metrics for this batch: accuracy, loss, AUC, and predictions
+        :param metrics: If not None, a StreamingMetrics to accumulate the metrics of this batch into, on the device,
+            instead of computing them on the host
+        :param timer: If not None, a PhaseTimer to time the forward pass, backward pass, and optimizer step with
+        :return: A dict of metrics for this batch: accuracy, loss, AUC, and predictions; only the predictions if
+            accumulating into metrics
         """
         if self.optimizer is None:
             self._create_optimizer()
@@ -95,14 +102,10 @@ class BasicModel(nn.Module):
         self.optimizer.zero_grad()
         output = self(input_img, query)
 
-        np_labels = label.data.cpu().numpy()
-        if self.multiclass:
-            multiclass_labels = self.mlb.fit_transform(np.expand_dims(np_labels, 1))
-
         if self.use_mse:
             # Per-class output in multiclass, softmax activation
             if self.multiclass:
-                tensor_labels = torch.from_numpy(multiclass_labels).float().to(output.device)
+                tensor_labels = F.one_hot(label, self.num_classes).float()
                 loss = self.loss(output, tensor_labels)
                 pred = output.data.max(1)[1]
 
@@ -117,8 +120,19 @@ class BasicModel(nn.Module):
             loss = self.loss(output, label)
             pred = output.data.max(1)[1]
 
+        if timer is not None: timer.lap('forward')
         loss.backward()
+        if timer is not None: timer.lap('backward')
         self.optimizer.step()
+        if timer is not None: timer.lap('optimizer')
+
+        if metrics is not None:
+            metrics.update(loss, pred, label.data, query, output.data if self.compute_correct_rank else None)
+            return dict(pred=pred.data)
+
+        np_labels = label.data.cpu().numpy()
+        if self.multiclass:
+            multiclass_labels = self.mlb.fit_transform(np.expand_dims(np_labels, 1))
 
         correct = pred.eq(label.data).cpu()
         accuracy = correct.sum() * 100. / len(label)
@@ -154,7 +168,7 @@ class BasicModel(nn.Module):
 
         return results
 
-    def test_(self, input_img, label, query=None):
+    def test_(self, input_img, label, query=None, metrics=None, timer=None):
         """
         Test mode. Functionally almost entirely the same as the train_ function, but without
         taking a backward step through the loss and optimizer, and with an explcit no_grad wrapper
@@ -162,19 +176,19 @@ class BasicModel(nn.Module):
             [batch_size x channels x width x height]
         :param label: the correct prediction for this image, used in order to compute the loss
         :param query: The query, if this model utilizes it
-        :return: A dict of metrics for this batch: accuracy, loss, AUC, and predictions
+        :param metrics: If not None, a StreamingMetrics to accumulate the metrics of this batch into, on the device,
+            instead of computing them on the host
+        :param timer: If not None, a PhaseTimer to time the forward pass with
+        :return: A dict of metrics for this batch: accuracy, loss, AUC, and predictions; only the predictions if
+            accumulating into metrics
         """
         with torch.no_grad():
             output = self(input_img, query)
 
-            np_labels = label.data.cpu().numpy()
-            if self.multiclass:
-                multiclass_labels = self.mlb.fit_transform(np.expand_dims(np_labels, 1))
-
             if self.use_mse:
                 # Per-class output in multiclass, softmax activation
                 if self.multiclass:
-                    tensor_labels = torch.from_numpy(multiclass_labels).float().to(output.device)
+                    tensor_labels = F.one_hot(label, self.num_classes).float()
                     loss = self.loss(output, tensor_labels)
                     pred = output.data.max(1)[1]
 
@@ -189,6 +203,16 @@ class BasicModel(nn.Module):
                 loss = self.loss(output, label)
                 pred = output.data.max(1)[1]
 
+            if timer is not None: timer.lap('forward')
+
+            if metrics is not None:
+                metrics.update(loss, pred, label.data, query, output.data if self.compute_correct_rank else None)
+                return dict(pred=pred.data)
+
+            np_labels = label.data.cpu().numpy()
+            if self.multiclass:
+                multiclass_labels = self.mlb.fit_transform(np.expand_dims(np_labels, 1))
+
             correct = pred.eq(label.data).cpu()
             accuracy = correct.sum() * 100. / len(label)
 
@@ -308,8 +332,22 @@ def now():
     return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
 
+def expand_query_ids(Q, dataloader):
+    """
+    Datasets created with `return_query_ids` return each query as an integer id, rather than as a vector. Expand those
+    ids into the query vectors the models expect, on whichever device the ids already are.
+    :param Q: The queries of a batch, as returned by the dataloader (and possibly moved to a device)
+    :param dataloader: The dataloader the batch came from, whose dataset holds the `query_vectors` for each id
+    :return: The queries as vectors; Q itself if it already held vectors (or was None)
+    """
+    if Q is None or Q.dim() != 1:
+        return Q
+
+    return torch.from_numpy(dataloader.dataset.query_vectors).to(Q.device)[Q]
+
+
 def train_epoch(model, dataloader, cuda=True, device=None,
-                num_batches_to_print=DEFAULT_NUM_BATCHES_TO_PRINT, debug=False):
+                num_batches_to_print=DEFAULT_NUM_BATCHES_TO_PRINT, debug=False, streaming_metrics=False, profile=False):
     """
     Train a model through an entire epoch, aggregating results.
     :param model: The model being trained
@@ -317,13 +355,22 @@ def train_epoch(model, dataloader, cuda=True, device=None,
     :param cuda: Whether or not to use CUDA (GPU acceleration)
     :param device: If using CUDA, which device to use; if None and cuda=True, using the default
     :param num_batches_to_print: How often to print results to the console.
+    :param streaming_metrics: Whether or not to accumulate the metrics on the device, with a StreamingMetrics, rather
+        than copying each batch's results to the host; the results have the same structure either way
+    :param profile: Whether or not to time each phase of each batch (see PhaseTimer), adding the percentiles of each
+        phase to the results (as 'phase_times') and to model.results (as 'train_phase_times')
     :return: Aggregated model results (accuracy, loss, auc, etc.) for the entire epoch
     """
 
     epoch_results = defaultdict(list)
     epoch_results['per_query_results'] = defaultdict(list)
+    metrics = StreamingMetrics(model.num_classes) if streaming_metrics else None
+    timer = create_phase_timer(profile, cuda)
+    if timer is not None: timer.start()
 
     for batch_index, batch in enumerate(dataloader):
+        if timer is not None: timer.lap('data')
+
         if model.use_query:
             X, y, Q = batch
 
@@ -336,25 +383,38 @@ def train_epoch(model, dataloader, cuda=True, device=None,
             y = y.to(device)
             if Q is not None: Q = Q.to(device)
 
+        Q = expand_query_ids(Q, dataloader)
         images = Variable(X)
         labels = Variable(y).long()
+        if timer is not None: timer.lap('transfer')
+
         if Q is not None:
             queries = Variable(Q).float()
-            results = model.train_(images, labels, queries)
+            results = model.train_(images, labels, queries, metrics=metrics, timer=timer)
         else:
-            results = model.train_(images, labels)
+            results = model.train_(images, labels, metrics=metrics, timer=timer)
+
+        if metrics is None:
+            epoch_results['accuracies'].append(results['accuracy'])
+            epoch_results['losses'].append(results['loss'])
+            if 'auc' in results and results['auc'] is not None: epoch_results['aucs'].append(results['auc'])
+            if model.compute_correct_rank: epoch_results['correct_rank'].extend(results['correct_rank'])
 
-        epoch_results['accuracies'].append(results['accuracy'])
-        epoch_results['losses'].append(results['loss'])
-        if 'auc' in results and results['auc'] is not None: epoch_results['aucs'].append(results['auc'])
-        if model.compute_correct_rank: epoch_results['correct_rank'].extend(results['correct_rank'])
+            for query in results['per_query_results']:
+                epoch_results['per_query_results'][query].extend(results['per_query_results'][query])
+
+            if (batch_index + 1) % num_batches_to_print == 0:
+                print(
+                    f'{now()}: After batch {batch_index + 1}, average acc is {np.mean(accuracies):.3f} and average loss is {np.mean(losses):.3f}')
+
+        if timer is not None: timer.lap('metrics')
 
-        for query in results['per_query_results']:
-            epoch_results['per_query_results'][query].extend(results['per_query_results'][query])
+    if metrics is not None:
+        epoch_results = metrics.epoch_results()
 
-        if (batch_index + 1) % num_batches_to_print == 0:
-            print(
-                f'{now()}: After batch {batch_index + 1}, average acc is {np.mean(accuracies):.3f} and average loss is {np.mean(losses):.3f}')
+    if timer is not None:
+        epoch_results['phase_times'] = timer.summary()
+        model.results['train_phase_times'].append(epoch_results['phase_times'])
 
     model.results['train_accuracies'].append(np.mean(epoch_results['accuracies']))
     model.results['train_losses'].append(np.mean(epoch_results['losses']))
@@ -366,7 +426,7 @@ def train_epoch(model, dataloader, cuda=True, device=None,
     return epoch_results
 
 
-def test(model, dataloader, cuda=True, device=None, training=False):
+def test(model, dataloader, cuda=True, device=None, training=False, streaming_metrics=False, profile=False):
     """
     Test a model through an entire epoch, aggregating results.
     :param model: The model being trained
@@ -375,13 +435,22 @@ def test(model, dataloader, cuda=True, device=None, training=False):
     :param device: If using CUDA, which device to use; if None and cuda=True, using the default
     :param training: Whether or not in training mode. If true, calls the model's post_test function
         after done testing. Used for learning rate scheduler purposes.
+    :param streaming_metrics: Whether or not to accumulate the metrics on the device, with a StreamingMetrics, rather
+        than copying each batch's results to the host; the results have the same structure either way
+    :param profile: Whether or not to time each phase of each batch (see PhaseTimer), adding the percentiles of each
+        phase to the results (as 'phase_times') and to model.results (as 'test_phase_times')
     :return: Aggregated model results (accuracy, loss, auc, etc.) for the entire epoch
     """
     test_results = defaultdict(list)
     test_results['per_query_results'] = defaultdict(list)
+    metrics = StreamingMetrics(model.num_classes) if streaming_metrics else None
+    timer = create_phase_timer(profile, cuda)
+    if timer is not None: timer.start()
 
     with torch.no_grad():
         for batch in dataloader:
+            if timer is not None: timer.lap('data')
+
             if model.use_query:
                 X, y, Q = batch
 
@@ -394,21 +463,34 @@ def test(model, dataloader, cuda=True, device=None, training=False):
                 y = y.to(device)
                 if Q is not None: Q = Q.to(device)
 
+            Q = expand_query_ids(Q, dataloader)
             images = Variable(X)
             labels = Variable(y).long()
+            if timer is not None: timer.lap('transfer')
+
             if Q is not None:
                 queries = Variable(Q).float()
-                results = model.test_(images, labels, queries)
+                results = model.test_(images, labels, queries, metrics=metrics, timer=timer)
             else:
-                results = model.test_(images, labels)
+                results = model.test_(images, labels, metrics=metrics, timer=timer)
 
-            test_results['accuracies'].append(results['accuracy'])
-            test_results['losses'].append(results['loss'])
-            if 'auc' in results and results['auc'] is not None: test_results['aucs'].append(results['auc'])
-            if model.compute_correct_rank: test_results['correct_rank'].extend(results['correct_rank'])
+            if metrics is None:
+                test_results['accuracies'].append(results['accuracy'])
+                test_results['losses'].append(results['loss'])
+                if 'auc' in results and results['auc'] is not None: test_results['aucs'].append(results['auc'])
+                if model.compute_correct_rank: test_results['correct_rank'].extend(results['correct_rank'])
 
-            for query in results['per_query_results']:
-                test_results['per_query_results'][query].extend(results['per_query_results'][query])
+                for query in results['per_query_results']:
+                    test_results['per_query_results'][query].extend(results['per_query_results'][query])
+
+            if timer is not None: timer.lap('metrics')
+
+        if metrics is not None:
+            test_results = metrics.epoch_results()
+
+        if timer is not None:
+            test_results['phase_times'] = timer.summary()
+            model.results['test_phase_times'].append(test_results['phase_times'])
 
         model.results['test_accuracies'].append(np.mean(test_results['accuracies']))
         mean_loss = np.mean(test_results['losses'])
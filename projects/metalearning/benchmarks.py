@@ -1,4 +1,5 @@
 from .base_model import *
+from .tracing import export_epoch_trace
 
 
 DEFAULT_ACCURACY_THRESHOLD = 0.95
@@ -129,6 +130,9 @@ def sequential_benchmark(model, train_dataloader, test_dataloader, accuracy_thre
 
         log_results = create_log_results_dict(total_training_size, train_results, test_results, query_order,
                                               current_query_index)
+        log_results.update(image_cache_log_dict('Train', train_dataloader.dataset))
+        log_results.update(image_cache_log_dict('Test', test_dataloader.dataset))
+        export_epoch_trace(epoch)
 
         # for k, v in log_results.items():
         #     print(f'{k}: {v}')
@@ -294,6 +298,27 @@ def create_log_results_dict(total_training_size, train_results=None, test_result
     return log_results
 
 
+def image_cache_log_dict(name, dataset):
+    """
+    Report (and print) how well the compressed image cache of a dataset served the last epoch, if it uses one, and
+    reset its counters for the next epoch.
+    :param name: The name to prefix the results with, e.g. 'Train'
+    :param dataset: The dataset
+    :return: A dict of the results to log, empty if the dataset does not use a compressed image cache
+    """
+    cache = getattr(dataset, 'compressed_image_cache', None)
+    if cache is None:
+        return {}
+
+    print(f'{name} compressed image cache: hit rate {cache.hit_rate:.3f}, {cache.mean_decode_milliseconds:.3f} ms to decode each image')
+    log_results = {
+        f'{name} Image Cache Hit Rate': cache.hit_rate,
+        f'{name} Image Cache Decode ms': cache.mean_decode_milliseconds,
+    }
+    cache.reset_counters()
+    return log_results
+
+
 def epoch_results_to_log_dict(name, epoch_results, query_order=None, current_query_index=0, all_queries=False):
     name = name.capitalize()
     log_dict = {
@@ -327,6 +352,11 @@ def epoch_results_to_log_dict(name, epoch_results, query_order=None, current_que
             [np.mean(epoch_results['per_query_results'][query])
              for query in query_order[:current_query_index]])
 
+    # Present when the epoch was profiled
+    for phase, phase_summary in epoch_results.get('phase_times', {}).items():
+        log_dict.update({f'{name} Phase {phase} {statistic} ({"s" if statistic == "total" else "ms"})': value
+                         for statistic, value in phase_summary.items()})
+
     return log_dict
 
 
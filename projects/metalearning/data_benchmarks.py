@@ -0,0 +1,424 @@
+import torch
+import numpy as np
+import functools
+import itertools
+import multiprocessing
+import platform
+import queue
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import sys
+import os
+from datetime import datetime
+
+from .dataset import MetaLearningH5DatasetFromDescription, MemmapMetaLearningDataset, \
+    SequentialBenchmarkMetaLearningDataset, BalancedBatchesMetaLearningDataset, \
+    CustomCurriculumSequentialBenchmarkMetaLearningDataset, \
+    BalancedBatchesCustomCurriculumSequentialBenchmarkMetaLearningDataset, ForgettingExperimentMetaLearningDataset, \
+    create_dataloader
+from .samplers import BatchIndexSampler, BlockShuffleSampler
+from .synthetic import create_synthetic_dataset
+
+
+DEFAULT_BENCHMARK_NUM_SAMPLES = 20000
+DEFAULT_BENCHMARK_BATCH_SIZE = 1500
+DEFAULT_BLOCK_SHUFFLE_WINDOW_SIZES = (1024, 4096, 16384, 65536)
+PIPELINE_DATASETS = ('from_description', 'sequential', 'balanced_batches', 'curriculum', 'balanced_batches_curriculum',
+                     'forgetting')
+DEFAULT_PIPELINE_NUM_WORKERS = (0, 2, 4)
+DEFAULT_PIPELINE_BATCH_SIZES = (512,)
+DEFAULT_PIPELINE_PIN_MEMORY = (False,)
+DEFAULT_PIPELINE_EPISODES = (0, 4)
+DEFAULT_PIPELINE_NUM_BATCHES = 20
+DEFAULT_SYNTHETIC_NUM_IMAGES = 10000
+PIPELINE_QUERY_ORDER = list(range(10))
+
+
+def measure_dataset_throughput(dataset, num_samples=DEFAULT_BENCHMARK_NUM_SAMPLES, batch_size=None, random_seed=0):
+    """
+    Measure how quickly a dataset serves uniformly random samples, in the calling process and without a DataLoader,
+    so that the measurement reflects only the storage and decoding path.
+    :param dataset: The dataset to read from
+    :param num_samples: How many samples to read
+    :param batch_size: If None, read one sample at a time through __getitem__; otherwise, read batches of this size
+        through get_batch
+    :param random_seed: The seed used to draw the indices, so that different datasets are read in the same order
+    :return: The number of samples read per second
+    """
+    indices = np.random.RandomState(random_seed).randint(len(dataset), size=num_samples)
+
+    start_time = time.perf_counter()
+
+    if batch_size is None:
+        for index in indices:
+            dataset[int(index)]
+
+    else:
+        for start in range(0, num_samples, batch_size):
+            dataset.get_batch(indices[start:start + batch_size])
+
+    return num_samples / (time.perf_counter() - start_time)
+
+
+def benchmark_memmap_against_hdf5(h5_path, memmap_dir, num_samples=DEFAULT_BENCHMARK_NUM_SAMPLES,
+                                  batch_size=DEFAULT_BENCHMARK_BATCH_SIZE, random_seed=0):
+    """
+    Compare the samples/sec of MetaLearningH5DatasetFromDescription, reading the HDF5 file, to that of
+    MemmapMetaLearningDataset, reading its converted copy; both per-sample and batched.
+    :param h5_path: The HDF5 file
+    :param memmap_dir: The directory the HDF5 file was converted to
+    :param num_samples: How many samples to read in each measurement
+    :param batch_size: Which batch size to use for the batched measurements
+    :param random_seed: The seed used to draw the indices read
+    :return: A dict mapping the name of each measurement to the samples/sec measured
+    """
+    datasets = dict(
+        hdf5=MetaLearningH5DatasetFromDescription(h5_path, return_indices=False),
+        memmap=MemmapMetaLearningDataset(memmap_dir, return_indices=False),
+    )
+
+    results = {}
+    for name, dataset in datasets.items():
+        results[f'{name} per-sample'] = measure_dataset_throughput(dataset, num_samples, None, random_seed)
+        results[f'{name} batched'] = measure_dataset_throughput(dataset, num_samples, batch_size, random_seed)
+
+    for name, samples_per_sec in results.items():
+        print(f'{name}: {samples_per_sec:.1f} samples/sec')
+
+    return results
+
+
+def measure_sampler_throughput(dataset, sampler, num_samples=DEFAULT_BENCHMARK_NUM_SAMPLES):
+    """
+    Measure how quickly a dataset serves the batches of a batch sampler (such as BatchIndexSampler, or
+    BlockShuffleSampler with a batch size), read through get_batch in the calling process.
+    :param dataset: The dataset to read from
+    :param sampler: The sampler, yielding arrays of indices
+    :param num_samples: Stop after (at least) this many samples
+    :return: The number of samples read per second
+    """
+    num_read = 0
+    start_time = time.perf_counter()
+
+    for batch in sampler:
+        dataset.get_batch(batch)
+        num_read += len(batch)
+        if num_read >= num_samples:
+            break
+
+    return num_read / (time.perf_counter() - start_time)
+
+
+def benchmark_block_shuffle(h5_path, window_sizes=DEFAULT_BLOCK_SHUFFLE_WINDOW_SIZES,
+                            num_samples=DEFAULT_BENCHMARK_NUM_SAMPLES, batch_size=DEFAULT_BENCHMARK_BATCH_SIZE,
+                            block_size=None):
+    """
+    Compare the samples/sec of batches drawn with a plain per-example shuffle to those drawn with a
+    BlockShuffleSampler, at several window sizes. Note that once the file is in the OS page cache, this measures the
+    cost of decoding chunks rather than of the disk; drop the caches between runs to measure the latter.
+    :param h5_path: The HDF5 file
+    :param window_sizes: The window sizes to measure the block shuffle with
+    :param num_samples: How many samples to read in each measurement
+    :param batch_size: Which batch size to read
+    :param block_size: The block size for the block shuffle; defaults to the chunk size of the images in the file
+    :return: A dict mapping the name of each measurement to the samples/sec measured
+    """
+    dataset = MetaLearningH5DatasetFromDescription(h5_path, return_indices=False)
+
+    results = dict(shuffle=measure_sampler_throughput(dataset, BatchIndexSampler(dataset, batch_size, True),
+                                                      num_samples))
+    for window_size in window_sizes:
+        sampler = BlockShuffleSampler(dataset, window_size, block_size, batch_size=batch_size)
+        results[f'block shuffle, window {window_size}'] = measure_sampler_throughput(dataset, sampler, num_samples)
+
+    for name, samples_per_sec in results.items():
+        print(f'{name}: {samples_per_sec:.1f} samples/sec')
+
+    return results
+
+
+def benchmark_h5_layout(h5_path, chunk_cache_bytes=None, num_samples=DEFAULT_BENCHMARK_NUM_SAMPLES,
+                        batch_size=DEFAULT_BENCHMARK_BATCH_SIZE, random_seed=0):
+    """
+    Measure the samples/sec MetaLearningH5DatasetFromDescription reads from an HDF5 file at, per-sample and batched,
+    with the same random indices for every file, to compare chunk layouts and compressors.
+    :param h5_path: The HDF5 file
+    :param chunk_cache_bytes: The chunk cache size to open the file with; None for h5py's default
+    :param num_samples: How many samples to read in each measurement
+    :param batch_size: Which batch size to use for the batched measurement
+    :param random_seed: The seed used to draw the indices read
+    :return: A dict mapping the name of each measurement to the samples/sec measured
+    """
+    dataset = MetaLearningH5DatasetFromDescription(h5_path, return_indices=False, chunk_cache_bytes=chunk_cache_bytes)
+
+    results = {
+        'per-sample': measure_dataset_throughput(dataset, num_samples, None, random_seed),
+        'batched': measure_dataset_throughput(dataset, num_samples, batch_size, random_seed),
+    }
+
+    for name, samples_per_sec in results.items():
+        print(f'{h5_path} {name}: {samples_per_sec:.1f} samples/sec')
+
+    return results
+
+
+def _uniform_curriculum(training_set_size, episode_number, task_number):
+    return training_set_size / episode_number
+
+
+def create_pipeline_dataset(name, h5_path, batch_size, random_seed=33):
+    """
+    Create one of the datasets the pipeline benchmark measures, configured as the benchmark scripts do (scaled to the
+    size of the file): coresets of half the images, as the default 22,500 are of the real training set, a curriculum
+    splitting the same number of images evenly between the tasks, and sub-epochs of 1,500 images.
+    :param name: Which dataset, one of PIPELINE_DATASETS
+    :param h5_path: The file to read from
+    :param batch_size: The batch size, which the balanced-batch datasets need to know
+    :param random_seed: The dataset random seed
+    :return: The dataset, and whether or not its dataloader should shuffle it
+    """
+    if name == 'from_description':
+        return MetaLearningH5DatasetFromDescription(h5_path, return_indices=False), True
+
+    dataset = MetaLearningH5DatasetFromDescription(h5_path, return_indices=False)
+    coreset_size = dataset.num_images // 2
+    curriculum_function = functools.partial(_uniform_curriculum, coreset_size)
+    sequential_kwargs = dict(benchmark_dimension=0, random_seed=random_seed, query_order=PIPELINE_QUERY_ORDER,
+                             return_indices=False)
+
+    if name == 'sequential':
+        return SequentialBenchmarkMetaLearningDataset(
+            h5_path, previous_query_coreset_size=coreset_size, **sequential_kwargs), True
+
+    if name == 'balanced_batches':
+        return BalancedBatchesMetaLearningDataset(
+            h5_path, batch_size, previous_query_coreset_size=coreset_size, **sequential_kwargs), False
+
+    if name == 'curriculum':
+        return CustomCurriculumSequentialBenchmarkMetaLearningDataset(
+            h5_path, curriculum_function=curriculum_function, **sequential_kwargs), True
+
+    if name == 'balanced_batches_curriculum':
+        return BalancedBatchesCustomCurriculumSequentialBenchmarkMetaLearningDataset(
+            h5_path, batch_size, curriculum_function=curriculum_function, **sequential_kwargs), False
+
+    if name == 'forgetting':
+        return ForgettingExperimentMetaLearningDataset(
+            h5_path, sub_epoch_size=min(1500, dataset.num_images // 2), **sequential_kwargs), True
+
+    raise ValueError(f'The dataset must be one of {PIPELINE_DATASETS}, not {name}')
+
+
+def _max_episode(name):
+    if name == 'from_description':
+        return 0
+
+    # The forgetting experiment starts from the second query
+    if name == 'forgetting':
+        return len(PIPELINE_QUERY_ORDER) - 2
+
+    return len(PIPELINE_QUERY_ORDER) - 1
+
+
+def _peak_rss_mb(pid='self'):
+    """
+    The peak RSS of a process, in MB. On Linux, read from /proc, as ru_maxrss carries over from the parent of a spawned
+    process (which would report the parent's peak); elsewhere, only the calling process is supported.
+    """
+    try:
+        with open(f'/proc/{pid}/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+
+    except OSError:
+        pass
+
+    if pid != 'self':
+        return None
+
+    # ru_maxrss is in kilobytes on Linux, and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / 2 ** 20 if sys.platform == 'darwin' else peak_rss / 2 ** 10
+
+
+def _record_worker_start(worker_start_times, worker_id):
+    worker_start_times[worker_id] = time.time()
+
+
+def measure_pipeline_case(name, h5_path, num_workers, batch_size, pin_memory, episode,
+                          num_batches=DEFAULT_PIPELINE_NUM_BATCHES, batched_reads=False, worker_start_method=None):
+    """
+    Measure a single configuration of the data pipeline: a dataset, advanced to an episode, served by the same
+    dataloader training uses. Meant to run in a fresh process (see `benchmark_pipeline`), so that the peak RSS
+    measured is that of this configuration alone.
+    :param name: Which dataset, one of PIPELINE_DATASETS
+    :param h5_path: The file to read from
+    :param num_workers: How many dataloader workers to use
+    :param batch_size: Which batch size to use
+    :param pin_memory: Whether or not to pin memory
+    :param episode: Which episode (query index) to advance the dataset to, with next_query
+    :param num_batches: How many batches to read (at most; an epoch may be shorter)
+    :param batched_reads: Whether or not to read entire batches through get_batch
+    :param worker_start_method: The multiprocessing start method of the workers; None for this process's default
+    :return: A dict of the configuration and its measurements: samples/sec after the first batch, the latency of
+        start_epoch, the time from starting the workers until the last of them is ready (None without workers), the
+        time until the first batch, and the peak RSS of this process and the largest of its workers (None without
+        workers, or outside Linux), in MB
+    """
+    start_time = time.perf_counter()
+    dataset, shuffle = create_pipeline_dataset(name, h5_path, batch_size)
+    construction_seconds = time.perf_counter() - start_time
+
+    for _ in range(episode):
+        dataset.next_query()
+
+    start_epoch_seconds = None
+    if hasattr(dataset, 'start_epoch'):
+        start_time = time.perf_counter()
+        dataset.start_epoch()
+        start_epoch_seconds = time.perf_counter() - start_time
+
+    dataloader = create_dataloader(dataset, batch_size, shuffle, num_workers, pin_memory, batched_reads)
+    worker_start_times = None
+    if num_workers > 0:
+        context = multiprocessing.get_context(worker_start_method)
+        worker_start_times = context.Array('d', num_workers)
+        dataloader.multiprocessing_context = context
+        dataloader.worker_init_fn = functools.partial(_record_worker_start, worker_start_times)
+
+    iterator_start_time = time.time()
+    start_time = time.perf_counter()
+    iterator = iter(dataloader)
+    next(iterator)
+    first_batch_seconds = time.perf_counter() - start_time
+
+    num_samples = 0
+    start_time = time.perf_counter()
+    for batch in itertools.islice(iterator, num_batches - 1):
+        num_samples += len(batch[0])
+
+    elapsed = time.perf_counter() - start_time
+    # Read before the workers shut down, which deleting the iterator does
+    worker_peak_rss = [_peak_rss_mb(worker.pid) for worker in getattr(iterator, '_workers', [])]
+    peak_worker_rss_mb = max((rss for rss in worker_peak_rss if rss is not None), default=None)
+    del iterator
+
+    worker_startup_seconds = None
+    if worker_start_times is not None:
+        worker_startup_seconds = max(worker_start_times[:]) - iterator_start_time
+
+    return dict(dataset=name, num_workers=num_workers, batch_size=batch_size, pin_memory=pin_memory,
+                episode=episode, batched_reads=batched_reads, worker_start_method=worker_start_method,
+                num_samples=num_samples,
+                samples_per_sec=num_samples / elapsed if num_samples > 0 else None,
+                construction_seconds=construction_seconds, start_epoch_seconds=start_epoch_seconds,
+                worker_startup_seconds=worker_startup_seconds, first_batch_seconds=first_batch_seconds,
+                peak_rss_mb=_peak_rss_mb(), peak_worker_rss_mb=peak_worker_rss_mb)
+
+
+def _measure_pipeline_case_process(results_queue, kwargs):
+    try:
+        results_queue.put(measure_pipeline_case(**kwargs))
+
+    except Exception as e:
+        results_queue.put(dict(error=repr(e)))
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_pipeline(h5_path=None, datasets=PIPELINE_DATASETS, num_workers=DEFAULT_PIPELINE_NUM_WORKERS,
+                       batch_sizes=DEFAULT_PIPELINE_BATCH_SIZES, pin_memory=DEFAULT_PIPELINE_PIN_MEMORY,
+                       episodes=DEFAULT_PIPELINE_EPISODES, num_batches=DEFAULT_PIPELINE_NUM_BATCHES,
+                       batched_reads=False, worker_start_method=None,
+                       synthetic_num_images=DEFAULT_SYNTHETIC_NUM_IMAGES):
+    """
+    Measure the data pipeline (on the CPU, without a model) over every combination of dataset, number of workers,
+    batch size, pin_memory, and episode, each in a fresh process. Episodes past the last of a dataset's (only episode 0,
+    for MetaLearningH5DatasetFromDescription) are skipped. The results are JSON-serializable, and record the commit
+    they were measured at, so that runs at different commits can be compared.
+    :param h5_path: The file to read from; if None, a synthetic dataset of synthetic_num_images images is generated
+        (and deleted afterwards)
+    :param datasets: Which datasets to measure, from PIPELINE_DATASETS
+    :param num_workers: The numbers of workers to measure
+    :param batch_sizes: The batch sizes to measure
+    :param pin_memory: The pin_memory settings to measure
+    :param episodes: The episodes to measure
+    :param num_batches: How many batches to read in each measurement
+    :param batched_reads: Whether or not to read entire batches through get_batch
+    :param worker_start_method: The multiprocessing start method of the workers; None for the platform's default
+        (that of the calling process, as each configuration runs in a spawned process)
+    :param synthetic_num_images: How many images to generate, when not given a file
+    :return: A dict of the metadata of the run, and a list of the measurements of each configuration (see
+        `measure_pipeline_case`)
+    """
+    for name in datasets:
+        if name not in PIPELINE_DATASETS:
+            raise ValueError(f'The datasets must be in {PIPELINE_DATASETS}, not {name}')
+
+    if worker_start_method is None:
+        worker_start_method = multiprocessing.get_start_method()
+
+    temp_dir = None
+    if h5_path is None:
+        temp_dir = tempfile.mkdtemp()
+        h5_path = os.path.join(temp_dir, 'synthetic.h5')
+        create_synthetic_dataset(h5_path, synthetic_num_images)
+
+    metadata = dict(commit=_git_commit(), timestamp=datetime.now().isoformat(), h5_path=h5_path,
+                    synthetic=temp_dir is not None, num_batches=num_batches, torch=torch.__version__,
+                    python=platform.python_version(), platform=platform.platform(), cpu_count=os.cpu_count())
+    cases = []
+    context = multiprocessing.get_context('spawn')
+
+    try:
+        for name, workers, batch_size, pin, episode in itertools.product(datasets, num_workers, batch_sizes,
+                                                                          pin_memory, episodes):
+            if episode > _max_episode(name):
+                continue
+
+            kwargs = dict(name=name, h5_path=h5_path, num_workers=workers, batch_size=batch_size, pin_memory=pin,
+                          episode=episode, num_batches=num_batches, batched_reads=batched_reads,
+                          worker_start_method=worker_start_method)
+            results_queue = context.Queue()
+            process = context.Process(target=_measure_pipeline_case_process, args=(results_queue, kwargs))
+            process.start()
+
+            while True:
+                try:
+                    result = results_queue.get(timeout=1)
+                    break
+
+                except queue.Empty:
+                    # A process killed outright (e.g. out of memory) never reports back
+                    if not process.is_alive():
+                        result = dict(error=f'The process exited with code {process.exitcode}')
+                        break
+
+            process.join()
+
+            if 'error' in result:
+                print(f'{name}, {workers} workers, batch size {batch_size}, pin_memory {pin}, episode {episode} failed: {result["error"]}')
+                result.update(dataset=name, num_workers=workers, batch_size=batch_size, pin_memory=pin,
+                              episode=episode)
+
+            else:
+                print(f'{name}, {workers} workers, batch size {batch_size}, pin_memory {pin}, episode {episode}: {result["samples_per_sec"] or 0:.1f} samples/sec, first batch after {result["first_batch_seconds"]:.2f} s, peak RSS {result["peak_rss_mb"]:.0f} MB')
+
+            cases.append(result)
+
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return dict(metadata=metadata, cases=cases)
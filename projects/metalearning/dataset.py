@@ -2,13 +2,24 @@ import torch
 from torch.utils.data import Dataset, DataLoader
 from torchvision import transforms
 import numpy as np
-import h5py
 import os
-import pickle
-from collections import defaultdict, OrderedDict
+from collections import OrderedDict
 import itertools
+import atexit
+import threading
+import time
+from multiprocessing import shared_memory
 from datetime import datetime
 
+from .image_cache import LRUImageCache, CompressedImageCache, DEFAULT_COMPRESSION_LEVEL
+from .manifest import DatasetManifest
+from .normalization import BatchTransform, compute_channel_statistics
+from .samplers import BatchIndexSampler, BlockShuffleSampler
+from .variants import materialize_resized_variant
+from .storage import MemmapFile, is_memmap_dir, open_dataset_file, is_shard_index, is_shard_pattern, \
+    resolve_dataset_path
+from .tracing import trace_span, traced
+
 
 META_LEARNING_DATA = 'drive/Research Projects/Meta-Learning/v1/CLEVR_meta_learning_uint8_desc.h5'
 META_LEARNING_DATA_SMALL = 'drive/Research Projects/Meta-Learning/v1/CLEVR_meta_learning_small_uint8.h5'
@@ -18,7 +29,249 @@ NUM_WORKERS = 1
 DOWNSAMPLE_SIZE = (96, 128)
 DEFAULT_TRAIN_PROPORTION = 0.9
 
-DATASET_CACHE_FILE = 'dataset_cache.pickle'
+SHARED_MEMORY_READ_CHUNK_SIZE = 1024
+# Read a batch as one contiguous slice when it spans at most this many times the number of rows it needs
+COALESCED_READ_MAX_SPAN_RATIO = 4
+# Otherwise, read runs of rows no further apart than this as slices, since h5py's fancy indexing is slow
+COALESCED_READ_MAX_GAP = 8
+LABEL_READ_CHUNK_SIZE = 8192
+
+CORESET_SAMPLING_STRATEGIES = ('rejection', 'stratified')
+
+
+def available_memory_bytes():
+    """
+    Best-effort estimate of how many bytes we could still place in a POSIX shared-memory block: the smaller of the
+    memory the kernel reports as available and the free space in /dev/shm, where the blocks live on Linux.
+    :return: The estimate in bytes, or None if neither could be determined
+    """
+    available = None
+
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+                    break
+
+    except OSError:
+        try:
+            available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (ValueError, OSError, AttributeError):
+            pass
+
+    if os.path.isdir('/dev/shm'):
+        stat = os.statvfs('/dev/shm')
+        shm_free = stat.f_bavail * stat.f_frsize
+        available = shm_free if available is None else min(available, shm_free)
+
+    return available
+
+
+class SharedMemoryImageStore:
+    """
+    Holds the entire image array (`X`) of an HDF5 file in a single POSIX shared-memory block. The process creating
+    the store reads the images from the file exactly once. Pickled copies (which is how the DataLoader workers receive
+    the dataset) carry only the name of the block, and attach to it zero-copy the first time the images are indexed.
+    """
+    _stores = {}
+
+    def __init__(self, in_file, shape, dtype):
+        self.in_file = in_file
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.name = None
+        self._shm = None
+        self._images = None
+        self._owner = False
+
+    @classmethod
+    def get_or_create(cls, in_file, max_bytes=None, open_file=None):
+        """
+        Return the store for this file, creating it if it does not exist yet in this process. The train and test
+        datasets index the same file, so they share a single block.
+        :param in_file: The HDF5 file to load the images from
+        :param max_bytes: An optional upper limit on the size of the block, in bytes
+        :param open_file: An optional function returning a new handle to the file; defaults to opening it with h5py
+        :return: The store, or None if the images do not fit, in which case the dataset should read from the file
+        """
+        key = os.path.realpath(in_file)
+        if key in cls._stores:
+            return cls._stores[key]
+
+        if open_file is None:
+            open_file = lambda: open_dataset_file(in_file)
+
+        with open_file() as file:
+            store = cls(in_file, file['X'].shape, file['X'].dtype)
+
+            available = available_memory_bytes()
+            if max_bytes is not None:
+                available = max_bytes if available is None else min(available, max_bytes)
+
+            if available is not None and store.nbytes > available:
+                print(f'Images in {in_file} require {store.nbytes / 2 ** 30:.2f} GiB, but only {available / 2 ** 30:.2f} GiB are available for shared memory, falling back to HDF5 reads')
+                return None
+
+            store._load(file['X'])
+
+        print(f'Loaded the images in {in_file} into shared memory block {store.name}, using {store.nbytes / 2 ** 30:.2f} GiB')
+        cls._stores[key] = store
+        return store
+
+    def _load(self, images):
+        self._shm = shared_memory.SharedMemory(create=True, size=max(self.nbytes, 1))
+        self._owner = True
+        self.name = self._shm.name
+        atexit.register(self.close)
+
+        self._images = np.ndarray(self.shape, self.dtype, buffer=self._shm.buf)
+        for start in range(0, self.shape[0], SHARED_MEMORY_READ_CHUNK_SIZE):
+            end = min(start + SHARED_MEMORY_READ_CHUNK_SIZE, self.shape[0])
+            self._images[start:end] = images[start:end]
+
+    @property
+    def images(self):
+        if self._images is None:
+            self._shm = shared_memory.SharedMemory(name=self.name)
+            self._images = np.ndarray(self.shape, self.dtype, buffer=self._shm.buf)
+
+        return self._images
+
+    def close(self):
+        """
+        Detach from the block; the creating process also releases it.
+        """
+        if self._shm is None:
+            return
+
+        self._images = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+            self._owner = False
+
+        self._shm = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_shm=None, _images=None, _owner=False)
+        return state
+
+
+class SharedEpochPlan:
+    """
+    Publishes epoch plans (see EpochPlanMixIn) through a POSIX shared-memory block, so that persistent DataLoader
+    workers pick up every new plan without being restarted. The block holds a (version, length, current task) header
+    followed by the image and task arrays. The process creating it publishes plans; pickled copies, in the workers,
+    attach to the block by name and copy the plan out whenever the version changes. The version works as a seqlock: it
+    is odd while a plan is being written, and readers only accept a copy made while it stayed even and unchanged.
+    """
+    def __init__(self, capacity):
+        """
+        :param capacity: The largest number of (image, task) pairs a plan may hold
+        """
+        self.capacity = int(capacity)
+        self._shm = shared_memory.SharedMemory(create=True, size=self._header_nbytes() + 2 * self.capacity * 4)
+        self.name = self._shm.name
+        self._owner = True
+        atexit.register(self.close)
+
+        self._header = None
+        self._plan = None
+        self._attach()
+        self._header[:] = 0
+
+        self._version = None
+        self._images = None
+        self._tasks = None
+        self._current_task = None
+
+    @staticmethod
+    def _header_nbytes():
+        return 3 * np.dtype(np.int64).itemsize
+
+    def _attach(self):
+        if self._shm is None:
+            self._shm = shared_memory.SharedMemory(name=self.name)
+
+        self._header = np.ndarray((3,), np.int64, buffer=self._shm.buf)
+        self._plan = np.ndarray((2, self.capacity), np.int32, buffer=self._shm.buf, offset=self._header_nbytes())
+
+    @property
+    def is_owner(self):
+        return self._owner
+
+    def publish(self, images, tasks, current_task=-1):
+        """
+        Write a new plan to the block, making the version odd while writing, and even (and new) once done, so readers
+        notice the new plan and never accept a partially written one.
+        :param images: The image index of each index in the epoch
+        :param tasks: The task (query) index of each index in the epoch
+        :param current_task: The task currently being learned, as opposed to those replayed from coresets
+        """
+        length = len(images)
+        if length > self.capacity:
+            raise ValueError(f'An epoch plan of length {length} exceeds the shared plan capacity of {self.capacity}')
+
+        self._header[0] += 1
+        self._plan[0, :length] = images
+        self._plan[1, :length] = tasks
+        self._header[1] = length
+        self._header[2] = current_task
+        self._header[0] += 1
+
+    def latest(self):
+        """
+        Return the most recently published plan, copying it out of the block only if it changed since the last call.
+        :return: The image and task arrays of the plan, and the current task
+        """
+        if self._header is None:
+            self._attach()
+
+        while True:
+            version = int(self._header[0])
+            if version == self._version:
+                break
+
+            # A plan is being written; wait for it to be complete
+            if version % 2 == 1:
+                time.sleep(0)
+                continue
+
+            length = self._header[1]
+            current_task = int(self._header[2])
+            images = self._plan[0, :length].copy()
+            tasks = self._plan[1, :length].copy()
+
+            # Retry if a plan was (or started being) written while we were copying this one
+            if self._header[0] == version:
+                self._version, self._images, self._tasks, self._current_task = version, images, tasks, current_task
+
+        return self._images, self._tasks, self._current_task
+
+    def close(self):
+        """
+        Detach from the block; the creating process also releases it.
+        """
+        if self._shm is None:
+            return
+
+        self._header = None
+        self._plan = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+            self._owner = False
+
+        self._shm = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_shm=None, _header=None, _plan=None, _owner=False, _version=None, _images=None, _tasks=None,
+                     _current_task=None)
+        return state
 
 
 class MetaLearningH5Dataset(Dataset):
@@ -29,10 +282,14 @@ class MetaLearningH5Dataset(Dataset):
     and serves images accordingly (see the __getitem__ method)
     """
     def __init__(self, in_file, transform=None, start_index=0,
-                 end_index=None, query_subset=None, return_indices=True):
+                 end_index=None, query_subset=None, return_indices=True,
+                 use_shared_memory=False, shared_memory_limit=None, chunk_cache_bytes=None,
+                 compressed_cache_bytes=None, compressed_cache_level=DEFAULT_COMPRESSION_LEVEL):
         """
         Initialize a new dataset.
-        :param in_file: The path to read the dataset from
+        :param in_file: The path to read the dataset from: an HDF5 file, a memory-mapped dataset directory, or a
+            shard index; alternatively, a list of HDF5 shards or a glob pattern matching them, which are indexed
+            (see `storage.create_shard_index`) and read as a single file
         :param transform: Whether or not to apply any transformations to the images before returning them
         :param start_index: Which image to start reading from; used for test-train splits; default 0
         :param end_index: Which image to stop reading from; used for test-train splits;
@@ -40,31 +297,263 @@ class MetaLearningH5Dataset(Dataset):
         :param query_subset: Which subset of queries to use, if not using all queries;
             default None which means "all queries"
         :param return_indices: Whether or not to return the requested indices along with the image; default True
+        :param use_shared_memory: Whether or not to load all images once into a POSIX shared-memory block, which the
+            DataLoader workers attach to instead of reading images from the HDF5 file; default False
+        :param shared_memory_limit: An optional upper limit, in bytes, on the shared-memory block. If the images do not
+            fit under it (or in the available memory), the dataset falls back to HDF5 reads; default None
+        :param chunk_cache_bytes: If not None, the size in bytes of the HDF5 chunk cache of each dataset in the file,
+            in each process reading it; default None, using h5py's default (1 MiB)
+        :param compressed_cache_bytes: If not None, keep up to this many bytes of recently read images, compressed, in
+            RAM (in each process reading them), reading only the rest from the file; for datasets larger than memory,
+            where the shared-memory store cannot be used. The cache lives in each worker, so dataloaders over this
+            dataset keep their workers alive between epochs (see create_dataloader). Default None, reading every image
+            from the file
+        :param compressed_cache_level: The zlib compression level of the compressed cache, from 0 to 9; default 1
         """
         super(MetaLearningH5Dataset, self).__init__()
 
+        in_file = resolve_dataset_path(in_file)
         self.in_file = in_file
         self.file = None
+        self.chunk_cache_bytes = chunk_cache_bytes
         self.transform = transform
         self.start_index = start_index
         self.end_index = end_index
 
-        with h5py.File(in_file, 'r') as file:
-            if self.end_index is None:
-                self.end_index = file['X'].shape[0]
+        shapes = self.manifest.shapes
+        if self.end_index is None:
+            self.end_index = shapes['X'][0][0]
 
-            self.num_images = self.end_index - self.start_index
-            self.query_length = file['Q'].shape[2]
-            self.total_queries_per_image = file['Q'].shape[1]
+        self.num_images = self.end_index - self.start_index
+        self.query_length = shapes['Q'][0][2]
+        self.total_queries_per_image = shapes['Q'][0][1]
 
-            if query_subset is None:
-                query_subset = np.arange(self.total_queries_per_image)
+        if query_subset is None:
+            query_subset = np.arange(self.total_queries_per_image)
 
         self.query_subset = query_subset
         self.active_queries_per_image = len(self.query_subset)
 
         self.return_indices = return_indices
 
+        self.shared_image_store = None
+        if use_shared_memory:
+            self.shared_image_store = SharedMemoryImageStore.get_or_create(in_file, shared_memory_limit,
+                                                                           self._open_in_file)
+
+        self.compressed_image_cache = None
+        if compressed_cache_bytes is not None and self.shared_image_store is None:
+            image_shape, image_dtype = shapes['X']
+            self.compressed_image_cache = CompressedImageCache(compressed_cache_bytes, image_shape[1:], image_dtype,
+                                                               compressed_cache_level)
+
+    @property
+    def has_worker_local_cache(self):
+        """
+        Whether or not this dataset caches images in each process reading from it, which only pays off if the
+        DataLoader workers holding those caches live longer than a single epoch.
+        """
+        return self.compressed_image_cache is not None
+
+    @property
+    def shared_memory_nbytes(self):
+        """
+        How much RAM the shared image store occupies, in bytes; zero when reading images from the HDF5 file.
+        """
+        if self.shared_image_store is None:
+            return 0
+
+        return self.shared_image_store.nbytes
+
+    @property
+    def storage_block_size(self):
+        """
+        How many consecutive images the file stores together, i.e. the number of images in each HDF5 chunk of `X`;
+        None if the images are not chunked (as in contiguous HDF5 datasets or memory-mapped arrays). Read through a
+        handle of its own, as samplers ask for it in the main process, which must not hold the dataset's handle when
+        DataLoader workers fork.
+        """
+        with self._open_in_file() as file:
+            chunks = getattr(file['X'], 'chunks', None)
+
+        return chunks[0] if chunks is not None else None
+
+    def sampling_image_indices(self):
+        """
+        The index in the file of the image read by each index of the dataset, in this epoch; used by samplers which
+        order their indices by where the images are stored.
+        :return: An array of image indices, of the same length as the dataset
+        """
+        return self.start_index + np.arange(len(self)) // self.active_queries_per_image
+
+    def _load_image(self, image_index):
+        """
+        Load a single (untransformed) image, from the shared-memory store or the compressed cache if either is used,
+        and from the file otherwise.
+        :param image_index: The index of the image in the file
+        :return: The image, as stored in the file
+        """
+        if self.shared_image_store is not None:
+            return self.shared_image_store.images[image_index]
+
+        if self.compressed_image_cache is not None:
+            image = self.compressed_image_cache.get_many((image_index,))[0]
+            if image is None:
+                image = self._read_image(image_index)
+                self.compressed_image_cache.put(image_index, image)
+
+            return image
+
+        return self._read_image(image_index)
+
+    def _read_image(self, image_index):
+        with trace_span('read X', 'read', rows=1):
+            return self._open_file()['X'][image_index, ...]
+
+    @property
+    def manifest(self):
+        """
+        The DatasetManifest of the file this dataset reads from, loaded once per process.
+        """
+        return DatasetManifest.get_or_create(self.in_file, self._open_in_file)
+
+    def _open_in_file(self):
+        """
+        Open a new handle to the file this dataset reads from. Subclasses reading from other storage formats override
+        this to return an object indexed like an h5py.File (e.g. `file['X'][image_index, ...]`).
+        :return: The new handle, which should also support use as a context manager
+        """
+        return open_dataset_file(self.in_file, self.chunk_cache_bytes)
+
+    def _open_file(self):
+        """
+        Open the file lazily, so that each DataLoader worker holds its own handle.
+        :return: The open file
+        """
+        if self.file is None:
+            self.file = self._open_in_file()
+
+        return self.file
+
+    def __getstate__(self):
+        # File handles cannot be pickled; each DataLoader worker reopens the file lazily
+        state = self.__dict__.copy()
+        state['file'] = None
+        return state
+
+    def _read_rows(self, name, sorted_indices):
+        """
+        Read a set of rows from one of the datasets in the file with as few reads as possible: a single contiguous
+        slice if the requested rows are dense enough, and otherwise one slice per run of nearby rows. Arrays that are
+        already memory-resident or memory-mapped are fancy-indexed directly.
+        :param name: Which dataset in the file to read from
+        :param sorted_indices: The (sorted, unique) rows to read
+        :return: The requested rows, in order
+        """
+        data = self._open_file()[name]
+        if isinstance(data, np.ndarray):
+            return data[sorted_indices]
+
+        with trace_span(f'read {name}', 'read', rows=len(sorted_indices)):
+            start, stop = sorted_indices[0], sorted_indices[-1] + 1
+            if stop - start <= COALESCED_READ_MAX_SPAN_RATIO * len(sorted_indices):
+                return data[start:stop][sorted_indices - start]
+
+            runs = np.split(sorted_indices, np.flatnonzero(np.diff(sorted_indices) > COALESCED_READ_MAX_GAP) + 1)
+            return np.concatenate([data[run[0]:run[-1] + 1][run - run[0]] for run in runs])
+
+    def _load_images(self, sorted_image_indices):
+        """
+        The batched equivalent of `_load_image`.
+        :param sorted_image_indices: The (sorted, unique) indices of the images in the file
+        :return: The images, stacked in the same order
+        """
+        if self.shared_image_store is not None:
+            return self.shared_image_store.images[sorted_image_indices]
+
+        if self.compressed_image_cache is not None:
+            cached = self.compressed_image_cache.get_many(sorted_image_indices)
+            missing = np.array([image is None for image in cached])
+            if not np.any(missing):
+                return np.stack(cached)
+
+            read = self._read_rows('X', sorted_image_indices[missing])
+            for image_index, image in zip(sorted_image_indices[missing], read):
+                self.compressed_image_cache.put(image_index, image)
+
+            if np.all(missing):
+                return read
+
+            images = np.empty((len(sorted_image_indices),) + read.shape[1:], dtype=read.dtype)
+            images[missing] = read
+            images[~missing] = np.stack([image for image in cached if image is not None])
+            return images
+
+        return self._read_rows('X', sorted_image_indices)
+
+    def _transform_images(self, images):
+        if self.transform is None:
+            return images
+
+        return torch.stack([self.transform(image) for image in images])
+
+    def _get_image(self, image_index, query_index):
+        """
+        Load and transform the image of a single example. Subclasses override this (along with `_get_images`) to serve
+        some images from elsewhere, such as a cache.
+        :param image_index: The index of the image in the file
+        :param query_index: The query the image is requested with
+        :return: The image, transformed if a transformer was set during initialization
+        """
+        x = self._load_image(image_index)
+        if self.transform is not None:
+            x = self.transform(x)
+
+        return x
+
+    def _get_images(self, image_indices, query_indices):
+        """
+        The batched equivalent of `_get_image`, reading each distinct image once.
+        :param image_indices: The index in the file of the image of each example
+        :param query_indices: The query of each example
+        :return: The images, transformed and stacked
+        """
+        unique_image_indices, inverse = np.unique(image_indices, return_inverse=True)
+        return self._transform_images(self._load_images(unique_image_indices)[inverse])
+
+    def _compute_indices_batch(self, indices):
+        """
+        The batched equivalent of `_compute_indices`. Delegates to it one index at a time, so subclasses which only
+        override `_compute_indices` are batched correctly.
+        :param indices: The indices to retrieve
+        :return: Two arrays, holding the real image and query indices
+        """
+        pairs = [self._compute_indices(index) for index in indices]
+        image_indices = np.array([pair[0] for pair in pairs], dtype=np.int64)
+        query_indices = np.array([pair[1] for pair in pairs], dtype=np.int64)
+        return image_indices, query_indices
+
+    @traced('get_batch', 'dataset')
+    def get_batch(self, indices):
+        """
+        Return an entire batch, reading all of its images (and other data) with a single read per dataset in the file,
+        rather than one read per example. Used by the DataLoader when iterated with a `BatchIndexSampler`.
+        :param indices: Which indices to return
+        :return: The same values as __getitem__, each stacked across the batch
+        """
+        indices = np.asarray(indices)
+        image_indices, query_indices = self._compute_indices_batch(indices)
+        unique_image_indices, inverse = np.unique(image_indices, return_inverse=True)
+
+        x = self._get_images(image_indices, query_indices)
+        q = self._read_rows('Q', unique_image_indices)[inverse, query_indices]
+        y = self._read_rows('y', unique_image_indices)[inverse, query_indices]
+
+        if self.return_indices:
+            return x, y, q, indices
+
+        return x, y, q
+
     def _compute_indices(self, index):
         """
         Compute the image and query index from the requested index. We treat the image index as $index // num_queries$
@@ -79,6 +568,7 @@ class MetaLearningH5Dataset(Dataset):
         actual_query_index = self.query_subset[query_index]
         return image_index, actual_query_index
 
+    @traced('__getitem__', 'dataset')
     def __getitem__(self, index):
         """
         Return a transformed image, query, and ground truth answer corresponding to an index.
@@ -88,18 +578,16 @@ class MetaLearningH5Dataset(Dataset):
             The ground truth answer for this query on this image
             The input index, if initalized with this option
         """
-        image_index, query_index = self._compute_indices(index)
-
-        if self.file is None:
-            self.file = h5py.File(self.in_file, 'r')
+        if isinstance(index, (list, np.ndarray)):
+            return self.get_batch(index)
 
-        x = self.file['X'][image_index, ...]
-        q = self.file['Q'][image_index, query_index, ...]
-        y = self.file['y'][image_index, query_index]
+        image_index, query_index = self._compute_indices(index)
+        self._open_file()
 
-        # Preprocessing each image
-        if self.transform is not None:
-            x = self.transform(x)
+        x = self._get_image(image_index, query_index)
+        with trace_span('read Q, y', 'read', rows=1):
+            q = self.file['Q'][image_index, query_index, ...]
+            y = self.file['y'][image_index, query_index]
 
         if self.return_indices:
             return x, y, q, index
@@ -110,57 +598,356 @@ class MetaLearningH5Dataset(Dataset):
         return self.num_images * self.active_queries_per_image
 
 
+def compositional_queries(features_per_dimension):
+    """
+    Enumerate the queries answerable from the image descriptions: first every single feature, so the id of a
+    single-feature query is the feature itself, and then every conjunction of two features from different dimensions
+    (300 of them, with the default three dimensions of ten features).
+    :param features_per_dimension: how many features exist in each dimension
+    :return: A list, indexed by query id, of the tuple of features each query requires
+    """
+    dimension_offsets = np.cumsum((0,) + tuple(features_per_dimension))
+    queries = [(feature,) for feature in range(dimension_offsets[-1])]
+
+    for first_dimension, second_dimension in itertools.combinations(range(len(features_per_dimension)), 2):
+        for first_feature in range(dimension_offsets[first_dimension], dimension_offsets[first_dimension + 1]):
+            for second_feature in range(dimension_offsets[second_dimension], dimension_offsets[second_dimension + 1]):
+                queries.append((int(first_feature), int(second_feature)))
+
+    return queries
+
+
 class MetaLearningH5DatasetFromDescription(MetaLearningH5Dataset):
     """
     Entirely the same as its super class, but computing the corect answer from the image descriptions saved in the
     dataset, rather than from the hard-coded query answer. This is setup for the compostional benchmark (and other
     two-feature queries), where we wouldn't want to save the answers for all 300 possible two-item queries.
+
+    When opened, the descriptions are encoded once as a bitmask of features per object, and each query (see
+    `compositional_queries`) as the bitmask of features it requires. An image answers a query positively if one of its
+    objects has all of the query's features, which takes a single AND and compare per object, for entire batches.
     """
     def __init__(self, in_file, transform=None, start_index=0,
                  end_index=None, query_subset=None, return_indices=True,
-                 num_dimensions=3, features_per_dimension=(10, 10, 10)):
+                 num_dimensions=3, features_per_dimension=(10, 10, 10), return_query_ids=False, **kwargs):
+        """
+        :param num_dimensions: how many dimensions exist; default 3
+        :param features_per_dimension: how many features exist in each dimension; default 10 each
+        :param return_query_ids: Whether to return each query as its integer id, rather than as a (multi-)hot float64
+            vector over the features (as long as a query vector in the file's Q); `query_vectors` maps the ids to the
+            vectors. default False
+        :param kwargs: Any additional keyword arguments are passed to MetaLearningH5Dataset
+        """
         super(MetaLearningH5DatasetFromDescription, self).__init__(
-            in_file, transform, start_index, end_index, query_subset, return_indices)
+            in_file, transform, start_index, end_index, query_subset, return_indices, **kwargs)
 
         self.num_dimensions = num_dimensions
         self.features_per_dimension = features_per_dimension
+        self.return_query_ids = return_query_ids
+
+        self.num_features = int(np.sum(features_per_dimension))
+        if self.num_features > 64:
+            raise ValueError(f'Feature bitmasks support up to 64 features, but {features_per_dimension} has {self.num_features}')
+
+        if self.num_features != self.total_queries_per_image:
+            raise ValueError(f'Query vectors in {self.in_file} have {self.total_queries_per_image} entries, but {features_per_dimension} has {self.num_features} features')
+
+        self.feature_bit_dtype = np.uint32 if self.num_features <= 32 else np.uint64
+        self.queries = compositional_queries(features_per_dimension)
+        self.query_masks = np.array([sum(1 << feature for feature in query) for query in self.queries],
+                                    dtype=self.feature_bit_dtype)
+        self.query_vectors = np.zeros((len(self.queries), self.num_features), dtype=np.float64)
+        for query_id, query in enumerate(self.queries):
+            self.query_vectors[query_id, list(query)] = 1
+
+        self._encode_descriptions()
+
+    def _encode_descriptions(self):
+        """
+        Encode the description of every image in the file as `self.object_feature_bits`, an array of
+        [num_images_in_file x num_objects] feature bitmasks. The descriptions are expected to list, for each object,
+        one feature per dimension (a last axis of length num_dimensions); values outside the range of features (such
+        as padding) are ignored. Descriptions of any other layout are encoded as a single object holding every
+        feature they list, answering each query by whether the image has all of its features anywhere, which is exact
+        for single-feature queries, as when answering them from the descriptions directly. The entire file is encoded, since the sequential benchmark datasets index images by their position in the file. The
+        encoding is computed once per file, and then loaded from the manifest.
+        """
+        cache_key = ('object_feature_bits', self.num_dimensions, tuple(self.features_per_dimension))
+        self.object_feature_bits = self.manifest.get_or_compute(cache_key, self._compute_object_feature_bits)
+
+    def _compute_object_feature_bits(self):
+        with self._open_in_file() as file:
+            descriptions = file['D']
+            total_images = descriptions.shape[0]
+            if descriptions.shape[-1] == self.num_dimensions:
+                num_objects = int(np.prod(descriptions.shape[1:])) // self.num_dimensions
+
+            else:
+                print(f'Warning, expected descriptions of shape [num_images x num_objects x {self.num_dimensions}], but D in {self.in_file} has shape {descriptions.shape}; answering queries by which features each image has, regardless of their objects')
+                num_objects = 1
+
+            object_feature_bits = np.zeros((total_images, num_objects), dtype=self.feature_bit_dtype)
+
+            for start in range(0, total_images, LABEL_READ_CHUNK_SIZE):
+                end = min(start + LABEL_READ_CHUNK_SIZE, total_images)
+                desc = np.asarray(descriptions[start:end]).reshape(end - start, num_objects, -1)
+                valid = (desc >= 0) & (desc < self.num_features)
+                shifts = np.where(valid, desc, 0).astype(self.feature_bit_dtype)
+                feature_bits = np.where(valid, np.left_shift(self.feature_bit_dtype(1), shifts),
+                                        self.feature_bit_dtype(0))
+                object_feature_bits[start:end] = np.bitwise_or.reduce(feature_bits, axis=2)
+
+        return object_feature_bits
+
+    def compute_labels(self, image_indices, query_ids):
+        """
+        Answer queries on images from the encoded descriptions.
+        :param image_indices: The indices of the images in the file
+        :param query_ids: The id of the query to answer on each image, as enumerated by `compositional_queries`
+        :return: An int64 array of 0/1 answers
+        """
+        masks = self.query_masks[query_ids][..., np.newaxis]
+        return np.any((self.object_feature_bits[image_indices] & masks) == masks, axis=-1).astype(np.int64)
+
+    def _queries_for_output(self, query_ids):
+        if self.return_query_ids:
+            return query_ids
 
+        return self.query_vectors[query_ids]
+
+    @traced('__getitem__', 'dataset')
     def __getitem__(self, index):
+        if isinstance(index, (list, np.ndarray)):
+            return self.get_batch(index)
+
         image_index, query_index = self._compute_indices(index)
+        self._open_file()
 
-        if self.file is None:
-            self.file = h5py.File(self.in_file, 'r')
+        x = self._get_image(image_index, query_index)
+        y = int(self.compute_labels(image_index, query_index))
+        q = self._queries_for_output(query_index)
+
+        if self.return_indices:
+            return x, y, q, index
 
-        x = self.file['X'][image_index, ...]
-        # TODO: for simple queries I can use y, but I will compute y, because I'll need to later
-        # y = self.file['y'][image_index, actual_query_index]
+        return x, y, q
 
-        desc = self.file['D'][image_index]
-        y = int(np.any(desc == query_index))
-        q = np.zeros((self.total_queries_per_image,))
-        q[query_index] = 1
+    @traced('get_batch', 'dataset')
+    def get_batch(self, indices):
+        indices = np.asarray(indices)
+        image_indices, query_indices = self._compute_indices_batch(indices)
 
-        # Preprocessing each image
-        if self.transform is not None:
-            x = self.transform(x)
+        x = self._get_images(image_indices, query_indices)
+        y = self.compute_labels(image_indices, query_indices)
+        q = self._queries_for_output(query_indices)
 
         if self.return_indices:
-            return x, y, q, index
+            return x, y, q, indices
 
         return x, y, q
 
 
+class MemmapMetaLearningDataset(MetaLearningH5DatasetFromDescription):
+    """
+    A drop-in replacement for MetaLearningH5DatasetFromDescription, reading from a directory of memory-mapped arrays
+    written by `storage.convert_h5_to_memmap`, rather than from the HDF5 file itself. Reads are zero-copy views of the
+    OS page cache, which all DataLoader workers share, and memory maps (unlike h5py handles) survive forking.
+    """
+    def __init__(self, in_file, transform=None, start_index=0,
+                 end_index=None, query_subset=None, return_indices=True,
+                 num_dimensions=3, features_per_dimension=(10, 10, 10), **kwargs):
+        """
+        The same arguments as MetaLearningH5DatasetFromDescription, other than
+        :param in_file: The directory the converted dataset was written to
+        """
+        if not is_memmap_dir(in_file):
+            raise ValueError(f'{in_file} is not a directory created by convert_h5_to_memmap')
+
+        super(MemmapMetaLearningDataset, self).__init__(
+            in_file, transform, start_index, end_index, query_subset, return_indices,
+            num_dimensions, features_per_dimension, **kwargs)
+
+    def _open_in_file(self):
+        return MemmapFile(self.in_file)
+
+
+class ShardedMetaLearningDataset(MetaLearningH5DatasetFromDescription):
+    """
+    A drop-in replacement for MetaLearningH5DatasetFromDescription, reading a dataset split across several HDF5 shards,
+    so that datasets can grow beyond a single file, and their shards can be generated in parallel. Images are indexed
+    globally, in the order of the shards, and `start_index` and `end_index` refer to these global indices; each
+    process opens the shards lazily, as it first reads from each of them.
+
+    Every other dataset (including SequentialBenchmarkMetaLearningDataset and its subclasses) also reads shards, when
+    given a list or glob of shards, or the path of their index, as its `in_file`.
+    """
+    def __init__(self, in_file, transform=None, start_index=0,
+                 end_index=None, query_subset=None, return_indices=True,
+                 num_dimensions=3, features_per_dimension=(10, 10, 10), **kwargs):
+        """
+        The same arguments as MetaLearningH5DatasetFromDescription, other than
+        :param in_file: A list of the shards, in order, a glob pattern matching them, or the path of an index
+            previously created by `storage.create_shard_index`
+        """
+        if not isinstance(in_file, (list, tuple)):
+            in_file = os.fspath(in_file)
+            if not is_shard_index(in_file) and not is_shard_pattern(in_file):
+                raise ValueError(f'{in_file} is neither a shard index nor a glob pattern matching shards')
+
+        super(ShardedMetaLearningDataset, self).__init__(
+            in_file, transform, start_index, end_index, query_subset, return_indices,
+            num_dimensions, features_per_dimension, **kwargs)
+
+
 def debug_print(message):
     print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: {message}')
 
 
-class SequentialBenchmarkMetaLearningDataset(MetaLearningH5DatasetFromDescription):
+class EpochPlanMixIn:
+    """
+    Stores the plan for the current epoch -- which image, and for which query (task), each index refers to -- as two
+    contiguous int32 arrays, `epoch_images` and `epoch_tasks`, rather than as a list of (image, task) tuples. Indices
+    are then mapped with an array lookup (vectorized for entire batches), and the plan is cheap to pickle to workers.
+
+    After `share_epoch_plan`, every new plan is also published through a SharedEpochPlan, which lets persistent
+    DataLoader workers follow the plan across epochs and queries without being restarted.
+
+    Datasets which compute their plans in `_plan_epoch` can also plan the next epoch on a background thread, while the
+    current one trains (see `_start_background_plan`). Each such plan draws from its own random state, seeded by the
+    dataset's random seed, the first image of its split, the number of the epoch, and the current query, so the plans
+    do not depend on when the background thread runs, and a train and a test split sharing a seed are not correlated.
+    These plans differ from those planned in start_epoch, which keep drawing from the dataset's random state, so that
+    existing seeds reproduce their plans.
+    """
+    shared_epoch_plan = None
+    _planner_thread = None
+    _background_plan = None
+
+    def _set_epoch_plan(self, images, tasks):
+        self.epoch_images = np.ascontiguousarray(images, dtype=np.int32)
+        self.epoch_tasks = np.ascontiguousarray(tasks, dtype=np.int32)
+        self.epoch_current_task = int(self.query_order[self.current_query_index])
+
+        if self.shared_epoch_plan is not None and self.shared_epoch_plan.is_owner:
+            self.shared_epoch_plan.publish(self.epoch_images, self.epoch_tasks, self.epoch_current_task)
+
+    def share_epoch_plan(self, capacity=None):
+        """
+        Start publishing the epoch plans of this dataset through shared memory. Must be called before the dataset is
+        handed to (persistent) DataLoader workers.
+        :param capacity: The longest plan to support; defaults to every image assigned to every query, the longest
+            plan any of the datasets can produce
+        """
+        if self.shared_epoch_plan is not None:
+            return
+
+        if capacity is None:
+            capacity = max(self.num_images * len(self.query_order), len(self.epoch_images))
+
+        self.shared_epoch_plan = SharedEpochPlan(capacity)
+        self.shared_epoch_plan.publish(self.epoch_images, self.epoch_tasks, self.epoch_current_task)
+
+    def _refresh_epoch_plan(self):
+        if self.shared_epoch_plan is not None and not self.shared_epoch_plan.is_owner:
+            self.epoch_images, self.epoch_tasks, self.epoch_current_task = self.shared_epoch_plan.latest()
+
+    @staticmethod
+    def _plan_from_segments(segments):
+        """
+        Build an epoch plan from a sequence of segments, each assigning a number of images to a single task.
+        :param segments: An iterable of (images, task) pairs, in the order the images should appear in the epoch
+        :return: The images and tasks of the plan, as two arrays
+        """
+        segments = list(segments)
+        if len(segments) == 0:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+
+        return (np.concatenate([images for images, _ in segments]),
+                np.concatenate([np.full(len(images), task) for images, task in segments]))
+
+    def _plan_epoch(self, random_state):
+        """
+        Compute the plan of the next epoch, without setting it; implemented by datasets supporting background planning.
+        :param random_state: The np.random.RandomState to sample the plan with
+        :return: The images and tasks of the plan, as two arrays
+        """
+        raise NotImplementedError()
+
+    def _plan_epoch_with_own_random_state(self, plan_key):
+        epoch_number, query_index = plan_key
+        seed_sequence = np.random.SeedSequence(self.random_seed,
+                                               spawn_key=(self.start_index, epoch_number, query_index))
+        return self._plan_epoch(np.random.RandomState(seed_sequence.generate_state(4)))
+
+    def _start_background_plan(self, plan_key):
+        """
+        Start computing the plan identified by plan_key, an (epoch number, query index) pair, on a background thread.
+        Only one plan is computed at a time, and it draws from its own random state, never the dataset's.
+        """
+        def plan():
+            try:
+                self._background_plan = (plan_key, self._plan_epoch_with_own_random_state(plan_key))
+
+            except Exception as e:
+                self._background_plan = (plan_key, e)
+
+        self._background_plan = None
+        self._planner_thread = threading.Thread(target=plan, name='epoch-planner', daemon=True)
+        self._planner_thread.start()
+
+    def _take_background_plan(self, plan_key):
+        """
+        Wait for the background plan, and return it if it is the plan identified by plan_key; otherwise (if it was
+        discarded, or none was started), compute that plan now.
+        :return: The images and tasks of the plan, as two arrays
+        """
+        self._wait_for_background_plan()
+        background_plan, self._background_plan = self._background_plan, None
+
+        if background_plan is None or background_plan[0] != plan_key:
+            return self._plan_epoch_with_own_random_state(plan_key)
+
+        if isinstance(background_plan[1], Exception):
+            raise background_plan[1]
+
+        return background_plan[1]
+
+    def _wait_for_background_plan(self):
+        if self._planner_thread is not None:
+            self._planner_thread.join()
+            self._planner_thread = None
+
+    def _discard_background_plan(self):
+        self._wait_for_background_plan()
+        self._background_plan = None
+
+    def __getstate__(self):
+        # Threads cannot be pickled, and the workers only follow the plans the main process sets
+        state = super(EpochPlanMixIn, self).__getstate__()
+        state.update(_planner_thread=None, _background_plan=None)
+        return state
+
+    def _compute_indices(self, index):
+        self._refresh_epoch_plan()
+        return int(self.epoch_images[index]), int(self.epoch_tasks[index])
+
+    def sampling_image_indices(self):
+        self._refresh_epoch_plan()
+        return self.epoch_images
+
+    def _compute_indices_batch(self, indices):
+        self._refresh_epoch_plan()
+        return self.epoch_images[indices].astype(np.int64), self.epoch_tasks[indices].astype(np.int64)
+
+
+class SequentialBenchmarkMetaLearningDataset(EpochPlanMixIn, MetaLearningH5DatasetFromDescription):
     def __init__(self, in_file, benchmark_dimension, random_seed,
                  previous_query_coreset_size, query_order, single_dimension=True,
                  coreset_size_per_query=False, transform=None,
                  start_index=0, end_index=None, return_indices=True,
                  num_dimensions=3, features_per_dimension=(10, 10, 10),
-                 imbalance_threshold=0.2, num_sampling_attempts=20):
+                 imbalance_threshold=0.2, num_sampling_attempts=20, coreset_sampling='rejection',
+                 coreset_cache_size=0, background_planning=False, **kwargs):
         """
         Dataset class for the sequential benchmark. Samples coreset images according to the description in the paper.
         During the first episode, returns 22,500 images for the current task. During every subsequent episodes, returns
@@ -184,10 +971,30 @@ class SequentialBenchmarkMetaLearningDataset(MetaLearningH5DatasetFromDescriptio
         :param return_indices: Whether or not to return the requested indices along with the image; default True
         :param num_dimensions: how many dimensions exist; default 3
         :param features_per_dimension: how many features exist in each dimension; default 10 each
+        :param imbalance_threshold: The smallest proportion of positive (or negative) examples allowed in each
+            previous task's coreset
+        :param num_sampling_attempts: How many times to attempt sampling a balanced coreset, when using rejection
+            sampling, before restarting the allocation (and how many restarts to allow before raising an error)
+        :param coreset_sampling: How to sample the shared coresets of the previous tasks: 'rejection' (the default)
+            draws random coresets until one is balanced enough; 'stratified' draws each coreset directly from the
+            task's positive and negative images, with the positive count clamped to the imbalance threshold, and never
+            retries
+        :param coreset_cache_size: If positive, keep up to this many coreset images (those of previous tasks) in an LRU
+            cache in each process reading from the dataset, in front of the file reads. The images are cached as read,
+            and transformed on every use, so random augmentations still vary. As each coreset image is read once per
+            epoch, the cache only hits across epochs, so dataloaders over this dataset keep their workers alive (see
+            create_dataloader). default 0, no cache
+        :param background_planning: Whether or not to plan each epoch on a background thread, while the previous epoch
+            trains, rather than in start_epoch. Each plan then draws from its own random state (see EpochPlanMixIn),
+            so the plans differ from those planned in start_epoch, but are just as deterministic; default False
+        :param kwargs: Any additional keyword arguments are passed to MetaLearningH5Dataset
         """
+        if coreset_sampling not in CORESET_SAMPLING_STRATEGIES:
+            raise ValueError(f'Coreset sampling must be one of {CORESET_SAMPLING_STRATEGIES}, received {coreset_sampling}')
+
         super(SequentialBenchmarkMetaLearningDataset, self).__init__(
             in_file, transform, start_index, end_index, None, return_indices,
-            num_dimensions, features_per_dimension)
+            num_dimensions, features_per_dimension, **kwargs)
 
         # In the case it's a single-dimension example, validate parameters
         if single_dimension:
@@ -210,57 +1017,84 @@ class SequentialBenchmarkMetaLearningDataset(MetaLearningH5DatasetFromDescriptio
         self.coreset_size_per_query = coreset_size_per_query
         self.random_seed = random_seed
         np.random.seed(random_seed)
+        self.random_state = np.random.RandomState(random_seed)
         self.imbalance_threshold = imbalance_threshold
         self.num_sampling_attempts = num_sampling_attempts
+        self.coreset_sampling = coreset_sampling
+        self.coreset_cache = LRUImageCache(coreset_cache_size) if coreset_cache_size > 0 else None
+        self.background_planning = background_planning
+        self.num_planned_epochs = 0
         self.query_order = query_order
         self.current_query_index = 0
         self._cache_images_by_query()
-        self.current_epoch_queries = []
+        self._set_epoch_plan([], [])
 
         self.start_epoch()
 
-    def _cache_images_by_query(self):
-        """
-        Cache which images are positive and which are negative for each query, to allow for balanced coresets.
-        This computation should happen once per dataset, and then be loaded from the cache.
-        :return:
-        """
-        __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
-        cache_path = os.path.join(__location__, DATASET_CACHE_FILE)
-
-        if os.path.exists(cache_path):
-            with open(cache_path, 'rb') as cache_file:
-                cache = pickle.load(cache_file)
+    @property
+    def has_worker_local_cache(self):
+        return self.coreset_cache is not None or \
+            super(SequentialBenchmarkMetaLearningDataset, self).has_worker_local_cache
 
-        else:
-            cache = {}
+    def _get_image(self, image_index, query_index):
+        if self.coreset_cache is None:
+            return super(SequentialBenchmarkMetaLearningDataset, self)._get_image(image_index, query_index)
 
-        positive_cache_key = (self.in_file, 'per_query_positive')
-        negative_cache_key = (self.in_file, 'per_query_negative')
+        return self._get_images(np.array([image_index]), np.array([query_index]))[0]
 
-        if positive_cache_key in cache and negative_cache_key in cache:
-            print('Loading positive and negative images from cache')
-            self.positive_images = cache[positive_cache_key]
-            self.negative_images = cache[negative_cache_key]
+    def _get_images(self, image_indices, query_indices):
+        """
+        Serve the images of coreset examples -- those of tasks other than the current one -- through the coreset
+        cache, and read the rest (the current task's stream, which would only churn the cache) from the file.
+        """
+        if self.coreset_cache is None:
+            return super(SequentialBenchmarkMetaLearningDataset, self)._get_images(image_indices, query_indices)
+
+        unique_image_indices, inverse = np.unique(image_indices, return_inverse=True)
+        is_coreset = np.zeros(len(unique_image_indices), dtype=bool)
+        is_coreset[inverse[query_indices != self.epoch_current_task]] = True
+
+        # The images are cached untransformed, and transformed below on every use, so random augmentations still vary
+        images = [None] * len(unique_image_indices)
+        coreset_positions = np.flatnonzero(is_coreset)
+        for position, image in zip(coreset_positions,
+                                   self.coreset_cache.get_many(unique_image_indices[coreset_positions])):
+            images[position] = image
+
+        positions_to_load = np.array([position for position, image in enumerate(images) if image is None],
+                                     dtype=np.int64)
+        if len(positions_to_load) > 0:
+            loaded_images = self._load_images(unique_image_indices[positions_to_load])
+            for position, image in zip(positions_to_load, loaded_images):
+                images[position] = image
+                if is_coreset[position]:
+                    self.coreset_cache.put(unique_image_indices[position], image)
+
+        return self._transform_images(np.stack(images)[inverse])
 
-        else:
-            self.positive_images = defaultdict(set)
-            self.negative_images = defaultdict(set)
+    def _cache_images_by_query(self):
+        """
+        Cache which images are positive and which are negative for each query, to allow for balanced coresets. The
+        result is a boolean [num_queries x num_images] matrix, `self.positive_mask`, so that membership tests and
+        positive counts are array operations (the negative images are simply its complement). The label matrix is
+        read in a few large chunks, and stored in the dataset manifest with one bit per image and query.
+        This computation should happen once per dataset, and then be loaded from the manifest.
+        :return:
+        """
+        packed_positive_mask, total_images = self.manifest.get_or_compute('per_query_positive_bits',
+                                                                          self._compute_packed_positive_mask)
+        self.positive_mask = np.unpackbits(packed_positive_mask, axis=1, count=total_images).astype(bool)
 
-            with h5py.File(self.in_file, 'r') as file:
-                y = file['y']
-                for i in range(y.shape[0]):
-                    for q in range(y.shape[1]):
-                        if y[i, q] == 1:
-                            self.positive_images[q].add(i)
-                        else:
-                            self.negative_images[q].add(i)
+    def _compute_packed_positive_mask(self):
+        with self._open_in_file() as file:
+            y = file['y']
+            positive_mask = np.empty((y.shape[1], y.shape[0]), dtype=bool)
 
-            cache[positive_cache_key] = self.positive_images
-            cache[negative_cache_key] = self.negative_images
+            for start in range(0, y.shape[0], LABEL_READ_CHUNK_SIZE):
+                end = min(start + LABEL_READ_CHUNK_SIZE, y.shape[0])
+                positive_mask[:, start:end] = (y[start:end] == 1).T
 
-            with open(cache_path, 'wb') as cache_file:
-                pickle.dump(cache, cache_file)
+        return np.packbits(positive_mask, axis=1), positive_mask.shape[1]
 
     def __len__(self):
         # if self.coreset_size_per_query:
@@ -272,23 +1106,89 @@ class SequentialBenchmarkMetaLearningDataset(MetaLearningH5DatasetFromDescriptio
         #
         # # For the first task, there's no coreset
         # return self.num_images - self.previous_query_coreset_size
-        return len(self.current_epoch_queries)
+        return len(self.epoch_images)
 
     def next_query(self):
         """
         This does not actualyl do much, other than increment the current_query_index. The reason is that start_epoch
-        reads that variable and will use this new value
+        reads that variable and will use this new value. A plan computed in the background for the previous query is
+        discarded.
         """
+        self._discard_background_plan()
         self.current_query_index += 1
 
-    def _allocate_images_to_tasks(self, depth=0):
+    def _sample_shared_coreset(self, available_images, coreset_size, query, random_state):
+        """
+        Sample a coreset for a previous task out of the images not yet allocated to another task, making sure it is
+        balanced (that is, the smaller of its positive and negative proportions is at least the imbalance threshold).
+        :param available_images: The unallocated images, in random order; reshuffled in place between attempts
+        :param coreset_size: How many images to sample
+        :param query: Which query the coreset is for
+        :param random_state: The np.random.RandomState to sample with
+        :return: The coreset, or None if failed to balance it within the allowed number of sampling attempts
+        """
+        if coreset_size == 0:
+            return available_images[:0]
+
+        if self.coreset_sampling == 'stratified':
+            return self._sample_stratified_coreset(available_images, coreset_size, query, random_state)
+
+        for attempt in range(self.num_sampling_attempts):
+            if attempt > 0:
+                random_state.shuffle(available_images)
+
+            coreset = available_images[:coreset_size]
+            positive_proportion = np.sum(self.positive_mask[query, coreset]) / coreset_size
+            if min(positive_proportion, 1 - positive_proportion) >= self.imbalance_threshold:
+                return coreset
+
+        return None
+
+    def _sample_stratified_coreset(self, available_images, coreset_size, query, random_state):
+        """
+        Sample a coreset for a previous task directly from its available positive and negative images. The number of
+        positive images is first drawn as it would be in a uniformly random coreset (from the hypergeometric
+        distribution), and then clamped so that both positives and negatives make up at least the imbalance threshold.
+        Balance is therefore guaranteed whenever the available images allow it, without ever retrying.
+        :param available_images: The unallocated images, in random order
+        :param coreset_size: How many images to sample
+        :param query: Which query the coreset is for
+        :param random_state: The np.random.RandomState to sample with
+        :return: The coreset, with its positive images first
+        """
+        is_positive = self.positive_mask[query, available_images]
+        positive_images = available_images[is_positive]
+        negative_images = available_images[~is_positive]
+
+        positive_count = random_state.hypergeometric(len(positive_images), len(negative_images), coreset_size)
+        min_count = int(np.ceil(self.imbalance_threshold * coreset_size))
+        positive_count = np.clip(positive_count, min_count, coreset_size - min_count)
+        # We cannot take more positives or negatives than there are available
+        positive_count = np.clip(positive_count, coreset_size - len(negative_images), len(positive_images))
+
+        if min(positive_count, coreset_size - positive_count) < min_count:
+            print(f'Warning, only {len(positive_images)} positive and {len(negative_images)} negative images are available for query {query}, the coreset will be imbalanced')
+
+        # The available images are in random order, so their prefixes are uniformly random samples
+        return np.concatenate((positive_images[:positive_count], negative_images[:coreset_size - positive_count]))
+
+    def _allocate_images_to_tasks(self, random_state, depth=0):
+        """
+        Allocate the images of the current epoch to tasks, as described in start_epoch. Works over a single random
+        permutation of the images and a mask of which of them are still available, so each task costs a few array
+        operations, and the allocation depends only on the random state.
+        :param random_state: The np.random.RandomState to sample with
+        :param depth: How many times the allocation was restarted after failing to balance a coreset
+        :return: An OrderedDict mapping each task to an array of its images
+        """
         task_to_images = OrderedDict()
 
         if depth >= self.num_sampling_attempts:
             raise ValueError('Warning, exceeded maximum number of sampling attempts, this is not great')
 
         if not self.coreset_size_per_query:
-            image_set = set(range(self.num_images))
+            permutation = random_state.permutation(self.num_images)
+            available = np.ones(self.num_images, dtype=bool)
 
             if self.current_query_index > 0:
                 query_coreset_sizes = np.array([int(self.previous_query_coreset_size * i / self.current_query_index)
@@ -300,60 +1200,59 @@ class SequentialBenchmarkMetaLearningDataset(MetaLearningH5DatasetFromDescriptio
 
             # This would happen in our test loader:
             if self.previous_query_coreset_size == self.num_images:
-                task_to_images[previous_query] = range(self.num_images)
+                task_to_images[previous_query] = np.arange(self.num_images)
 
             else:
                 if self.coreset_size_per_query:
                     positive_size = self.previous_query_coreset_size // 2
                     negative_size = positive_size
-                    positive_queries = np.random.choice(list(self.positive_images[previous_query]), positive_size,
-                                                        False)
-                    negative_queries = np.random.choice(list(self.negative_images[previous_query]), negative_size,
-                                                        False)
+                    positive_queries = random_state.choice(np.flatnonzero(self.positive_mask[previous_query]),
+                                                           positive_size, False)
+                    negative_queries = random_state.choice(np.flatnonzero(~self.positive_mask[previous_query]),
+                                                           negative_size, False)
                     current_task_coreset = np.concatenate((positive_queries, negative_queries))
 
                 else:  # shared coreset among all queries
-                    current_coreset_size = query_coreset_sizes[previous_query_index]
-
-                    smaller_proportion = 0
-                    attempt_count = 0
-
-                    while smaller_proportion < self.imbalance_threshold \
-                            and attempt_count < self.num_sampling_attempts:
-                        attempt_count += 1
-                        image_list = list(image_set)
-                        current_task_coreset = np.random.choice(image_list, current_coreset_size, False)
+                    current_task_coreset = self._sample_shared_coreset(permutation[available[permutation]],
+                                                                       query_coreset_sizes[previous_query_index],
+                                                                       previous_query, random_state)
 
-                        # negative_count = sum([x in self.negative_images[previous_query]
-                        # for x in current_task_coreset])
-                        positive_count = sum([x in self.positive_images[previous_query] for x in current_task_coreset])
-                        smaller_proportion = min(positive_count / current_coreset_size,
-                                                 1 - (positive_count / current_coreset_size))
-
-                    if attempt_count >= self.num_sampling_attempts:
+                    if current_task_coreset is None:
                         print(f'Warning, failed to balance query #{previous_query_index + 1}, restarting...')
-                        return self._allocate_images_to_tasks(depth + 1)
+                        return self._allocate_images_to_tasks(random_state, depth + 1)
 
-                    image_set = image_set.difference(set(current_task_coreset))
+                    available[current_task_coreset] = False
 
                 task_to_images[previous_query] = current_task_coreset
 
         current_query = self.query_order[self.current_query_index]
 
         if self.coreset_size_per_query:  # use the entire training set for the previous query
-            task_to_images[current_query] = range(self.num_images)
+            task_to_images[current_query] = np.arange(self.num_images)
 
-        else:
-            if self.current_query_index == 0:
-                image_set = set(np.random.choice(self.num_images,
-                                                 self.num_images - self.previous_query_coreset_size,
-                                                 False))
+        elif self.current_query_index == 0:
+            task_to_images[current_query] = permutation[:self.num_images - self.previous_query_coreset_size]
 
-            task_to_images[current_query] = image_set
+        else:
+            task_to_images[current_query] = permutation[available[permutation]]
 
         return task_to_images
 
     def start_epoch(self, debug=False):
+        """
+        Set the plan of the coming epoch, computing it with `_plan_epoch`. With background planning, the plan was
+        (usually) already computed while the previous epoch trained, and we start planning the next one.
+        """
+        if not self.background_planning:
+            self._set_epoch_plan(*self._plan_epoch(self.random_state))
+            return
+
+        plan_key = (self.num_planned_epochs, self.current_query_index)
+        self._set_epoch_plan(*self._take_background_plan(plan_key))
+        self.num_planned_epochs += 1
+        self._start_background_plan((self.num_planned_epochs, self.current_query_index))
+
+    def _plan_epoch(self, random_state):
         """
         Sample the images for each coreset query to be used for the current epoch. This supports a number of
         different variations:
@@ -366,14 +1265,8 @@ class SequentialBenchmarkMetaLearningDataset(MetaLearningH5DatasetFromDescriptio
         appropriately sized coreset, making sure it is balanced, and after we finish sampling the coresets, we
         assign the remaining images to the current task.
         """
-        task_to_images = self._allocate_images_to_tasks()
-
-        self.current_epoch_queries = []
-        for task, images in task_to_images.items():
-            self.current_epoch_queries.extend(list(zip(images, itertools.cycle([task]))))
-
-    def _compute_indices(self, index):
-        return self.current_epoch_queries[index]
+        task_to_images = self._allocate_images_to_tasks(random_state)
+        return self._plan_from_segments((images, task) for task, images in task_to_images.items())
 
 
 class CustomCurriculumSequentialBenchmarkMetaLearningDataset(SequentialBenchmarkMetaLearningDataset):
@@ -381,7 +1274,7 @@ class CustomCurriculumSequentialBenchmarkMetaLearningDataset(SequentialBenchmark
                  query_order, single_dimension=True, transform=None,
                  start_index=0, end_index=None, return_indices=True,
                  num_dimensions=3, features_per_dimension=(10, 10, 10),
-                 imbalance_threshold=0.2, num_sampling_attempts=20):
+                 imbalance_threshold=0.2, num_sampling_attempts=20, **kwargs):
 
         self.curriculum_function = curriculum_function
 
@@ -391,18 +1284,15 @@ class CustomCurriculumSequentialBenchmarkMetaLearningDataset(SequentialBenchmark
             coreset_size_per_query=False, transform=transform, start_index=start_index,
             end_index=end_index, return_indices=return_indices, num_dimensions=num_dimensions,
             features_per_dimension=features_per_dimension, imbalance_threshold=imbalance_threshold,
-            num_sampling_attempts=num_sampling_attempts
+            num_sampling_attempts=num_sampling_attempts, **kwargs
         )
 
-    def _allocate_images_to_tasks(self, depth=0):
-        task_to_images = OrderedDict()
-        episode_number = self.current_query_index + 1
-
-        if depth >= self.num_sampling_attempts:
-            raise ValueError('Warning, exceeded maximum number of sampling attempts, this is not great')
-
-        image_set = set(range(self.num_images))
+    def start_epoch(self, debug=False):
+        super(CustomCurriculumSequentialBenchmarkMetaLearningDataset, self).start_epoch(debug)
+        print(f'Coreset task sizes: {self._curriculum_coreset_sizes()}')
 
+    def _curriculum_coreset_sizes(self):
+        episode_number = self.current_query_index + 1
         unrounded_coreset_sizes = np.array([self.curriculum_function(episode_number, task)
                                    for task in range(1, episode_number + 1)])
         rounded_coreset_sizes = np.around(unrounded_coreset_sizes)
@@ -421,48 +1311,41 @@ class CustomCurriculumSequentialBenchmarkMetaLearningDataset(SequentialBenchmark
                 decrement_index = np.argmin(unrounded_coreset_sizes - rounded_coreset_sizes)
                 rounded_coreset_sizes[decrement_index] -= 1
 
-        coreset_sizes = rounded_coreset_sizes.astype(np.int)
-        print(f'Coreset task sizes: {coreset_sizes}')
+        return rounded_coreset_sizes.astype(int)
+
+    def _allocate_images_to_tasks(self, random_state, depth=0):
+        task_to_images = OrderedDict()
+
+        if depth >= self.num_sampling_attempts:
+            raise ValueError('Warning, exceeded maximum number of sampling attempts, this is not great')
+
+        permutation = random_state.permutation(self.num_images)
+        available = np.ones(self.num_images, dtype=bool)
+        coreset_sizes = self._curriculum_coreset_sizes()
 
         for previous_query_index in range(self.current_query_index):
             previous_query = self.query_order[previous_query_index]
 
             # This would happen in our test loader:
             if self.previous_query_coreset_size == self.num_images:
-                task_to_images[previous_query] = range(self.num_images)
+                task_to_images[previous_query] = np.arange(self.num_images)
 
             else:
-                current_coreset_size = coreset_sizes[previous_query_index]
-
-                smaller_proportion = 0
-                attempt_count = 0
-                current_task_coreset = []
+                current_task_coreset = self._sample_shared_coreset(permutation[available[permutation]],
+                                                                   coreset_sizes[previous_query_index],
+                                                                   previous_query, random_state)
 
-                while smaller_proportion < self.imbalance_threshold \
-                        and attempt_count < self.num_sampling_attempts:
-                    attempt_count += 1
-                    image_list = list(image_set)
+                if current_task_coreset is None:
+                    print(f'Warning, failed to balance query #{previous_query_index + 1}, restarting...')
+                    return self._allocate_images_to_tasks(random_state, depth + 1)
 
-                    current_task_coreset = np.random.choice(image_list, current_coreset_size, False)
-                    positive_count = sum([x in self.positive_images[previous_query] for x in current_task_coreset])
-                    smaller_proportion = min(positive_count / current_coreset_size,
-                                             1 - (positive_count / current_coreset_size))
-
-                    if attempt_count >= self.num_sampling_attempts:
-                        print(f'Warning, failed to balance query #{previous_query_index + 1}, restarting...')
-                        return self._allocate_images_to_tasks(depth + 1)
-
-                image_set = image_set.difference(set(current_task_coreset))
+                available[current_task_coreset] = False
                 task_to_images[previous_query] = current_task_coreset
 
         current_query = self.query_order[self.current_query_index]
 
-        # Handle the current task
-        latest_task_training_set_size = coreset_sizes[-1]
-        if latest_task_training_set_size < len(image_set):
-            image_set = set(np.random.choice(list(image_set), latest_task_training_set_size, False))
-
-        task_to_images[current_query] = image_set
+        # Handle the current task -- the available images are in random order, so take as many as it needs
+        task_to_images[current_query] = permutation[available[permutation]][:coreset_sizes[-1]]
 
         return task_to_images
 
@@ -473,18 +1356,18 @@ class BalancedBatchesMetaLearningDataset(SequentialBenchmarkMetaLearningDataset)
                  coreset_size_per_query=False, transform=None,
                  start_index=0, end_index=None, return_indices=True,
                  num_dimensions=3, features_per_dimension=(10, 10, 10),
-                 imbalance_threshold=0.2, num_sampling_attempts=20):
+                 imbalance_threshold=0.2, num_sampling_attempts=20, **kwargs):
 
         super(BalancedBatchesMetaLearningDataset, self).__init__(
             in_file, benchmark_dimension, random_seed, previous_query_coreset_size,
             query_order, single_dimension, coreset_size_per_query, transform,
             start_index, end_index, return_indices, num_dimensions, features_per_dimension,
-            imbalance_threshold, num_sampling_attempts)
+            imbalance_threshold, num_sampling_attempts, **kwargs)
 
         self.batch_size = batch_size
         self.num_batches_per_epoch = self.num_images // self.batch_size
 
-    def start_epoch(self, debug=False):
+    def _plan_epoch(self, random_state):
         """
         Sample the images for each coreset query to be used for the current epoch. This supports a number of
         different variations:
@@ -497,18 +1380,14 @@ class BalancedBatchesMetaLearningDataset(SequentialBenchmarkMetaLearningDataset)
         appropriately sized coreset, making sure it is balanced, and after we finish sampling the coresets, we
         assign the remaining images to the current task.
         """
-        task_to_images = self._allocate_images_to_tasks()
+        task_to_images = self._allocate_images_to_tasks(random_state)
         for task in task_to_images:
-            image_list = list(task_to_images[task])
-            np.random.shuffle(image_list)
-            task_to_images[task] = image_list
+            task_to_images[task] = random_state.permutation(task_to_images[task])
 
         # if only one task, shuffle its examples, call it a day
         if self.current_query_index == 0:
             first_task = self.query_order[0]
-            first_task_images = task_to_images[first_task]
-            self.current_epoch_queries = list(zip(first_task_images, itertools.cycle([first_task])))
-            return
+            return self._plan_from_segments([(task_to_images[first_task], first_task)])
 
         # more than one task -- we can deal with the current task first
         # since it occupies half of every epoch
@@ -516,8 +1395,7 @@ class BalancedBatchesMetaLearningDataset(SequentialBenchmarkMetaLearningDataset)
         current_task_images = task_to_images[current_task]
         current_task_per_batch = self.batch_size // 2
 
-        batches = [list(zip(current_task_images[i * current_task_per_batch:(i + 1) * current_task_per_batch],
-                            itertools.cycle([current_task])))
+        batches = [[(current_task_images[i * current_task_per_batch:(i + 1) * current_task_per_batch], current_task)]
                    for i in range(self.num_batches_per_epoch)]
 
         # move onto the previous tasks
@@ -531,14 +1409,10 @@ class BalancedBatchesMetaLearningDataset(SequentialBenchmarkMetaLearningDataset)
 
             for task in self.query_order[:self.current_query_index]:
                 num_task_examples = prev_task_per_batch + 1 * (task in tasks_rounding_up)
-                batches[batch_index].extend(list(zip(task_to_images[task][:num_task_examples],
-                                                     itertools.cycle([task]))))
+                batches[batch_index].append((task_to_images[task][:num_task_examples], task))
                 task_to_images[task] = task_to_images[task][num_task_examples:]
 
-        self.current_epoch_queries = [pair for batch in batches for pair in batch]
-
-    def _compute_indices(self, index):
-        return self.current_epoch_queries[index]
+        return self._plan_from_segments(segment for batch in batches for segment in batch)
 
 
 class BalancedBatchesCustomCurriculumSequentialBenchmarkMetaLearningDataset(CustomCurriculumSequentialBenchmarkMetaLearningDataset):
@@ -546,7 +1420,7 @@ class BalancedBatchesCustomCurriculumSequentialBenchmarkMetaLearningDataset(Cust
                  query_order, single_dimension=True, transform=None,
                  start_index=0, end_index=None, return_indices=True,
                  num_dimensions=3, features_per_dimension=(10, 10, 10),
-                 imbalance_threshold=0.2, num_sampling_attempts=20):
+                 imbalance_threshold=0.2, num_sampling_attempts=20, **kwargs):
 
         super(BalancedBatchesCustomCurriculumSequentialBenchmarkMetaLearningDataset, self).__init__(
             in_file=in_file, benchmark_dimension=benchmark_dimension, random_seed=random_seed,
@@ -554,29 +1428,25 @@ class BalancedBatchesCustomCurriculumSequentialBenchmarkMetaLearningDataset(Cust
             single_dimension=single_dimension, transform=transform, start_index=start_index,
             end_index=end_index, return_indices=return_indices, num_dimensions=num_dimensions,
             features_per_dimension=features_per_dimension, imbalance_threshold=imbalance_threshold,
-            num_sampling_attempts=num_sampling_attempts
+            num_sampling_attempts=num_sampling_attempts, **kwargs
         )
 
         self.batch_size = batch_size
         self.num_batches_per_epoch = self.num_images // self.batch_size
 
-    def start_epoch(self, debug=False):
+    def _plan_epoch(self, random_state):
         """
         Take the allocation of tasks to images from `self._allocate_images_to_tasks()`, and split them into balanced
         batches. Correctly handles the logic of tasks not having the same number of examples in each one.
         """
-        task_to_images = self._allocate_images_to_tasks()
+        task_to_images = self._allocate_images_to_tasks(random_state)
         for task in task_to_images:
-            image_list = list(task_to_images[task])
-            np.random.shuffle(image_list)
-            task_to_images[task] = image_list
+            task_to_images[task] = random_state.permutation(task_to_images[task])
 
         # if only one task, shuffle its examples, call it a day
         if self.current_query_index == 0:
             first_task = self.query_order[0]
-            first_task_images = task_to_images[first_task]
-            self.current_epoch_queries = list(zip(first_task_images, itertools.cycle([first_task])))
-            return
+            return self._plan_from_segments([(task_to_images[first_task], first_task)])
 
         # The new logic needs to be different -- we might not have half from the current task per batch
         # and the newest task might not occupy half of the examples, so no reason to treat it uniquely
@@ -586,7 +1456,7 @@ class BalancedBatchesCustomCurriculumSequentialBenchmarkMetaLearningDataset(Cust
         # number of times. First, we can compute how many times we'll have to round up each task
         examples_per_task = np.array([len(task_to_images[task])
                                       for task in self.query_order[:self.current_query_index + 1]])
-        rounded_down_ex_per_task_per_batch = np.floor(examples_per_task / self.num_batches_per_epoch).astype(np.int)
+        rounded_down_ex_per_task_per_batch = np.floor(examples_per_task / self.num_batches_per_epoch).astype(int)
         rounded_down_batch_size = np.sum(rounded_down_ex_per_task_per_batch)
         num_to_round_up_per_batch = self.batch_size - rounded_down_batch_size
         times_to_round_up_per_task_arr = examples_per_task - (rounded_down_ex_per_task_per_batch * self.num_batches_per_epoch)
@@ -604,23 +1474,22 @@ class BalancedBatchesCustomCurriculumSequentialBenchmarkMetaLearningDataset(Cust
             # Grab a batch from each
             for task_idx, task in enumerate(self.query_order[:self.current_query_index + 1]):
                 num_task_examples = rounded_down_ex_per_task_per_batch[task_idx] + (task in tasks_rounding_up)
-                batches[batch_index].extend(list(zip(task_to_images[task][:num_task_examples],
-                                                     itertools.cycle([task]))))
+                batches[batch_index].append((task_to_images[task][:num_task_examples], task))
                 task_to_images[task] = task_to_images[task][num_task_examples:]
 
             # Decrement the number of times left to round up
             for rounded_up_task in tasks_rounding_up:
                 times_to_round_up_per_task_dict[rounded_up_task] -= 1
 
-        self.current_epoch_queries = [pair for batch in batches for pair in batch]
+        return self._plan_from_segments(segment for batch in batches for segment in batch)
 
 
-class ForgettingExperimentMetaLearningDataset(MetaLearningH5DatasetFromDescription):
+class ForgettingExperimentMetaLearningDataset(EpochPlanMixIn, MetaLearningH5DatasetFromDescription):
     def __init__(self, in_file, benchmark_dimension, random_seed,
                  sub_epoch_size, query_order, single_dimension=True,
                  transform=None,
                  start_index=0, end_index=None, return_indices=True,
-                 num_dimensions=3, features_per_dimension=(10, 10, 10)):
+                 num_dimensions=3, features_per_dimension=(10, 10, 10), **kwargs):
         """
         Dataset class for the sequential benchmark. Samples coreset images according to the description in the paper.
         During the first episode, returns 22,500 images for the current task. During every subsequent episodes, returns
@@ -644,10 +1513,11 @@ class ForgettingExperimentMetaLearningDataset(MetaLearningH5DatasetFromDescripti
         :param return_indices: Whether or not to return the requested indices along with the image; default True
         :param num_dimensions: how many dimensions exist; default 3
         :param features_per_dimension: how many features exist in each dimension; default 10 each
+        :param kwargs: Any additional keyword arguments are passed to MetaLearningH5Dataset
         """
         super(ForgettingExperimentMetaLearningDataset, self).__init__(
             in_file, transform, start_index, end_index, None, return_indices,
-            num_dimensions, features_per_dimension)
+            num_dimensions, features_per_dimension, **kwargs)
 
         # In the case it's a single-dimension example, validate parameters
         if single_dimension:
@@ -668,14 +1538,15 @@ class ForgettingExperimentMetaLearningDataset(MetaLearningH5DatasetFromDescripti
 
         self.random_seed = random_seed
         np.random.seed(random_seed)
+        self.random_state = np.random.RandomState(random_seed)
         self.sub_epoch_size = sub_epoch_size
         self.num_sub_epochs = self.num_images // self.sub_epoch_size
         self.sub_epoch_index = -1
-        self.sub_epochs = []
+        self.sub_epoch_images = None
         self.query_order = query_order
         self.current_query_index = 1  # we start from one, since we do not actually train on the 1st query
 
-        self.current_epoch_queries = []
+        self._set_epoch_plan([], [])
         self.start_epoch()
 
     def __len__(self):
@@ -690,16 +1561,10 @@ class ForgettingExperimentMetaLearningDataset(MetaLearningH5DatasetFromDescripti
         self.sub_epoch_index = -1
 
     def assign_images_to_sub_epochs(self):
-        perm = np.random.permutation(self.num_images)
-        sub_epochs_without_task = [perm[i * self.sub_epoch_size:(i + 1) * self.sub_epoch_size]
-                                   for i in range(self.num_sub_epochs)]
-
-        self.sub_epochs = [list(zip(sub_epoch,
-                                    itertools.cycle([self.query_order[self.current_query_index]])))
-                           for sub_epoch in sub_epochs_without_task]
-
-    def _compute_indices(self, index):
-        return self.sub_epochs[self.sub_epoch_index][index]
+        perm = self.random_state.permutation(self.num_images)
+        # One row per sub-epoch; all of them are of the current query, which start_epoch attaches
+        self.sub_epoch_images = perm[:self.num_sub_epochs * self.sub_epoch_size].reshape(
+            self.num_sub_epochs, self.sub_epoch_size)
 
     def start_epoch(self):
         """
@@ -712,6 +1577,178 @@ class ForgettingExperimentMetaLearningDataset(MetaLearningH5DatasetFromDescripti
             self.assign_images_to_sub_epochs()
             self.sub_epoch_index = 0
 
+        self._set_epoch_plan(self.sub_epoch_images[self.sub_epoch_index],
+                             np.full(self.sub_epoch_size, self.query_order[self.current_query_index]))
+
+
+class BatchTransformDataLoader:
+    """
+    Wraps a dataloader whose datasets return raw (untransformed) images, applying a BatchTransform to the images of
+    every collated batch, in the iterating process. The workers then only ship uint8 batches, a quarter of the size of
+    transformed float32 ones. Exposes the wrapped dataloader's dataset and length, which is all our training loops use.
+    """
+    def __init__(self, dataloader, batch_transform, device=None):
+        """
+        :param dataloader: The dataloader to wrap
+        :param batch_transform: The BatchTransform to apply
+        :param device: If not None, move the raw images to this device before transforming them, so that the
+            transform runs there (and the transfer is of uint8 images)
+        """
+        self.dataloader = dataloader
+        self.batch_transform = batch_transform
+        self.device = device
+
+    @property
+    def dataset(self):
+        return self.dataloader.dataset
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        for batch in self.dataloader:
+            x = batch[0]
+            if self.device is not None:
+                x = x.to(self.device, non_blocking=True)
+
+            yield (self.batch_transform(x),) + tuple(batch[1:])
+
+
+class CachedTestSetLoader:
+    """
+    Serves a dataset with an epoch plan (such as the sequential benchmark test set, which assigns every held-out image
+    to every query) from memory, in place of a DataLoader. The first time it is iterated, it preprocesses each image
+    the plan refers to once, keeping them all in a single tensor; every batch then indexes that tensor, with the labels
+    and queries computed from the dataset's encoded descriptions, without any workers. Images that enter the plan
+    later are preprocessed as they first appear.
+    """
+    def __init__(self, dataset, batch_size, shuffle=False, batch_transform=None, device=None):
+        """
+        :param dataset: The dataset to serve; must have an epoch plan and answer queries from descriptions
+        :param batch_size: What batch size to use
+        :param shuffle: Whether or not to shuffle the plan every time the loader is iterated
+        :param batch_transform: If the dataset returns raw images, a BatchTransform to preprocess them with
+        :param device: If not None, keep the cached images on this device, and return batches on it
+        """
+        if not isinstance(dataset, EpochPlanMixIn) or not isinstance(dataset, MetaLearningH5DatasetFromDescription):
+            raise ValueError(f'Only datasets with epoch plans and descriptions can be cached, not {type(dataset).__name__}')
+
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.batch_transform = batch_transform
+        self.device = device
+
+        self.images = None
+        self.cached_image_indices = np.zeros(0, dtype=np.int64)
+        self.image_rows = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    @property
+    def cache_nbytes(self):
+        if self.images is None:
+            return 0
+
+        return self.images.element_size() * self.images.nelement()
+
+    def _preprocess(self, sorted_image_indices):
+        images = self.dataset._transform_images(self.dataset._load_images(sorted_image_indices))
+        images = torch.as_tensor(images)
+        if self.device is not None:
+            images = images.to(self.device)
+
+        if self.batch_transform is not None:
+            images = self.batch_transform(images)
+
+        return images
+
+    def _cache_images(self, image_indices):
+        missing = np.setdiff1d(image_indices, self.cached_image_indices)
+        if len(missing) == 0:
+            return
+
+        new_images = [self._preprocess(missing[start:start + self.batch_size])
+                      for start in range(0, len(missing), self.batch_size)]
+        if self.images is not None:
+            new_images.insert(0, self.images)
+
+        self.images = torch.cat(new_images)
+        self.cached_image_indices = np.concatenate((self.cached_image_indices, missing))
+
+        self.image_rows = np.full(self.cached_image_indices.max() + 1, -1, dtype=np.int64)
+        self.image_rows[self.cached_image_indices] = np.arange(len(self.cached_image_indices))
+        print(f'Cached {len(self.cached_image_indices)} preprocessed test images, using {self.cache_nbytes / 2 ** 20:.1f} MiB')
+
+    def __iter__(self):
+        dataset = self.dataset
+        dataset._refresh_epoch_plan()
+        self._cache_images(dataset.epoch_images)
+
+        num_indices = len(dataset)
+        order = torch.randperm(num_indices).numpy() if self.shuffle else np.arange(num_indices)
+
+        for start in range(0, num_indices, self.batch_size):
+            indices = order[start:start + self.batch_size]
+            image_indices, query_indices = dataset._compute_indices_batch(indices)
+
+            rows = torch.from_numpy(self.image_rows[image_indices]).to(self.images.device)
+            x = self.images[rows]
+            y = torch.from_numpy(dataset.compute_labels(image_indices, query_indices))
+            q = torch.from_numpy(dataset._queries_for_output(query_indices))
+
+            if dataset.return_indices:
+                yield x, y, q, torch.from_numpy(indices)
+
+            else:
+                yield x, y, q
+
+
+def create_dataloader(dataset, batch_size, shuffle, num_workers, pin_memory, batched_reads=False,
+                      persistent_workers=False, block_shuffle_window=None):
+    """
+    Create a dataloader for one of the datasets.
+    :param dataset: The dataset to load from
+    :param batch_size: What batch size to use
+    :param shuffle: Should the dataloader shuffle the data
+    :param num_workers: How many workers to use
+    :param pin_memory: Whether or not to pin GPU memory
+    :param batched_reads: Whether or not to fetch entire batches at once through the dataset's `get_batch`, with the
+        workers returning pre-stacked batches; default False
+    :param persistent_workers: Whether or not to keep the workers alive between epochs, rather than starting new ones
+        every time the dataloader is iterated. Datasets with epoch plans publish them to the workers through shared
+        memory, so the workers follow calls to `start_epoch` and `next_query`. Always enabled (with workers) for
+        datasets which cache images in each worker, whose caches would otherwise start out empty every epoch;
+        default False
+    :param block_shuffle_window: If not None, and shuffling, shuffle with a BlockShuffleSampler using windows of this
+        many examples, so that batches read entire chunks of the file; default None, shuffling individual examples
+    :return: The dataloader
+    """
+    if num_workers > 0 and not persistent_workers and dataset.has_worker_local_cache:
+        print(f'Keeping the dataloader workers of {type(dataset).__name__} alive between epochs, as it caches images in each worker')
+        persistent_workers = True
+
+    persistent_workers = persistent_workers and num_workers > 0
+    if persistent_workers and isinstance(dataset, EpochPlanMixIn):
+        dataset.share_epoch_plan()
+
+    if shuffle and block_shuffle_window is not None:
+        if batched_reads:
+            return DataLoader(dataset, batch_size=None,
+                              sampler=BlockShuffleSampler(dataset, block_shuffle_window, batch_size=batch_size),
+                              num_workers=num_workers, pin_memory=pin_memory, persistent_workers=persistent_workers)
+
+        return DataLoader(dataset, batch_size=batch_size, sampler=BlockShuffleSampler(dataset, block_shuffle_window),
+                          num_workers=num_workers, pin_memory=pin_memory, persistent_workers=persistent_workers)
+
+    if batched_reads:
+        return DataLoader(dataset, batch_size=None, sampler=BatchIndexSampler(dataset, batch_size, shuffle),
+                          num_workers=num_workers, pin_memory=pin_memory, persistent_workers=persistent_workers)
+
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers, pin_memory=pin_memory,
+                      persistent_workers=persistent_workers)
+
 
 def create_normalized_datasets(dataset_path=META_LEARNING_DATA, batch_size=BATCH_SIZE, num_workers=NUM_WORKERS,
                                dataset_train_prop=DEFAULT_TRAIN_PROPORTION,
@@ -719,13 +1756,18 @@ def create_normalized_datasets(dataset_path=META_LEARNING_DATA, batch_size=BATCH
                                should_flip=True, shuffle=True, return_indices=False,
                                dataset_class=MetaLearningH5DatasetFromDescription,
                                dataset_class_kwargs=None, train_dataset_kwargs=None, test_dataset_kwargs=None,
-                               normalization_dataset_class=MetaLearningH5DatasetFromDescription,
+                               normalization_dataset_class=None,
                                train_dataset_class=None, test_dataset_class=None,
                                train_shuffle=None, test_shuffle=None,
-                               train_batch_size=None, test_batch_size=None):
+                               train_batch_size=None, test_batch_size=None,
+                               batched_reads=False, persistent_workers=False,
+                               batched_transforms=False, batch_transform_device=None,
+                               normalization_num_processes=None, cache_test_set=False, block_shuffle_window=None,
+                               materialize_downsample=False, materialized_format='memmap', materialized_dir=None):
     """
     Helper function to create both the train and test normalized datasets.
-    :param dataset_path: Which HDF5 file to load the dataset from
+    :param dataset_path: Which HDF5 file to load the dataset from; or any other path the datasets accept, such as a
+        memory-mapped dataset directory, a shard index, or a list of shards or a glob pattern matching them
     :param batch_size: What batch size to use
     :param num_workers: How many workers to use in the PyTorch dataloaders
     :param dataset_train_prop: What proportion of the dataset to assign to train; the remainder goes to test
@@ -738,20 +1780,47 @@ def create_normalized_datasets(dataset_path=META_LEARNING_DATA, batch_size=BATCH
     :param dataset_class_kwargs: Keyword arguments to pass to both train and test dataset
     :param train_dataset_kwargs: Keyword arguments to pass only to the training dataset
     :param test_dataset_kwargs: Keyword argmetns to pass only to the test dataset
-    :param normalization_dataset_class: If we need to load the dataset to normalize, if it's not cached - which class
-        to use.
+    :param normalization_dataset_class: Deprecated, and ignored with a warning: the test-train split and normalization
+        statistics now come from the dataset manifest
+    :param batched_reads: Whether or not the dataloaders should fetch entire batches at once through the datasets'
+        `get_batch`, rather than one example at a time; default False
+    :param persistent_workers: Whether or not the dataloaders should keep their workers alive across epochs (and
+        queries), rather than restarting them every epoch. Always enabled, when using workers, for datasets caching
+        images in each worker (with compressed_cache_bytes or coreset_cache_size set), as workers restarted every
+        epoch would start with empty caches, and never hit; default False
+    :param batched_transforms: Whether or not to have the datasets return raw uint8 images, and instead resize, flip,
+        and normalize entire batches after collation, with a BatchTransform; default False
+    :param batch_transform_device: With batched_transforms, an optional device to move the raw images to and run
+        the batch transforms on; default None, running them wherever the batches are
+    :param normalization_num_processes: If the normalization statistics are not cached, how many processes to
+        compute them with; default None, computing them in this process
+    :param cache_test_set: Whether or not to serve the test set from a CachedTestSetLoader, which preprocesses each
+        test image once and keeps them all in memory (on batch_transform_device, if set), instead of from a
+        DataLoader; requires a test dataset class with an epoch plan. default False
+    :param block_shuffle_window: If not None, the shuffling dataloaders shuffle storage blocks, and then windows of this
+        many examples, with a BlockShuffleSampler; default None
+    :param materialize_downsample: When downsampling, whether or not to read from a copy of the dataset with its
+        images already resized (see `variants.materialize_resized_variant`), writing it if this is the first run to
+        use this size, instead of resizing every example as it is read; default False
+    :param materialized_format: The format of the resized copy, 'memmap' or 'hdf5'; default 'memmap'
+    :param materialized_dir: The directory to store the resized copy in; default None, next to the dataset
     :return: The datasets and dataloaders for both train and test.
     """
+    if normalization_dataset_class is not None:
+        print('Warning, normalization_dataset_class is deprecated and ignored, as the normalization statistics come from the dataset manifest')
+
     if train_dataset_class is None:
         train_dataset_class = dataset_class
 
     if test_dataset_class is None:
         test_dataset_class = dataset_class
 
-    full_dataset = normalization_dataset_class(dataset_path, return_indices=return_indices)
-    test_train_split_index = int(full_dataset.num_images * dataset_train_prop)
+    # Shards are indexed once here, so that the manifest, the statistics, and every dataset read the same index
+    dataset_path = resolve_dataset_path(dataset_path)
+    manifest = DatasetManifest.get_or_create(dataset_path)
+    test_train_split_index = manifest.get_or_compute(('split_index', dataset_train_prop),
+                                                     lambda: int(manifest.num_images * dataset_train_prop))
     print(f'Splitting test-train at {test_train_split_index}')
-    del full_dataset
 
     if dataset_class_kwargs is None:
         dataset_class_kwargs = {}
@@ -770,55 +1839,34 @@ def create_normalized_datasets(dataset_path=META_LEARNING_DATA, batch_size=BATCH
         if key not in test_dataset_kwargs:
             test_dataset_kwargs[key] = dataset_class_kwargs[key]
 
-    __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
-    cache_path = os.path.join(__location__, DATASET_CACHE_FILE)
-
-    if os.path.exists(cache_path):
-        with open(cache_path, 'rb') as cache_file:
-            cache = pickle.load(cache_file)
-
-    else:
-        cache = {}
-
-    cache_key = (dataset_path, dataset_train_prop, downsample_size)
     to_tensor = transforms.ToTensor()
+    to_pil = transforms.ToPILImage()
+    resize = transforms.Resize(downsample_size) if downsample_size is not None else None
 
-    if cache_key in cache:
-        print('Loaded normalization from cache')
-        channel_means, channel_stds = cache[cache_key]
-
-    else:
-        if downsample_size is not None:
-            to_pil = transforms.ToPILImage()
-            resize = transforms.Resize(downsample_size)
-            unnormalized_transformer = transforms.Compose([
-                to_pil,
-                resize,
-                to_tensor
-            ])
-        else:
-            unnormalized_transformer = to_tensor
-
-        unnormalized_train_dataset = normalization_dataset_class(dataset_path, unnormalized_transformer,
-                                                                 end_index=test_train_split_index,
-                                                                 return_indices=return_indices)
-
-        # To get it to load the file
-        _ = unnormalized_train_dataset[0]
+    # The statistics are of the images as they are normalized, so they are resized the same way: by BatchTransform
+    # with batched transforms, and through PIL otherwise (including in the resized variants)
+    resize_method = 'tensor' if batched_transforms and not materialize_downsample else 'pil'
+    normalization_key = ('normalization', dataset_train_prop, downsample_size)
+    if downsample_size is not None:
+        normalization_key += (resize_method,)
 
-        transformed_images = np.stack([unnormalized_transformer(image).numpy() for image in
-                                       unnormalized_train_dataset.file['X']])
-        channel_means = np.mean(transformed_images, (0, 2, 3))
-        channel_stds = np.std(transformed_images, (0, 2, 3))
-        del unnormalized_train_dataset
+    if normalization_key in manifest:
+        print('Loaded normalization from the dataset manifest')
 
-        cache[cache_key] = channel_means, channel_stds
-        with open(cache_path, 'wb') as cache_file:
-            pickle.dump(cache, cache_file)
+    channel_means, channel_stds = manifest.get_or_compute(
+        normalization_key, lambda: compute_channel_statistics(dataset_path, 0, test_train_split_index, downsample_size,
+                                                              resize_method,
+                                                              num_processes=normalization_num_processes))
 
     print(channel_means)
     print(channel_stds)
 
+    # The split and normalization statistics above come from the original dataset, so they are the same either way
+    if materialize_downsample and downsample_size is not None:
+        dataset_path = materialize_resized_variant(dataset_path, downsample_size, materialized_format,
+                                                   materialized_dir)
+        downsample_size = None
+
     normalizer = transforms.Normalize(torch.from_numpy(channel_means),
                                       torch.from_numpy(channel_stds))
 
@@ -840,6 +1888,10 @@ def create_normalized_datasets(dataset_path=META_LEARNING_DATA, batch_size=BATCH
     train_transformer = transforms.Compose(train_transforms)
     test_transformer = transforms.Compose(test_transforms)
 
+    if batched_transforms:
+        train_transformer = None
+        test_transformer = None
+
     normalized_train_dataset = train_dataset_class(dataset_path, transform=train_transformer,
                                              end_index=test_train_split_index,
                                              return_indices=return_indices, **train_dataset_kwargs)
@@ -847,8 +1899,8 @@ def create_normalized_datasets(dataset_path=META_LEARNING_DATA, batch_size=BATCH
         train_shuffle = shuffle
     if train_batch_size is None:
         train_batch_size = batch_size
-    train_dataloader = DataLoader(normalized_train_dataset, batch_size=train_batch_size,
-                                  shuffle=train_shuffle, num_workers=num_workers, pin_memory=pin_memory)
+    train_dataloader = create_dataloader(normalized_train_dataset, train_batch_size, train_shuffle,
+                                         num_workers, pin_memory, batched_reads, persistent_workers, block_shuffle_window)
 
     normalized_test_dataset = test_dataset_class(dataset_path, transform=test_transformer,  # augment only in train
                                             start_index=test_train_split_index,
@@ -857,10 +1909,23 @@ def create_normalized_datasets(dataset_path=META_LEARNING_DATA, batch_size=BATCH
         test_shuffle = shuffle
     if test_batch_size is None:
         test_batch_size = batch_size
-    test_dataloader = DataLoader(normalized_test_dataset, batch_size=test_batch_size,
-                                 shuffle=test_shuffle, num_workers=num_workers, pin_memory=pin_memory)
 
-    return normalized_train_dataset, train_dataloader, normalized_test_dataset, test_dataloader
+    test_batch_transform = BatchTransform(channel_means, channel_stds, downsample_size) if batched_transforms else None
+    if cache_test_set:
+        test_dataloader = CachedTestSetLoader(normalized_test_dataset, test_batch_size, test_shuffle,
+                                              test_batch_transform, batch_transform_device)
 
+    else:
+        test_dataloader = create_dataloader(normalized_test_dataset, test_batch_size, test_shuffle,
+                                            num_workers, pin_memory, batched_reads, persistent_workers,
+                                            block_shuffle_window)
 
+        if batched_transforms:
+            test_dataloader = BatchTransformDataLoader(test_dataloader, test_batch_transform, batch_transform_device)
 
+    if batched_transforms:
+        train_dataloader = BatchTransformDataLoader(
+            train_dataloader, BatchTransform(channel_means, channel_stds, downsample_size, should_flip),
+            batch_transform_device)
+
+    return normalized_train_dataset, train_dataloader, normalized_test_dataset, test_dataloader
@@ -0,0 +1,235 @@
+import torch
+import numpy as np
+import multiprocessing
+import time
+import zlib
+from collections import OrderedDict
+
+
+_HITS = 0
+_MISSES = 1
+_DECODE_NANOSECONDS = 2
+_NUM_DECODED = 3
+
+DEFAULT_COMPRESSION_LEVEL = 1
+
+
+class LRUImageCache:
+    """
+    A bounded cache of raw (untransformed) images, as read from the file, keyed by their index in the file, evicting
+    the least recently used image once full; the dataset transforms them on every use, so random augmentations still
+    vary. Each process holds its own images -- pickled copies, such as those in DataLoader workers, start out empty --
+    but the hit and miss counters live in shared memory, so they add up over all workers.
+    """
+    def __init__(self, max_images):
+        """
+        :param max_images: How many images to hold (in each process) before evicting; each takes as much memory as
+            a raw image in the file (57,600 bytes for a 120 x 160 x 3 uint8 image)
+        """
+        if max_images <= 0:
+            raise ValueError(f'The image cache must hold at least one image, not {max_images}')
+
+        self.max_images = max_images
+        self._images = OrderedDict()
+        self._counters = multiprocessing.Array('q', 2)
+
+    def __len__(self):
+        return len(self._images)
+
+    def __contains__(self, image_index):
+        return int(image_index) in self._images
+
+    @property
+    def hits(self):
+        return self._counters[_HITS]
+
+    @property
+    def misses(self):
+        return self._counters[_MISSES]
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def reset_counters(self):
+        with self._counters.get_lock():
+            self._counters[_HITS] = 0
+            self._counters[_MISSES] = 0
+
+    def get_many(self, image_indices):
+        """
+        Look up several images at once, marking the ones found as recently used.
+        :param image_indices: The indices of the images to look up
+        :return: A list with the cached image for each index, or None where it is not cached
+        """
+        images = []
+        for image_index in image_indices:
+            image = self._images.get(int(image_index))
+            if image is not None:
+                self._images.move_to_end(int(image_index))
+
+            images.append(image)
+
+        num_hits = sum(image is not None for image in images)
+        with self._counters.get_lock():
+            self._counters[_HITS] += num_hits
+            self._counters[_MISSES] += len(images) - num_hits
+
+        return images
+
+    def put(self, image_index, image):
+        """
+        Cache an image, evicting the least recently used one if the cache is full. The image is copied, so that
+        caching a row of a batch does not keep the entire batch alive.
+        :param image_index: The index of the image
+        :param image: The raw image, as an array or a tensor
+        """
+        image = image.clone() if isinstance(image, torch.Tensor) else np.array(image)
+        self._images[int(image_index)] = image
+        self._images.move_to_end(int(image_index))
+
+        while len(self._images) > self.max_images:
+            self._images.popitem(last=False)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = OrderedDict()
+        return state
+
+
+class CompressedImageCache:
+    """
+    A bounded cache of raw (untransformed) images, held as zlib-compressed byte strings, so that many more images fit
+    in RAM than as arrays; the synthetic images compress well, as they are mostly background. Images are decompressed
+    on every hit, in the process reading them (usually a DataLoader worker), and the least recently used images are
+    evicted once the compressed images exceed the byte budget. As with LRUImageCache, each process holds its own
+    images, but the hit, miss, and decoding counters live in shared memory, and add up over all workers. Pickled
+    copies start out empty, so the cache only hits across epochs in workers which outlive an epoch (persistent ones).
+    """
+    def __init__(self, max_bytes, image_shape, image_dtype, compression_level=DEFAULT_COMPRESSION_LEVEL):
+        """
+        :param max_bytes: How many bytes of compressed images to hold (in each process) before evicting
+        :param image_shape: The shape of each image
+        :param image_dtype: The dtype of the images
+        :param compression_level: The zlib compression level, from 0 (no compression, fastest) to 9 (smallest)
+        """
+        if max_bytes <= 0:
+            raise ValueError(f'The compressed image cache requires a positive budget, not {max_bytes} bytes')
+
+        if not 0 <= compression_level <= 9:
+            raise ValueError(f'The compression level must be between 0 and 9, not {compression_level}')
+
+        self.max_bytes = max_bytes
+        self.image_shape = tuple(image_shape)
+        self.image_dtype = np.dtype(image_dtype)
+        self.compression_level = compression_level
+        self.nbytes = 0
+        self.uncompressed_nbytes = 0
+        self._blobs = OrderedDict()
+        self._counters = multiprocessing.Array('q', 4)
+
+    def __len__(self):
+        return len(self._blobs)
+
+    def __contains__(self, image_index):
+        return int(image_index) in self._blobs
+
+    @property
+    def hits(self):
+        return self._counters[_HITS]
+
+    @property
+    def misses(self):
+        return self._counters[_MISSES]
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    @property
+    def mean_decode_milliseconds(self):
+        """
+        The average time it took to decompress an image, over all processes.
+        """
+        num_decoded = self._counters[_NUM_DECODED]
+        return self._counters[_DECODE_NANOSECONDS] / num_decoded / 1e6 if num_decoded > 0 else 0.0
+
+    @property
+    def compression_ratio(self):
+        """
+        How many times smaller the images held by this process are compressed.
+        """
+        return self.uncompressed_nbytes / self.nbytes if self.nbytes > 0 else 0.0
+
+    def reset_counters(self):
+        with self._counters.get_lock():
+            for counter in range(len(self._counters)):
+                self._counters[counter] = 0
+
+    def statistics(self):
+        """
+        :return: A dict of the hit rate, mean decoding time, and (in this process) the number of images held, the
+            bytes they occupy, and their compression ratio
+        """
+        return dict(hit_rate=self.hit_rate, mean_decode_milliseconds=self.mean_decode_milliseconds,
+                    num_images=len(self), nbytes=self.nbytes, compression_ratio=self.compression_ratio)
+
+    def get_many(self, image_indices):
+        """
+        Look up and decompress several images at once, marking the ones found as recently used.
+        :param image_indices: The indices of the images to look up
+        :return: A list with the decompressed image for each index, or None where it is not cached
+        """
+        images = []
+        start_time = time.perf_counter_ns()
+
+        for image_index in image_indices:
+            blob = self._blobs.get(int(image_index))
+            if blob is None:
+                images.append(None)
+                continue
+
+            self._blobs.move_to_end(int(image_index))
+            # Decompressing into a bytearray keeps the image writable, as torch expects
+            image = np.frombuffer(bytearray(zlib.decompress(blob)), dtype=self.image_dtype)
+            images.append(image.reshape(self.image_shape))
+
+        decode_nanoseconds = time.perf_counter_ns() - start_time
+        num_hits = sum(image is not None for image in images)
+        with self._counters.get_lock():
+            self._counters[_HITS] += num_hits
+            self._counters[_MISSES] += len(images) - num_hits
+            self._counters[_DECODE_NANOSECONDS] += decode_nanoseconds if num_hits > 0 else 0
+            self._counters[_NUM_DECODED] += num_hits
+
+        return images
+
+    def put(self, image_index, image):
+        """
+        Compress and cache an image, evicting the least recently used images while over budget.
+        :param image_index: The index of the image
+        :param image: The image, as an array
+        """
+        image_index = int(image_index)
+        if image_index in self._blobs:
+            self._blobs.move_to_end(image_index)
+            return
+
+        blob = zlib.compress(np.ascontiguousarray(image, dtype=self.image_dtype).tobytes(), self.compression_level)
+        self._blobs[image_index] = blob
+        self.nbytes += len(blob)
+        self.uncompressed_nbytes += self.image_dtype.itemsize * int(np.prod(self.image_shape))
+
+        while self.nbytes > self.max_bytes and len(self._blobs) > 0:
+            _, evicted = self._blobs.popitem(last=False)
+            self.nbytes -= len(evicted)
+            self.uncompressed_nbytes -= self.image_dtype.itemsize * int(np.prod(self.image_shape))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_blobs'] = OrderedDict()
+        state['nbytes'] = 0
+        state['uncompressed_nbytes'] = 0
+        return state
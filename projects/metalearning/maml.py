@@ -1,5 +1,6 @@
 from .base_model import *
 from .cnnmlp import *
+from .profiling import create_phase_timer
 
 import torch
 
@@ -268,21 +269,33 @@ class MamlPoolingDropoutCNNMLP(CNNMLPMixIn, MamlModel):
 
 
 def maml_train_epoch(model, dataloader, cuda=True, device=None,
-                     num_batches_to_print=DEFAULT_NUM_BATCHES_TO_PRINT, debug=False):
-
+                     num_batches_to_print=DEFAULT_NUM_BATCHES_TO_PRINT, debug=False, profile=False):
+    """
+    Train a MAML model through an entire epoch, taking a meta-step on every pair of batches.
+    :param profile: Whether or not to time each phase (see PhaseTimer): fetching and copying each of the two batches
+        ('data' and 'transfer'), the entire meta-step ('maml_step'), and aggregating its results ('metrics')
+    The other arguments are the same as those of base_model.train_epoch.
+    """
     epoch_results = defaultdict(list)
     epoch_results['per_query_results'] = defaultdict(list)
+    timer = create_phase_timer(profile, cuda)
+    if timer is not None: timer.start()
 
     dataloader_iter = iter(dataloader)
 
     for batch_index, train_batch in enumerate(dataloader_iter):
-        X_train, Q_train, y_train = split_batch(train_batch, cuda, device, model)
+        if timer is not None: timer.lap('data')
+        X_train, Q_train, y_train = split_batch(train_batch, cuda, device, model, dataloader)
+        if timer is not None: timer.lap('transfer')
         meta_train_batch = next(dataloader_iter)
-        X_meta_train, Q_meta_train, y_meta_train = split_batch(meta_train_batch, cuda, device, model)
+        if timer is not None: timer.lap('data')
+        X_meta_train, Q_meta_train, y_meta_train = split_batch(meta_train_batch, cuda, device, model, dataloader)
+        if timer is not None: timer.lap('transfer')
 
         results = model.maml_train_(X_train, Q_train, y_train, X_meta_train, Q_meta_train, y_meta_train,
                                     dataloader.dataset.query_order[:dataloader.dataset.current_query_index + 1],
                                     debug=debug)
+        if timer is not None: timer.lap('maml_step')
 
         epoch_results['accuracies'].append(results['accuracy'])
         epoch_results['losses'].append(results['loss'])
@@ -295,6 +308,12 @@ def maml_train_epoch(model, dataloader, cuda=True, device=None,
             print(
                 f'{now()}: After batch {batch_index + 1}, average acc is {np.mean(accuracies):.3f} and average loss is {np.mean(losses):.3f}')
 
+        if timer is not None: timer.lap('metrics')
+
+    if timer is not None:
+        epoch_results['phase_times'] = timer.summary()
+        model.results['train_phase_times'].append(epoch_results['phase_times'])
+
     model.results['train_accuracies'].append(np.mean(epoch_results['accuracies']))
     model.results['train_losses'].append(np.mean(epoch_results['losses']))
     model.results['train_aucs'].append(np.mean(epoch_results['aucs']))
@@ -305,7 +324,7 @@ def maml_train_epoch(model, dataloader, cuda=True, device=None,
     return epoch_results
 
 
-def maml_test_epoch(model, dataloader, cuda=True, device=None, training=False, debug=False):
+def maml_test_epoch(model, dataloader, cuda=True, device=None, training=False, debug=False, profile=False):
     """
     Test a model through an entire epoch, aggregating results.
     :param model: The model being trained
@@ -314,17 +333,22 @@ def maml_test_epoch(model, dataloader, cuda=True, device=None, training=False, d
     :param device: If using CUDA, which device to use; if None and cuda=True, using the default
     :param training: Whether or not in training mode. If true, calls the model's post_test function
         after done testing. Used for learning rate scheduler purposes.
+    :param profile: Whether or not to time each phase, as in maml_train_epoch
     :return: Aggregated model results (accuracy, loss, auc, etc.) for the entire epoch
     """
     test_results = defaultdict(list)
     test_results['per_query_results'] = defaultdict(list)
+    timer = create_phase_timer(profile, cuda)
+    if timer is not None: timer.start()
 
     dataloader_iter = iter(dataloader)
 
     # We do actually need gradients inside, to take the single-steps in meta-testing
     # with torch.no_grad():
     for batch_index, test_batch in enumerate(dataloader_iter):
-        X_test, Q_test, y_test = split_batch(test_batch, cuda, device, model)
+        if timer is not None: timer.lap('data')
+        X_test, Q_test, y_test = split_batch(test_batch, cuda, device, model, dataloader)
+        if timer is not None: timer.lap('transfer')
         try:
             meta_test_batch = next(dataloader_iter)
 
@@ -332,11 +356,14 @@ def maml_test_epoch(model, dataloader, cuda=True, device=None, training=False, d
         except StopIteration:
             break
 
-        X_meta_test, Q_meta_test, y_meta_test = split_batch(meta_test_batch, cuda, device, model)
+        if timer is not None: timer.lap('data')
+        X_meta_test, Q_meta_test, y_meta_test = split_batch(meta_test_batch, cuda, device, model, dataloader)
+        if timer is not None: timer.lap('transfer')
 
         results = model.maml_test_(X_test, Q_test, y_test, X_meta_test, Q_meta_test, y_meta_test,
                                     dataloader.dataset.query_order[:dataloader.dataset.current_query_index + 1],
                                     debug=debug)
+        if timer is not None: timer.lap('maml_step')
 
         test_results['accuracies'].append(results['accuracy'])
         test_results['losses'].append(results['loss'])
@@ -345,6 +372,12 @@ def maml_test_epoch(model, dataloader, cuda=True, device=None, training=False, d
         for query in results['per_query_results']:
             test_results['per_query_results'][query].extend(results['per_query_results'][query])
 
+        if timer is not None: timer.lap('metrics')
+
+    if timer is not None:
+        test_results['phase_times'] = timer.summary()
+        model.results['test_phase_times'].append(test_results['phase_times'])
+
     model.results['test_accuracies'].append(np.mean(test_results['accuracies']))
     mean_loss = np.mean(test_results['losses'])
     model.results['test_losses'].append(mean_loss)
@@ -357,7 +390,7 @@ def maml_test_epoch(model, dataloader, cuda=True, device=None, training=False, d
     return test_results
 
 
-def split_batch(batch, cuda, device, model):
+def split_batch(batch, cuda, device, model, dataloader=None):
     if model.use_query:
         if len(batch) == 4:
             X, y, Q, index = batch
@@ -376,6 +409,9 @@ def split_batch(batch, cuda, device, model):
         y = y.to(device)
         if Q is not None: Q = Q.to(device)
 
+    if dataloader is not None:
+        Q = expand_query_ids(Q, dataloader)
+
     X = Variable(X)
     y = Variable(y).long()
     if Q is not None: Q = Variable(Q).float()
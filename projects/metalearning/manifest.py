@@ -0,0 +1,206 @@
+import numpy as np
+import hashlib
+import pickle
+import tempfile
+import os
+from contextlib import ExitStack
+
+from .storage import open_dataset_file, dataset_files, file_lock, LOCK_SUFFIX
+
+
+MANIFEST_SUFFIX = '.manifest'
+MANIFEST_LOCK_SUFFIX = LOCK_SUFFIX
+HASH_BLOCK_SIZE = 2 ** 16
+HASH_NUM_BLOCKS = 16
+
+
+def manifest_path(in_file):
+    """
+    The manifest of a dataset is a sidecar file, next to the HDF5 file (or memory-mapped dataset directory, or shard
+    index).
+    """
+    return os.path.abspath(in_file).rstrip(os.sep) + MANIFEST_SUFFIX
+
+
+def dataset_content_hash(in_file, block_size=HASH_BLOCK_SIZE, num_blocks=HASH_NUM_BLOCKS):
+    """
+    A fast fingerprint of a dataset's contents: hashes the size of each of its files, along with a fixed number of
+    blocks spread evenly through each file, so it reads about a megabyte regardless of the size of the dataset, and
+    changes whenever the dataset is regenerated (or converted again).
+    :param in_file: The HDF5 file, memory-mapped dataset directory, or shard index
+    :param block_size: How many bytes to read in each block
+    :param num_blocks: How many blocks to read from each file
+    :return: The hash, as a hex string
+    """
+    content_hash = hashlib.blake2b(digest_size=16)
+
+    for path in dataset_files(in_file):
+        size = os.path.getsize(path)
+        content_hash.update(os.path.basename(path).encode())
+        content_hash.update(size.to_bytes(8, 'little'))
+
+        with open(path, 'rb') as file:
+            for offset in np.unique(np.linspace(0, max(size - block_size, 0), num_blocks).astype(np.int64)):
+                file.seek(int(offset))
+                content_hash.update(file.read(block_size))
+
+    return content_hash.hexdigest()
+
+
+class DatasetManifest:
+    """
+    Everything we derive once from a dataset file and reuse on every run (its shapes, test-train split indices,
+    normalization statistics, per-query labels, and so on), stored in a small sidecar file next to it.
+
+    The manifest is keyed by the content hash of the dataset, so entries computed from an older version of the file
+    are discarded. Updates are written under an exclusive file lock, by atomically replacing the sidecar, so that many
+    runs starting at once neither corrupt it nor lose each other's entries; readers never need the lock. Each process
+    loads the manifest of a file once, and shares it between all datasets reading that file.
+    """
+    _manifests = {}
+
+    def __init__(self, in_file, content_hash, entries=None):
+        self.in_file = in_file
+        self.path = manifest_path(in_file)
+        self.content_hash = content_hash
+        self.entries = entries if entries is not None else {}
+
+    @classmethod
+    def get_or_create(cls, in_file, open_file=None):
+        """
+        Return the manifest of this file, loading it (or creating it, recording the shapes of the datasets in the file)
+        if it was not loaded yet in this process.
+        :param in_file: The HDF5 file or memory-mapped dataset directory
+        :param open_file: An optional function returning a new handle to the file; defaults to `open_dataset_file`
+        :return: The manifest
+        """
+        key = os.path.realpath(in_file)
+        if key in cls._manifests:
+            return cls._manifests[key]
+
+        if open_file is None:
+            open_file = lambda: open_dataset_file(in_file)
+
+        content_hash = dataset_content_hash(in_file)
+        manifest = cls(in_file, content_hash)
+        manifest.entries = manifest._read()
+
+        def compute_shapes():
+            with open_file() as file:
+                return {name: (tuple(file[name].shape), np.dtype(file[name].dtype).str) for name in file.keys()}
+
+        manifest.get_or_compute('shapes', compute_shapes)
+        cls._manifests[key] = manifest
+        return manifest
+
+    @property
+    def shapes(self):
+        return self.entries['shapes']
+
+    @property
+    def num_images(self):
+        return self.shapes['X'][0][0]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        return self.entries[key]
+
+    def get(self, key, default=None):
+        return self.entries.get(key, default)
+
+    def get_or_compute(self, key, compute):
+        """
+        Return an entry, computing and saving it if it does not exist. The entry is computed under a lock of its own,
+        so when many processes need the same missing entry, one computes it, and the others wait and read its result;
+        the manifest's lock is only taken to save it, so a long computation never blocks saving other entries.
+        :param key: The key of the entry
+        :param compute: A function of no arguments, computing the value of the entry
+        :return: The value of the entry
+        """
+        if key in self.entries:
+            return self.entries[key]
+
+        with ExitStack() as compute_lock:
+            try:
+                compute_lock.enter_context(file_lock(self._compute_lock_path(key)))
+                # Another process may have saved the entry while we waited for the lock
+                self.entries.update(self._read(warn=False))
+
+            except OSError as e:
+                print(f'Warning, could not lock {key} in the manifest {self.path} ({e}), computing it regardless')
+
+            if key in self.entries:
+                return self.entries[key]
+
+            value = compute()
+
+            try:
+                with self._locked():
+                    self.entries.update(self._read(warn=False))
+                    if key not in self.entries:
+                        self.entries[key] = value
+                        self._write()
+
+            except OSError as e:
+                print(f'Warning, could not update the manifest {self.path} ({e}), keeping {key} only in memory')
+                self.entries.setdefault(key, value)
+
+        return self.entries[key]
+
+    def _compute_lock_path(self, key):
+        return f'{self.path}.{hashlib.blake2b(repr(key).encode(), digest_size=8).hexdigest()}'
+
+    def update(self, entries):
+        """
+        Add or replace entries, and save the manifest, preserving any entries other processes saved meanwhile.
+        :param entries: A dict of the entries to add
+        """
+        self.entries.update(entries)
+
+        try:
+            with self._locked():
+                on_disk = self._read(warn=False)
+                on_disk.update(self.entries)
+                self.entries = on_disk
+                self._write()
+
+        except OSError as e:
+            print(f'Warning, could not update the manifest {self.path} ({e}), keeping the new entries only in memory')
+
+    def _read(self, warn=True):
+        if not os.path.exists(self.path):
+            return {}
+
+        with open(self.path, 'rb') as manifest_file:
+            contents = pickle.load(manifest_file)
+
+        if contents.get('content_hash') != self.content_hash:
+            if warn:
+                print(f'Ignoring the manifest {self.path}, written for a different version of {self.in_file}')
+
+            return {}
+
+        return contents['entries']
+
+    def _write(self):
+        directory = os.path.dirname(self.path)
+        descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(self.path) + '.')
+
+        try:
+            # mkstemp creates the file readable only by us, but the manifest is shared like the dataset itself
+            os.chmod(temp_path, 0o644)
+            with os.fdopen(descriptor, 'wb') as temp_file:
+                pickle.dump(dict(content_hash=self.content_hash, entries=self.entries), temp_file)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+
+            os.replace(temp_path, self.path)
+
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def _locked(self):
+        return file_lock(self.path)
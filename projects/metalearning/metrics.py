@@ -0,0 +1,172 @@
+import torch
+import torch.distributed as dist
+import numpy as np
+from collections import defaultdict
+
+
+class StreamingMetrics:
+    """
+    Accumulates the metrics of an epoch (accuracy, loss, AUC, per-query accuracy, and correct rank) as tensors on the
+    device the model runs on, so that a batch never waits on the host: every update is a handful of asynchronous tensor
+    operations, and the accumulators are copied to the host once, when the epoch's results are read.
+
+    Accuracy and loss are averaged over batches, as train_epoch and test always did. The AUC, which we compute on the
+    hard predictions, is computed from a histogram of predictions per label (i.e. a confusion matrix) over the entire
+    epoch, rather than averaged over per-batch AUCs; it is exact, and batches with a single class no longer skew it.
+
+    Accumulators from different processes (or from several loaders) can be combined with `merge`, or, under
+    torch.distributed, with `all_reduce`.
+    """
+    def __init__(self, num_classes=2):
+        """
+        :param num_classes: How many classes the model predicts
+        """
+        self.num_classes = num_classes
+        self.num_batches = 0
+        self.accuracy_sum = None
+        self.loss_sum = None
+        self.confusion = None
+        self.query_correct = None
+        self.query_total = None
+        self.correct_rank_sum = None
+        self.correct_rank_count = None
+
+    def _initialize(self, device, num_queries):
+        self.accuracy_sum = torch.zeros((), dtype=torch.float64, device=device)
+        self.loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+        self.confusion = torch.zeros(self.num_classes, self.num_classes, dtype=torch.int64, device=device)
+        self.query_correct = torch.zeros(num_queries, dtype=torch.int64, device=device)
+        self.query_total = torch.zeros(num_queries, dtype=torch.int64, device=device)
+        self.correct_rank_sum = torch.zeros((), dtype=torch.float64, device=device)
+        self.correct_rank_count = torch.zeros((), dtype=torch.int64, device=device)
+
+    def _accumulators(self):
+        return [self.accuracy_sum, self.loss_sum, self.confusion, self.query_correct, self.query_total,
+                self.correct_rank_sum, self.correct_rank_count]
+
+    def update(self, loss, pred, label, query=None, output=None):
+        """
+        Add a batch to the accumulators.
+        :param loss: The (scalar) loss of the batch
+        :param pred: The predicted class of each example
+        :param label: The correct class of each example
+        :param query: The query vector of each example (one-hot for the queries we use), if the model uses queries
+        :param output: The model's outputs; if given, the rank of the correct class is accumulated
+        """
+        if self.accuracy_sum is None:
+            self._initialize(pred.device, query.shape[1] if query is not None else 0)
+
+        correct = pred.eq(label).long()
+        ones = torch.ones_like(correct)
+        self.num_batches += 1
+        self.accuracy_sum += correct.double().mean() * 100
+        self.loss_sum += loss.detach().double()
+        # Counting with scatter_add_ rather than bincount (or boolean masks), which would wait on the device
+        self.confusion.view(-1).scatter_add_(0, label * self.num_classes + pred, ones)
+
+        if query is not None:
+            query_ids = query.argmax(1)
+            self.query_correct.scatter_add_(0, query_ids, correct)
+            self.query_total.scatter_add_(0, query_ids, ones)
+
+        if output is not None:
+            correct_output = output.detach().gather(1, label.view(-1, 1))
+            self.correct_rank_sum += (output.detach() > correct_output).sum(1).add(1).double().sum()
+            self.correct_rank_count += len(label)
+
+    def merge(self, other):
+        """
+        Add the accumulators of another StreamingMetrics (for example, one computed in another process) to these.
+        :param other: The other metrics
+        :return: self
+        """
+        if other.accuracy_sum is None:
+            return self
+
+        if self.accuracy_sum is None:
+            self._initialize(other.accuracy_sum.device, len(other.query_total))
+
+        device = self.accuracy_sum.device
+        self.num_batches += other.num_batches
+        for accumulator, other_accumulator in zip(self._accumulators(), other._accumulators()):
+            accumulator += other_accumulator.to(device)
+
+        return self
+
+    def all_reduce(self, group=None):
+        """
+        Sum the accumulators over all processes of a torch.distributed group, in place. Every process must have
+        updated the metrics at least once.
+        """
+        flat = torch.cat([accumulator.double().flatten() for accumulator in self._accumulators()] +
+                         [torch.tensor([self.num_batches], dtype=torch.float64, device=self.accuracy_sum.device)])
+        dist.all_reduce(flat, group=group)
+
+        offset = 0
+        for accumulator in self._accumulators():
+            accumulator.copy_(flat[offset:offset + accumulator.numel()].view_as(accumulator))
+            offset += accumulator.numel()
+
+        self.num_batches = int(flat[-1].item())
+
+    def auc(self, confusion=None):
+        """
+        The AUC of the hard predictions, from the confusion matrix: for two classes, that of the positive class, and
+        otherwise the mean one-vs-rest AUC over the classes with both positive and negative examples.
+        :param confusion: The confusion matrix, as a numpy array; defaults to this epoch's
+        :return: The AUC, or None if no class has both positive and negative examples
+        """
+        if confusion is None:
+            confusion = self.confusion.cpu().numpy()
+
+        total = confusion.sum()
+        classes = [1] if self.num_classes == 2 else range(self.num_classes)
+        aucs = []
+        for cls in classes:
+            positives = confusion[cls].sum()
+            negatives = total - positives
+            if positives == 0 or negatives == 0:
+                continue
+
+            true_positive_rate = confusion[cls, cls] / positives
+            true_negative_rate = (negatives - (confusion[:, cls].sum() - confusion[cls, cls])) / negatives
+            aucs.append((true_positive_rate + true_negative_rate) / 2)
+
+        return float(np.mean(aucs)) if len(aucs) > 0 else None
+
+    def epoch_results(self):
+        """
+        Copy the accumulators to the host (in a single transfer), and summarize them in the same structure train_epoch
+        and test always returned, so that the results are logged as before: lists for accuracies, losses, AUCs, and
+        correct ranks, and per-query results mapping each query to a list; each list holds the epoch's value.
+        :return: The epoch results
+        """
+        epoch_results = defaultdict(list)
+        epoch_results['per_query_results'] = defaultdict(list)
+        if self.accuracy_sum is None:
+            return epoch_results
+
+        accumulators = self._accumulators()
+        flat = torch.cat([accumulator.double().flatten() for accumulator in accumulators]).cpu().numpy()
+        values = []
+        offset = 0
+        for accumulator in accumulators:
+            values.append(flat[offset:offset + accumulator.numel()].reshape(accumulator.shape))
+            offset += accumulator.numel()
+
+        accuracy_sum, loss_sum, confusion, query_correct, query_total, correct_rank_sum, correct_rank_count = values
+
+        epoch_results['accuracies'].append(float(accuracy_sum) / self.num_batches)
+        epoch_results['losses'].append(float(loss_sum) / self.num_batches)
+
+        auc = self.auc(confusion)
+        if auc is not None:
+            epoch_results['aucs'].append(auc)
+
+        if correct_rank_count > 0:
+            epoch_results['correct_rank'].append(float(correct_rank_sum) / float(correct_rank_count))
+
+        for query in np.flatnonzero(query_total):
+            epoch_results['per_query_results'][query].append(query_correct[query] / query_total[query])
+
+        return epoch_results
@@ -0,0 +1,146 @@
+import torch
+import torch.nn.functional as F
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from .storage import open_dataset_file
+from .variants import resize_images
+
+
+NORMALIZATION_CHUNK_SIZE = 256
+RESIZE_METHODS = ('pil', 'tensor')
+
+# The file each statistics worker process reads from, opened once when the process starts
+_worker_file = None
+
+
+class BatchTransform:
+    """
+    The batched equivalent of the per-image torchvision pipelines built by `create_normalized_datasets`: converts a
+    whole collated batch of raw uint8 images to float, optionally resizes it and randomly flips each image, and
+    normalizes it, all as tensor operations on [B, C, H, W] batches, on whichever device the batch is.
+    """
+    def __init__(self, channel_means, channel_stds, downsample_size=None, should_flip=False, channels_last=True):
+        """
+        :param channel_means: The per-channel means to normalize by, in [0, 1] pixel units
+        :param channel_stds: The per-channel standard deviations to normalize by, in [0, 1] pixel units
+        :param downsample_size: If not None, the (height, width) to resize the images to
+        :param should_flip: Whether or not to flip each image horizontally and vertically, each with probability 0.5
+        :param channels_last: Whether the raw images are [B, H, W, C], as stored in our files; default True
+        """
+        self.channel_means = torch.as_tensor(channel_means, dtype=torch.float32).view(1, -1, 1, 1)
+        self.channel_stds = torch.as_tensor(channel_stds, dtype=torch.float32).view(1, -1, 1, 1)
+        self.downsample_size = downsample_size
+        self.should_flip = should_flip
+        self.channels_last = channels_last
+
+    @staticmethod
+    def _random_flip(images, dim):
+        flip = torch.rand(images.shape[0], device=images.device) < 0.5
+        return torch.where(flip.view(-1, 1, 1, 1), images.flip(dim), images)
+
+    def __call__(self, images):
+        images = torch.as_tensor(images)
+        if self.channels_last:
+            images = images.permute(0, 3, 1, 2)
+
+        images = images.float().div_(255)
+
+        if self.downsample_size is not None:
+            images = F.interpolate(images, size=self.downsample_size, mode='bilinear',
+                                   align_corners=False, antialias=True)
+
+        if self.should_flip:
+            images = self._random_flip(images, 3)
+            images = self._random_flip(images, 2)
+
+        means = self.channel_means.to(images.device)
+        stds = self.channel_stds.to(images.device)
+        return (images - means) / stds
+
+
+def _combine_moments(first, second):
+    """
+    Combine the (count, mean, M2) moments of two disjoint sets of values, using the parallel variant of Welford's
+    algorithm (Chan et al.), which is numerically stable for any split of the values.
+    """
+    first_count, first_mean, first_m2 = first
+    second_count, second_mean, second_m2 = second
+
+    if first_count == 0:
+        return second
+
+    count = first_count + second_count
+    delta = second_mean - first_mean
+    mean = first_mean + delta * second_count / count
+    m2 = first_m2 + second_m2 + delta ** 2 * first_count * second_count / count
+    return count, mean, m2
+
+
+def _chunk_channel_moments(file, start, end, downsample_size, resize_method):
+    """
+    Compute the per-channel (count, mean, M2) moments of a chunk of images, after converting them to [0, 1] floats
+    and resizing them as the datasets would, with the given resize method.
+    """
+    images = np.array(file['X'][start:end])
+    if downsample_size is not None and resize_method == 'pil':
+        images = resize_images(images, downsample_size)
+        downsample_size = None
+
+    images = BatchTransform(0, 1, downsample_size)(torch.from_numpy(images)).double()
+    count = images.shape[0] * images.shape[2] * images.shape[3]
+    mean = images.mean((0, 2, 3))
+    m2 = ((images - mean.view(1, -1, 1, 1)) ** 2).sum((0, 2, 3))
+    return count, mean.numpy(), m2.numpy()
+
+
+def _open_worker_file(in_file):
+    global _worker_file
+    _worker_file = open_dataset_file(in_file)
+
+
+def _worker_chunk_channel_moments(start, end, downsample_size, resize_method):
+    return _chunk_channel_moments(_worker_file, start, end, downsample_size, resize_method)
+
+
+def compute_channel_statistics(in_file, start_index=0, end_index=None, downsample_size=None, resize_method='pil',
+                               chunk_size=NORMALIZATION_CHUNK_SIZE, num_processes=None):
+    """
+    Compute the per-channel mean and standard deviation of the images in a file, in a single streaming pass over
+    chunks of images, so the memory used is bounded by the chunk size (times the number of processes), regardless of
+    the number of images.
+    :param in_file: The HDF5 file (or memory-mapped dataset directory) to read the images from
+    :param start_index: The first image to include; default 0
+    :param end_index: The image to stop at; default None meaning "end of the file"
+    :param downsample_size: If not None, the (height, width) to resize the images to before computing statistics
+    :param resize_method: How the images being normalized are resized, which changes their statistics slightly:
+        'pil', through PIL, as the per-example pipelines and resized variants do; or 'tensor', with the antialiased
+        bilinear interpolation of BatchTransform. default 'pil'
+    :param chunk_size: How many images to read and process at a time
+    :param num_processes: If not None, how many processes to spread the chunks over, each opening the file once;
+        default None, computing everything in the calling process
+    :return: The per-channel means and standard deviations, as float32 arrays
+    """
+    if resize_method not in RESIZE_METHODS:
+        raise ValueError(f'Resize method must be one of {RESIZE_METHODS}, not {resize_method}')
+
+    moments = (0, 0, 0)
+    with open_dataset_file(in_file) as file:
+        if end_index is None:
+            end_index = file['X'].shape[0]
+
+        chunk_starts = list(range(start_index, end_index, chunk_size))
+        chunk_args = (chunk_starts, [min(start + chunk_size, end_index) for start in chunk_starts],
+                      [downsample_size] * len(chunk_starts), [resize_method] * len(chunk_starts))
+
+        if num_processes is None:
+            for chunk_moments in map(_chunk_channel_moments, [file] * len(chunk_starts), *chunk_args):
+                moments = _combine_moments(moments, chunk_moments)
+
+    if num_processes is not None:
+        with ProcessPoolExecutor(num_processes, initializer=_open_worker_file, initargs=(in_file,)) as executor:
+            for chunk_moments in executor.map(_worker_chunk_channel_moments, *chunk_args):
+                moments = _combine_moments(moments, chunk_moments)
+
+    count, mean, m2 = moments
+    return mean.astype(np.float32), np.sqrt(m2 / count).astype(np.float32)
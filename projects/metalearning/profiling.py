@@ -0,0 +1,82 @@
+import torch
+import numpy as np
+import time
+from collections import defaultdict
+
+from .tracing import record_span, tracing_enabled
+
+
+PHASE_PERCENTILES = (50, 95)
+
+
+class PhaseTimer:
+    """
+    Times the phases of each batch of an epoch (waiting on the dataloader, copying to the device, forward, backward,
+    optimizer step, and metrics), as laps: each call to `lap` attributes the time since the previous call to a phase.
+    On an accelerator, each lap first waits for the work queued so far, so that asynchronous kernels are attributed to
+    the phase that launched them -- which also means profiling slows the epoch down somewhat, so it is off by default.
+    When tracing is enabled, each lap is also recorded as a span of the main process's timeline.
+    """
+    def __init__(self, synchronize=False):
+        """
+        :param synchronize: Whether or not to synchronize CUDA before each lap; set when training on a GPU
+        """
+        self.synchronize = synchronize
+        self.phase_times = defaultdict(list)
+        self.last_time = None
+        self.last_wall_time = None
+
+    def start(self):
+        """
+        Start timing, before fetching the first batch.
+        """
+        if self.synchronize:
+            torch.cuda.synchronize()
+
+        self.last_time = time.perf_counter()
+        self.last_wall_time = time.time()
+
+    def lap(self, phase):
+        """
+        Attribute the time since the previous lap (or start) to a phase.
+        :param phase: The name of the phase, e.g. 'forward'
+        """
+        if self.synchronize:
+            torch.cuda.synchronize()
+
+        now = time.perf_counter()
+        self.phase_times[phase].append(now - self.last_time)
+        self.last_time = now
+
+        if tracing_enabled():
+            wall_time = time.time()
+            record_span(phase, 'main', self.last_wall_time, wall_time)
+            self.last_wall_time = wall_time
+
+    def summary(self, percentiles=PHASE_PERCENTILES):
+        """
+        :param percentiles: Which percentiles of the per-batch times to report
+        :return: A dict mapping each phase to a dict of its per-batch percentiles (keyed 'p50', 'p95', ...), in
+            milliseconds, and its total time over the epoch ('total'), in seconds
+        """
+        summary = {}
+        for phase, times in self.phase_times.items():
+            times = np.array(times)
+            phase_summary = {f'p{percentile}': float(np.percentile(times, percentile)) * 1000
+                             for percentile in percentiles}
+            phase_summary['total'] = float(times.sum())
+            summary[phase] = phase_summary
+
+        return summary
+
+
+def create_phase_timer(profile, cuda):
+    """
+    :param profile: Whether or not to profile the epoch; always profiled when tracing is enabled
+    :param cuda: Whether or not the epoch runs on CUDA
+    :return: A PhaseTimer, or None if not profiling
+    """
+    if not profile and not tracing_enabled():
+        return None
+
+    return PhaseTimer(cuda and torch.cuda.is_available())
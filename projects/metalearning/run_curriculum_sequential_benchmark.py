@@ -77,6 +77,7 @@ parser.add_argument('--power_curriculum_alpha', type=float, default=DEFAULT_POWE
 # parser.add_argument('--fast_weight_learning_rate', type=float, default=DEFAULT_FAST_WEIGHT_LEARNING_RATE)
 parser.add_argument('--return_indices', action='store_true')
 parser.add_argument('--balanced_batches', action='store_true')
+parser.add_argument('--coreset_sampling', default='rejection', choices=CORESET_SAMPLING_STRATEGIES)
 # parser.add_argument('--maml_meta_test', action='store_true')
 
 parser.add_argument('--debug', action='store_true')
@@ -206,7 +207,8 @@ if __name__ == '__main__':
                                    dataset_class_kwargs=dict(
                                        benchmark_dimension=benchmark_dimension,
                                        random_seed=dataset_random_seed,
-                                       query_order=query_order
+                                       query_order=query_order,
+                                       coreset_sampling=args.coreset_sampling
                                    ),
                                    train_dataset_class=train_dataset_class,
                                    train_dataset_kwargs=train_dataset_kwargs,
@@ -0,0 +1,55 @@
+import sys
+
+sys.path.extend(('/home/cc/deep-learning-projects', '/home/cc/src/tqdm'))
+
+import projects
+from projects.metalearning.data_benchmarks import *
+import argparse
+import json
+
+
+parser = argparse.ArgumentParser()
+subparsers = parser.add_subparsers(dest='benchmark')
+subparsers.required = True
+
+ML_50K = '/home/cc/meta_learning_50k.h5'
+
+block_shuffle_parser = subparsers.add_parser('block_shuffle')
+block_shuffle_parser.add_argument('--path_dataset', default=ML_50K)
+block_shuffle_parser.add_argument('--window_sizes', type=int, nargs='+', default=DEFAULT_BLOCK_SHUFFLE_WINDOW_SIZES)
+block_shuffle_parser.add_argument('--block_size', type=int, default=None)
+
+pipeline_parser = subparsers.add_parser('pipeline')
+pipeline_parser.add_argument('--path_dataset', default=None)
+pipeline_parser.add_argument('--synthetic_num_images', type=int, default=DEFAULT_SYNTHETIC_NUM_IMAGES)
+pipeline_parser.add_argument('--datasets', choices=PIPELINE_DATASETS, nargs='+', default=list(PIPELINE_DATASETS))
+pipeline_parser.add_argument('--num_workers', type=int, nargs='+', default=list(DEFAULT_PIPELINE_NUM_WORKERS))
+pipeline_parser.add_argument('--batch_sizes', type=int, nargs='+', default=list(DEFAULT_PIPELINE_BATCH_SIZES))
+pipeline_parser.add_argument('--pin_memory', type=int, nargs='+', default=[int(pin) for pin in DEFAULT_PIPELINE_PIN_MEMORY])
+pipeline_parser.add_argument('--episodes', type=int, nargs='+', default=list(DEFAULT_PIPELINE_EPISODES))
+pipeline_parser.add_argument('--num_batches', type=int, default=DEFAULT_PIPELINE_NUM_BATCHES)
+pipeline_parser.add_argument('--batched_reads', action='store_true')
+pipeline_parser.add_argument('--worker_start_method', choices=('fork', 'spawn', 'forkserver'), default=None)
+
+for subparser in subparsers.choices.values():
+    subparser.add_argument('--num_samples', type=int, default=DEFAULT_BENCHMARK_NUM_SAMPLES)
+    subparser.add_argument('--batch_size', type=int, default=DEFAULT_BENCHMARK_BATCH_SIZE)
+    subparser.add_argument('--output', default=None)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print(args)
+
+    if args.benchmark == 'block_shuffle':
+        results = benchmark_block_shuffle(args.path_dataset, args.window_sizes, num_samples=args.num_samples,
+                                          batch_size=args.batch_size, block_size=args.block_size)
+
+    if args.benchmark == 'pipeline':
+        results = benchmark_pipeline(args.path_dataset, args.datasets, args.num_workers, args.batch_sizes,
+                                     [bool(pin) for pin in args.pin_memory], args.episodes, args.num_batches,
+                                     args.batched_reads, args.worker_start_method, args.synthetic_num_images)
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
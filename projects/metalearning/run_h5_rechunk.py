@@ -0,0 +1,50 @@
+import sys
+
+sys.path.extend(('/home/cc/deep-learning-projects', '/home/cc/src/tqdm'))
+
+import projects
+from projects.metalearning.storage import rechunk_h5, RECHUNK_COMPRESSIONS
+from projects.metalearning.data_benchmarks import *
+import argparse
+import json
+
+
+parser = argparse.ArgumentParser()
+
+ML_50K = '/home/cc/meta_learning_50k.h5'
+parser.add_argument('--path_dataset', default=ML_50K)
+DEFAULT_OUTPUT_PATH = '/home/cc/meta_learning_50k_rechunked.h5'
+parser.add_argument('--output_path', default=DEFAULT_OUTPUT_PATH)
+parser.add_argument('--skip_rechunk', action='store_true')
+parser.add_argument('--images_per_chunk', type=int, default=1)
+parser.add_argument('--compression', choices=RECHUNK_COMPRESSIONS, default=None)
+parser.add_argument('--compression_level', type=int, default=1)
+parser.add_argument('--chunk_cache_mb', type=float, default=None)
+
+parser.add_argument('--benchmark', action='store_true')
+parser.add_argument('--benchmark_num_samples', type=int, default=DEFAULT_BENCHMARK_NUM_SAMPLES)
+parser.add_argument('--benchmark_batch_size', type=int, default=DEFAULT_BENCHMARK_BATCH_SIZE)
+parser.add_argument('--benchmark_output', default=None)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print(args)
+
+    if not args.skip_rechunk:
+        rechunk_h5(args.path_dataset, args.output_path, args.images_per_chunk, args.compression,
+                   args.compression_level)
+
+    if args.benchmark:
+        chunk_cache_bytes = None
+        if args.chunk_cache_mb is not None:
+            chunk_cache_bytes = int(args.chunk_cache_mb * 2 ** 20)
+
+        results = {}
+        for name, path in (('original', args.path_dataset), ('rechunked', args.output_path)):
+            results[name] = benchmark_h5_layout(path, chunk_cache_bytes, num_samples=args.benchmark_num_samples,
+                                                batch_size=args.benchmark_batch_size)
+
+        if args.benchmark_output is not None:
+            with open(args.benchmark_output, 'w') as output_file:
+                json.dump(results, output_file, indent=2)
@@ -0,0 +1,40 @@
+import sys
+
+sys.path.extend(('/home/cc/deep-learning-projects', '/home/cc/src/tqdm'))
+
+import projects
+from projects.metalearning.storage import convert_h5_to_memmap
+from projects.metalearning.data_benchmarks import *
+import argparse
+import json
+
+
+parser = argparse.ArgumentParser()
+
+ML_50K = '/home/cc/meta_learning_50k.h5'
+parser.add_argument('--path_dataset', default=ML_50K)
+DEFAULT_OUTPUT_DIR = '/home/cc/meta_learning_50k_memmap'
+parser.add_argument('--output_dir', default=DEFAULT_OUTPUT_DIR)
+parser.add_argument('--skip_conversion', action='store_true')
+
+parser.add_argument('--benchmark', action='store_true')
+parser.add_argument('--benchmark_num_samples', type=int, default=DEFAULT_BENCHMARK_NUM_SAMPLES)
+parser.add_argument('--benchmark_batch_size', type=int, default=DEFAULT_BENCHMARK_BATCH_SIZE)
+parser.add_argument('--benchmark_output', default=None)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print(args)
+
+    if not args.skip_conversion:
+        convert_h5_to_memmap(args.path_dataset, args.output_dir)
+
+    if args.benchmark:
+        results = benchmark_memmap_against_hdf5(args.path_dataset, args.output_dir,
+                                                num_samples=args.benchmark_num_samples,
+                                                batch_size=args.benchmark_batch_size)
+
+        if args.benchmark_output is not None:
+            with open(args.benchmark_output, 'w') as output_file:
+                json.dump(results, output_file, indent=2)
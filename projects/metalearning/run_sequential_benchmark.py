@@ -6,6 +6,7 @@ sys.path.extend(('/home/cc/deep-learning-projects', '/home/cc/src/tqdm'))
 import projects
 from projects.metalearning import *
 import argparse
+import functools
 
 
 parser = argparse.ArgumentParser()
@@ -68,8 +69,24 @@ parser.add_argument('--fast_weight_learning_rate', type=float, default=DEFAULT_F
 parser.add_argument('--return_indices', action='store_true')
 
 parser.add_argument('--balanced_batches', action='store_true')
+parser.add_argument('--coreset_sampling', default='rejection', choices=CORESET_SAMPLING_STRATEGIES)
 parser.add_argument('--maml_meta_test', action='store_true')
 
+parser.add_argument('--use_shared_memory', action='store_true')
+parser.add_argument('--batched_reads', action='store_true')
+parser.add_argument('--persistent_workers', action='store_true')
+parser.add_argument('--batched_transforms', action='store_true')
+# e.g. 'cuda'; with --cache_test_set, the cached test set is also kept on this device
+parser.add_argument('--batch_transform_device', default=None)
+parser.add_argument('--cache_test_set', action='store_true')
+parser.add_argument('--coreset_cache_size', type=int, default=0)
+parser.add_argument('--compressed_cache_mb', type=float, default=None)
+parser.add_argument('--compressed_cache_level', type=int, default=1)
+parser.add_argument('--background_planning', action='store_true')
+parser.add_argument('--streaming_metrics', action='store_true')
+parser.add_argument('--profile', action='store_true')
+parser.add_argument('--trace_dir', default=None)
+
 parser.add_argument('--debug', action='store_true')
 
 
@@ -81,6 +98,10 @@ if __name__ == '__main__':
     num_workers = args.num_workers
     pin_memory = bool(args.pin_memory)
 
+    if args.trace_dir is not None:
+        # Before any DataLoader workers start, so that they trace as well
+        enable_tracing(args.trace_dir)
+
     if num_workers > 1:
         try:
             torch.multiprocessing.set_start_method("spawn")
@@ -140,6 +161,7 @@ if __name__ == '__main__':
     train_dataset_kwargs = dict(
         previous_query_coreset_size=train_coreset_size,
         coreset_size_per_query=train_coreset_size_per_query,
+        coreset_cache_size=args.coreset_cache_size,
     )
 
     test_dataset_class = None
@@ -181,7 +203,13 @@ if __name__ == '__main__':
                                    dataset_class_kwargs=dict(
                                        benchmark_dimension=benchmark_dimension,
                                        random_seed=dataset_random_seed,
-                                       query_order=query_order
+                                       query_order=query_order,
+                                       coreset_sampling=args.coreset_sampling,
+                                       background_planning=args.background_planning,
+                                       use_shared_memory=args.use_shared_memory,
+                                       compressed_cache_bytes=None if args.compressed_cache_mb is None else
+                                       int(args.compressed_cache_mb * 2 ** 20),
+                                       compressed_cache_level=args.compressed_cache_level,
                                    ),
                                    train_dataset_class=train_dataset_class,
                                    train_dataset_kwargs=train_dataset_kwargs,
@@ -190,7 +218,13 @@ if __name__ == '__main__':
                                    train_shuffle=train_shuffle,
                                    test_shuffle=test_shuffle,
                                    train_batch_size=train_batch_size,
-                                   test_batch_size=test_batch_size)
+                                   test_batch_size=test_batch_size,
+                                   batched_reads=args.batched_reads,
+                                   persistent_workers=args.persistent_workers,
+                                   batched_transforms=args.batched_transforms,
+                                   batch_transform_device=None if args.batch_transform_device is None else
+                                   torch.device(args.batch_transform_device),
+                                   cache_test_set=args.cache_test_set)
 
     learning_rate = args.learning_rate
     weight_decay = args.weight_decay
@@ -260,12 +294,20 @@ if __name__ == '__main__':
     train_epoch_func = train_epoch
     test_epoch_func = test
 
+    if args.streaming_metrics:
+        train_epoch_func = functools.partial(train_epoch, streaming_metrics=True)
+        test_epoch_func = functools.partial(test, streaming_metrics=True)
+
     if args.maml:
         train_epoch_func = maml_train_epoch
 
         if args.maml_meta_test:
             test_epoch_func = maml_test_epoch
 
+    if args.profile:
+        train_epoch_func = functools.partial(train_epoch_func, profile=True)
+        test_epoch_func = functools.partial(test_epoch_func, profile=True)
+
     if args.debug: print('Calling sequential benchmark')
 
     sequential_benchmark(model, train_dataloader, test_dataloader, accuracy_threshold,
@@ -0,0 +1,52 @@
+import sys
+
+sys.path.extend(('/home/cc/deep-learning-projects', '/home/cc/src/tqdm'))
+
+import projects
+from projects.metalearning.storage import RECHUNK_COMPRESSIONS
+from projects.metalearning.synthetic import *
+from projects.metalearning.data_benchmarks import *
+import argparse
+import json
+
+
+parser = argparse.ArgumentParser()
+
+DEFAULT_OUTPUT_PATH = '/home/cc/meta_learning_synthetic.h5'
+parser.add_argument('--output_path', default=DEFAULT_OUTPUT_PATH)
+parser.add_argument('--num_images', type=int, default=50000)
+parser.add_argument('--image_height', type=int, default=SYNTHETIC_IMAGE_SHAPE[0])
+parser.add_argument('--image_width', type=int, default=SYNTHETIC_IMAGE_SHAPE[1])
+parser.add_argument('--features_per_dimension', type=int, nargs='+', default=list(SYNTHETIC_FEATURES_PER_DIMENSION))
+parser.add_argument('--positive_rates', type=float, nargs='+', default=[SYNTHETIC_POSITIVE_RATE])
+parser.add_argument('--images_per_chunk', type=int, default=1)
+parser.add_argument('--compression', choices=RECHUNK_COMPRESSIONS, default=None)
+parser.add_argument('--compression_level', type=int, default=1)
+parser.add_argument('--noise_level', type=int, default=SYNTHETIC_NOISE_LEVEL)
+parser.add_argument('--random_seed', type=int, default=33)
+
+parser.add_argument('--benchmark', action='store_true')
+parser.add_argument('--benchmark_num_samples', type=int, default=DEFAULT_BENCHMARK_NUM_SAMPLES)
+parser.add_argument('--benchmark_batch_size', type=int, default=DEFAULT_BENCHMARK_BATCH_SIZE)
+parser.add_argument('--benchmark_output', default=None)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print(args)
+
+    positive_rates = args.positive_rates[0] if len(args.positive_rates) == 1 else args.positive_rates
+    query_positive_rates = create_synthetic_dataset(
+        args.output_path, args.num_images, image_shape=(args.image_height, args.image_width, 3),
+        features_per_dimension=tuple(args.features_per_dimension), positive_rates=positive_rates,
+        images_per_chunk=args.images_per_chunk, compression=args.compression,
+        compression_level=args.compression_level, noise_level=args.noise_level, random_seed=args.random_seed)
+    print(f'Per-query positive rates: {[round(rate, 3) for rate in query_positive_rates]}')
+
+    if args.benchmark:
+        results = benchmark_h5_layout(args.output_path, num_samples=args.benchmark_num_samples,
+                                      batch_size=args.benchmark_batch_size)
+
+        if args.benchmark_output is not None:
+            with open(args.benchmark_output, 'w') as output_file:
+                json.dump(results, output_file, indent=2)
@@ -0,0 +1,119 @@
+import torch
+from torch.utils.data import Sampler
+import numpy as np
+
+
+class BatchIndexSampler(Sampler):
+    """
+    A sampler yielding entire batches of indices at once. Meant to be used as the `sampler` of a DataLoader created
+    with `batch_size=None`, in which case the DataLoader passes each array of indices directly to the dataset, and
+    datasets implementing `get_batch` (all of the meta-learning datasets) read and return the whole batch at once.
+    """
+    def __init__(self, data_source, batch_size, shuffle=True, drop_last=False):
+        """
+        :param data_source: The dataset to sample from; its length is queried anew every epoch, as the length of the
+            sequential benchmark datasets changes between epochs
+        :param batch_size: How many indices to place in each batch
+        :param shuffle: Whether or not to shuffle the indices before splitting them into batches. Without shuffling,
+            batches preserve the dataset order, as the balanced batches datasets require.
+        :param drop_last: Whether or not to drop the last batch, if it is smaller than batch_size
+        """
+        self.data_source = data_source
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        num_indices = len(self.data_source)
+
+        if self.shuffle:
+            order = torch.randperm(num_indices).numpy()
+        else:
+            order = np.arange(num_indices)
+
+        for start in range(0, num_indices, self.batch_size):
+            batch = order[start:start + self.batch_size]
+            if self.drop_last and len(batch) < self.batch_size:
+                return
+
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.data_source) // self.batch_size
+
+        return (len(self.data_source) + self.batch_size - 1) // self.batch_size
+
+
+DEFAULT_BLOCK_SHUFFLE_BLOCK_SIZE = 64
+DEFAULT_BLOCK_SHUFFLE_WINDOW_SIZE = 8192
+
+
+class BlockShuffleSampler(Sampler):
+    """
+    A sampler that shuffles at the level of storage blocks (the HDF5 chunks of the images, by default), rather than of
+    individual examples. Every epoch, the blocks are visited in a random order, with all examples whose images fall in
+    a block visited together; the resulting order is then shuffled within consecutive windows of window_size examples.
+    Every batch therefore reads from a few blocks, each in its entirety, while examples still arrive in a random order
+    across the epoch, and the window bounds how far apart in the file the examples mixed together lie.
+    """
+    def __init__(self, data_source, window_size=DEFAULT_BLOCK_SHUFFLE_WINDOW_SIZE, block_size=None, batch_size=None,
+                 drop_last=False):
+        """
+        :param data_source: The dataset to sample from; must implement `sampling_image_indices`, returning the image
+            read by each of its indices in the current epoch
+        :param window_size: How many examples to shuffle together after ordering them by block
+        :param block_size: How many consecutive images make up a block; defaults to the dataset's
+            `storage_block_size` (the chunk size of its images), or DEFAULT_BLOCK_SHUFFLE_BLOCK_SIZE if not chunked
+        :param batch_size: If None, yield one index at a time; otherwise, yield arrays of this many indices, as
+            BatchIndexSampler does, for use with `batch_size=None` in the DataLoader
+        :param drop_last: When yielding batches, whether or not to drop the last one if it is smaller than batch_size
+        """
+        self.data_source = data_source
+        self.window_size = window_size
+        self.block_size = block_size
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+
+        if self.block_size is None:
+            self.block_size = getattr(data_source, 'storage_block_size', None) or DEFAULT_BLOCK_SHUFFLE_BLOCK_SIZE
+
+    def epoch_order(self):
+        """
+        :return: The order to visit the dataset's indices in this epoch
+        """
+        image_indices = np.asarray(self.data_source.sampling_image_indices())
+        blocks = image_indices // self.block_size
+
+        # Random block ranks, and a random order of the examples within each block
+        block_ranks = torch.randperm(int(blocks.max()) + 1).numpy() if len(blocks) > 0 else blocks
+        order = np.lexsort((torch.randperm(len(blocks)).numpy(), block_ranks[blocks]))
+
+        for start in range(0, len(order), self.window_size):
+            window = order[start:start + self.window_size]
+            order[start:start + self.window_size] = window[torch.randperm(len(window)).numpy()]
+
+        return order
+
+    def __iter__(self):
+        order = self.epoch_order()
+
+        if self.batch_size is None:
+            yield from order.tolist()
+            return
+
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            if self.drop_last and len(batch) < self.batch_size:
+                return
+
+            yield batch
+
+    def __len__(self):
+        if self.batch_size is None:
+            return len(self.data_source)
+
+        if self.drop_last:
+            return len(self.data_source) // self.batch_size
+
+        return (len(self.data_source) + self.batch_size - 1) // self.batch_size
@@ -0,0 +1,412 @@
+import numpy as np
+import h5py
+import json
+import glob
+import fcntl
+import tempfile
+import os
+from contextlib import contextmanager
+
+
+MEMMAP_HEADER_FILE = 'header.json'
+MEMMAP_DATASETS = ('X', 'Q', 'y', 'D')
+CONVERSION_CHUNK_SIZE = 1024
+RECHUNK_COMPRESSIONS = ('lzf', 'gzip')
+SHARD_INDEX_SUFFIX = '.shards.json'
+SHARD_PATTERN_CHARACTERS = '*?['
+LOCK_SUFFIX = '.lock'
+
+
+def rechunk_h5(in_file, out_file, images_per_chunk=1, compression=None, compression_level=1,
+               copy_chunk_size=CONVERSION_CHUNK_SIZE):
+    """
+    Rewrite a meta-learning HDF5 file with a chunk layout matching how we read it: every dataset in the file is chunked
+    by blocks of images_per_chunk images (rows), and optionally compressed with a fast compressor.
+    :param in_file: The HDF5 file to rewrite
+    :param out_file: The HDF5 file to write
+    :param images_per_chunk: How many images (rows) to store in each chunk; 1 suits per-image reads, larger values
+        suit batched or block-shuffled reads
+    :param compression: None, 'lzf', or 'gzip'
+    :param compression_level: The gzip compression level; ignored by the other compressors. default 1, the fastest
+    :param copy_chunk_size: Roughly how many rows to copy at a time, bounding the memory used
+    :return: A dict describing the new layout of each dataset
+    """
+    if compression is not None and compression not in RECHUNK_COMPRESSIONS:
+        raise ValueError(f'Compression must be None or one of {RECHUNK_COMPRESSIONS}, not {compression}')
+
+    compression_opts = compression_level if compression == 'gzip' else None
+    # Copy whole chunks at a time, so each chunk of the output is written once
+    copy_chunk_size = max(images_per_chunk, copy_chunk_size - copy_chunk_size % images_per_chunk)
+    layout = {}
+
+    with h5py.File(in_file, 'r') as source, h5py.File(out_file, 'w') as target:
+        target.attrs.update(source.attrs)
+
+        for name, data in source.items():
+            chunks = (min(images_per_chunk, data.shape[0]),) + data.shape[1:]
+            out = target.create_dataset(name, shape=data.shape, dtype=data.dtype, chunks=chunks,
+                                        compression=compression, compression_opts=compression_opts)
+            out.attrs.update(data.attrs)
+
+            for start in range(0, data.shape[0], copy_chunk_size):
+                end = min(start + copy_chunk_size, data.shape[0])
+                out[start:end] = data[start:end]
+
+            layout[name] = dict(shape=list(data.shape), chunks=list(chunks), compression=compression)
+            print(f'Rewrote {name} with shape {data.shape}, chunks {chunks}, and compression {compression}')
+
+    return layout
+
+
+def convert_h5_to_memmap(in_file, out_dir, datasets=MEMMAP_DATASETS, chunk_size=CONVERSION_CHUNK_SIZE):
+    """
+    Convert a meta-learning HDF5 file to a directory of flat, uncompressed .npy files (one per dataset in the file),
+    which MemmapFile (and therefore MemmapMetaLearningDataset) memory-maps. This is a one-off conversion: the reads
+    then go through the OS page cache, rather than through h5py.
+    :param in_file: The HDF5 file to convert
+    :param out_dir: The directory to write the arrays and the JSON header to; created if it does not exist
+    :param datasets: Which datasets in the file to convert; defaults to X, Q, y, and D
+    :param chunk_size: How many rows to copy at a time, bounding the memory used by the conversion
+    :return: The header written, describing the shape and dtype of each array
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    header = dict(source=os.path.abspath(in_file), datasets={})
+
+    with h5py.File(in_file, 'r') as file:
+        for name in datasets:
+            data = file[name]
+            array_file = f'{name}.npy'
+            out = np.lib.format.open_memmap(os.path.join(out_dir, array_file), mode='w+',
+                                            dtype=data.dtype, shape=data.shape)
+
+            for start in range(0, data.shape[0], chunk_size):
+                end = min(start + chunk_size, data.shape[0])
+                out[start:end] = data[start:end]
+
+            out.flush()
+            del out
+
+            header['datasets'][name] = dict(file=array_file, shape=list(data.shape), dtype=data.dtype.str)
+            print(f'Converted {name} with shape {data.shape} and dtype {data.dtype}')
+
+    # Written last, so that a directory with a header is always a complete conversion
+    with open(os.path.join(out_dir, MEMMAP_HEADER_FILE), 'w') as header_file:
+        json.dump(header, header_file, indent=2)
+
+    return header
+
+
+def is_memmap_dir(path):
+    return isinstance(path, str) and os.path.isfile(os.path.join(path, MEMMAP_HEADER_FILE))
+
+
+class MemmapFile:
+    """
+    A read-only stand-in for an h5py.File, over a directory written by `convert_h5_to_memmap`. Indexing by name returns
+    a read-only memory-mapped array, which supports the same indexing the datasets use on h5py datasets.
+    """
+    def __init__(self, directory):
+        with open(os.path.join(directory, MEMMAP_HEADER_FILE)) as header_file:
+            self.header = json.load(header_file)
+
+        self.directory = directory
+        self._arrays = {name: np.load(os.path.join(directory, info['file']), mmap_mode='r')
+                        for name, info in self.header['datasets'].items()}
+
+    def __getitem__(self, name):
+        return self._arrays[name]
+
+    def __contains__(self, name):
+        return name in self._arrays
+
+    def keys(self):
+        return self._arrays.keys()
+
+    def close(self):
+        self._arrays = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive lock on a path (through a sidecar lock file), across processes, for the duration of the context.
+    """
+    with open(path + LOCK_SUFFIX, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _indexed_shards(index_path):
+    if not os.path.isfile(index_path):
+        return None
+
+    with open(index_path) as index_file:
+        return [shard['file'] for shard in json.load(index_file)['shards']]
+
+
+def create_shard_index(shards, index_path=None):
+    """
+    Describe a dataset split across several HDF5 shards (each a complete meta-learning file, with its own X, Q, y, and
+    D) in a shard index, which ShardedH5File (and therefore any of the datasets) reads as a single file, with the images
+    of each shard following those of the previous ones. Shards can be generated in parallel and indexed afterwards.
+    An existing index of the same shards is reused; otherwise, the index is written once, under a lock, and moved into
+    place atomically, as many runs may index the same shards at once.
+    :param shards: A list of shard paths, in order, or a glob pattern matching them (sorted by name)
+    :param index_path: Where to write the index; defaults to a file ending with SHARD_INDEX_SUFFIX, named after the
+        common prefix of the shards, in the directory of the first shard
+    :return: The path of the index
+    """
+    if not isinstance(shards, (list, tuple)):
+        pattern = os.fspath(shards)
+        shards = sorted(glob.glob(pattern))
+        if len(shards) == 0:
+            raise ValueError(f'No shards match {pattern}')
+
+    shards = [os.path.abspath(os.fspath(shard)) for shard in shards]
+    if len(shards) == 0:
+        raise ValueError('A sharded dataset requires at least one shard')
+
+    if index_path is None:
+        prefix = os.path.commonprefix([os.path.basename(shard) for shard in shards]).rstrip('_-.') or 'dataset'
+        index_path = os.path.join(os.path.dirname(shards[0]), prefix + SHARD_INDEX_SUFFIX)
+
+    index_path = os.fspath(index_path)
+    index_directory = os.path.dirname(os.path.abspath(index_path))
+    shard_files = [os.path.relpath(shard, index_directory) for shard in shards]
+    if _indexed_shards(index_path) == shard_files:
+        return index_path
+
+    with file_lock(index_path):
+        # Another run may have written it while we waited for the lock
+        if _indexed_shards(index_path) == shard_files:
+            return index_path
+
+        index = dict(shards=[])
+        for shard, shard_file in zip(shards, shard_files):
+            with h5py.File(shard, 'r') as file:
+                index['shards'].append(dict(file=shard_file, num_images=file['X'].shape[0]))
+
+        descriptor, temp_path = tempfile.mkstemp(dir=index_directory, prefix=os.path.basename(index_path) + '.')
+        with os.fdopen(descriptor, 'w') as index_file:
+            json.dump(index, index_file, indent=2)
+
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, index_path)
+
+    return index_path
+
+
+def is_shard_index(path):
+    return isinstance(path, str) and path.endswith(SHARD_INDEX_SUFFIX) and os.path.isfile(path)
+
+
+def is_shard_pattern(path):
+    """
+    Whether a dataset path is a list of shards, or a glob pattern matching them (rather than an existing path).
+    """
+    if isinstance(path, (list, tuple)):
+        return True
+
+    return isinstance(path, str) and not os.path.exists(path) and any(
+        character in path for character in SHARD_PATTERN_CHARACTERS)
+
+
+def resolve_dataset_path(path):
+    """
+    Resolve the path a dataset is read from: path-likes are converted to strings, and a list of shards, or a glob
+    pattern matching them, is indexed (see `create_shard_index`), replaced by the path of the index.
+    """
+    if not isinstance(path, (list, tuple)):
+        path = os.fspath(path)
+
+    if is_shard_pattern(path):
+        return create_shard_index(path)
+
+    return path
+
+
+class ShardedArray:
+    """
+    One of the datasets (X, Q, y, or D) of a ShardedH5File, indexed across all shards by global image index. Supports
+    the indexing the meta-learning datasets use: a single image, a slice of images, or an array of image indices,
+    optionally followed by indices into the remaining dimensions.
+    """
+    def __init__(self, sharded_file, name):
+        self.sharded_file = sharded_file
+        self.name = name
+
+        first_shard = sharded_file._shard(0)[name]
+        self.shape = (int(sharded_file.offsets[-1]),) + tuple(first_shard.shape[1:])
+        self.dtype = first_shard.dtype
+        self.chunks = first_shard.chunks
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _locate(self, rows):
+        shard_indices = np.searchsorted(self.sharded_file.offsets, rows, side='right') - 1
+        return shard_indices, rows - self.sharded_file.offsets[shard_indices]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        rows, rest = key[0], key[1:]
+
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(self.shape[0])
+            if step != 1:
+                rows = np.arange(start, stop, step)
+
+            else:
+                return self._read_slice(start, stop, rest)
+
+        if isinstance(rows, (list, np.ndarray)):
+            return self._read_array(np.asarray(rows, dtype=np.int64), rest)
+
+        row = int(rows)
+        if row < 0:
+            row += self.shape[0]
+
+        shard_index, local_row = self._locate(row)
+        return self.sharded_file._shard(int(shard_index))[self.name][(int(local_row),) + rest]
+
+    def _read_slice(self, start, stop, rest):
+        offsets = self.sharded_file.offsets
+        parts = []
+        for shard_index in range(len(offsets) - 1):
+            shard_start, shard_stop = max(start, offsets[shard_index]), min(stop, offsets[shard_index + 1])
+            if shard_start < shard_stop:
+                data = self.sharded_file._shard(shard_index)[self.name]
+                parts.append(data[(slice(shard_start - offsets[shard_index], shard_stop - offsets[shard_index]),) + rest])
+
+        if len(parts) == 0:
+            return np.empty((0,) + self.shape[1:], dtype=self.dtype)[(slice(None),) + rest]
+
+        return np.concatenate(parts)
+
+    def _read_array(self, rows, rest):
+        rows = np.where(rows < 0, rows + self.shape[0], rows)
+        shard_indices, local_rows = self._locate(rows)
+
+        parts = []
+        positions = []
+        for shard_index in np.unique(shard_indices):
+            shard_positions = np.flatnonzero(shard_indices == shard_index)
+            # h5py requires increasing, unique indices
+            unique_rows, inverse = np.unique(local_rows[shard_positions], return_inverse=True)
+            data = self.sharded_file._shard(int(shard_index))[self.name]
+            parts.append(np.asarray(data[(unique_rows,) + rest])[inverse])
+            positions.append(shard_positions)
+
+        if len(parts) == 0:
+            return np.empty((0,) + self.shape[1:], dtype=self.dtype)[(slice(None),) + rest]
+
+        ordered = np.concatenate(parts)
+        result = np.empty_like(ordered)
+        result[np.concatenate(positions)] = ordered
+        return result
+
+
+class ShardedH5File:
+    """
+    A read-only stand-in for an h5py.File, over a dataset split across several HDF5 shards, described by a shard index
+    (see `create_shard_index`). Each shard is opened lazily, the first time it is read, so every process (such as each
+    DataLoader worker) only holds handles to the shards it actually reads.
+    """
+    def __init__(self, index_path, chunk_cache_bytes=None):
+        with open(index_path) as index_file:
+            self.index = json.load(index_file)
+
+        index_directory = os.path.dirname(os.path.abspath(index_path))
+        self.index_path = index_path
+        self.shard_paths = [os.path.join(index_directory, shard['file']) for shard in self.index['shards']]
+        self.offsets = np.concatenate(([0], np.cumsum([shard['num_images'] for shard in self.index['shards']])))
+        self.chunk_cache_bytes = chunk_cache_bytes
+        self._handles = [None] * len(self.shard_paths)
+        self._arrays = {}
+
+    def _shard(self, shard_index):
+        if self._handles[shard_index] is None:
+            if self.chunk_cache_bytes is not None:
+                self._handles[shard_index] = h5py.File(self.shard_paths[shard_index], 'r',
+                                                       rdcc_nbytes=self.chunk_cache_bytes)
+            else:
+                self._handles[shard_index] = h5py.File(self.shard_paths[shard_index], 'r')
+
+        return self._handles[shard_index]
+
+    def __getitem__(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = ShardedArray(self, name)
+
+        return self._arrays[name]
+
+    def __contains__(self, name):
+        return name in self._shard(0)
+
+    def keys(self):
+        return self._shard(0).keys()
+
+    def close(self):
+        for handle in self._handles:
+            if handle is not None:
+                handle.close()
+
+        self._handles = [None] * len(self.shard_paths)
+        self._arrays = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def dataset_files(path):
+    """
+    List the files a dataset is stored in: the HDF5 file itself, the files of a memory-mapped dataset directory, or a
+    shard index followed by its shards.
+    """
+    if os.path.isdir(path):
+        return [os.path.join(path, name) for name in sorted(os.listdir(path))
+                if os.path.isfile(os.path.join(path, name))]
+
+    if is_shard_index(path):
+        with open(path) as index_file:
+            index = json.load(index_file)
+
+        index_directory = os.path.dirname(os.path.abspath(path))
+        return [path] + [os.path.join(index_directory, shard['file']) for shard in index['shards']]
+
+    return [path]
+
+
+def open_dataset_file(path, chunk_cache_bytes=None):
+    """
+    Open a dataset for reading, whether it is an HDF5 file, a directory written by `convert_h5_to_memmap`, or a shard
+    index written by `create_shard_index`.
+    :param path: The path to the dataset
+    :param chunk_cache_bytes: If not None, the size of the HDF5 chunk cache of each dataset opened
+    :return: An h5py.File, MemmapFile, or ShardedH5File, any of which can be used as a context manager
+    """
+    if is_memmap_dir(path):
+        return MemmapFile(path)
+
+    if is_shard_index(path):
+        return ShardedH5File(path, chunk_cache_bytes)
+
+    if chunk_cache_bytes is not None:
+        return h5py.File(path, 'r', rdcc_nbytes=chunk_cache_bytes)
+
+    return h5py.File(path, 'r')
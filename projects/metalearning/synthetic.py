@@ -0,0 +1,173 @@
+import numpy as np
+import h5py
+import json
+
+from .storage import RECHUNK_COMPRESSIONS
+
+
+SYNTHETIC_IMAGE_SHAPE = (120, 160, 3)
+SYNTHETIC_FEATURES_PER_DIMENSION = (10, 10, 10)
+SYNTHETIC_POSITIVE_RATE = 0.3
+SYNTHETIC_NOISE_LEVEL = 8
+SYNTHETIC_BACKGROUND = 110
+GENERATION_CHUNK_SIZE = 256
+DESCRIPTION_PADDING = -1
+
+
+def _feature_offsets(features_per_dimension):
+    return np.cumsum((0,) + tuple(features_per_dimension))
+
+
+def synthetic_descriptions(num_images, positive_rates, features_per_dimension=SYNTHETIC_FEATURES_PER_DIMENSION,
+                           random_state=None):
+    """
+    Sample image descriptions in which each feature appears in each image independently, with its own probability, so
+    that the fraction of positive examples of every single-feature query is (in expectation) exactly its rate. In each
+    dimension, the features present are assigned to distinct objects, so an image has as many objects as its largest
+    set of features in a dimension; objects with no feature in a dimension are padded with -1, which the datasets
+    ignore, as they do the padding of the real descriptions.
+    :param num_images: How many images to describe
+    :param positive_rates: The probability of each feature (and so of a positive answer to its query), as a float for
+        every feature, or one per feature
+    :param features_per_dimension: How many features exist in each dimension
+    :param random_state: The np.random.RandomState to sample with
+    :return: The descriptions, as a [num_images x max(features_per_dimension) x num_dimensions] int16 array of feature
+        ids (numbered consecutively across dimensions, as the datasets expect)
+    """
+    if random_state is None:
+        random_state = np.random.RandomState()
+
+    offsets = _feature_offsets(features_per_dimension)
+    present = random_state.random_sample((num_images, offsets[-1])) < positive_rates
+    descriptions = np.full((num_images, max(features_per_dimension), len(features_per_dimension)),
+                           DESCRIPTION_PADDING, dtype=np.int16)
+
+    for dimension in range(len(features_per_dimension)):
+        dimension_present = present[:, offsets[dimension]:offsets[dimension + 1]]
+        # Sorting by a random key places the present features first, in a random order, so objects vary across images
+        order = np.argsort(np.where(dimension_present, random_state.random_sample(dimension_present.shape), 2), axis=1)
+        features = np.where(np.take_along_axis(dimension_present, order, axis=1), order + offsets[dimension],
+                            DESCRIPTION_PADDING)
+        descriptions[:, :features.shape[1], dimension] = features
+
+    return descriptions
+
+
+def render_synthetic_images(descriptions, image_shape=SYNTHETIC_IMAGE_SHAPE,
+                            features_per_dimension=SYNTHETIC_FEATURES_PER_DIMENSION, noise_level=SYNTHETIC_NOISE_LEVEL,
+                            random_state=None):
+    """
+    Draw a flat-colored rectangle for each object over a noisy background: its color follows its feature in the first
+    dimension, its size its feature in the second, and its shade its feature in the third. The images carry no
+    meaningful signal beyond that; they only need to read, decode, and compress roughly like the real ones.
+    :param descriptions: The descriptions of the images, as returned by synthetic_descriptions
+    :param image_shape: The (height, width, channels) of the images
+    :param features_per_dimension: How many features exist in each dimension
+    :param noise_level: The amplitude of the uniform noise added to every pixel; 0 makes the images compress very well,
+        larger values less so
+    :param random_state: The np.random.RandomState to sample with
+    :return: The images, as a [N, height, width, channels] uint8 array
+    """
+    if random_state is None:
+        random_state = np.random.RandomState()
+
+    height, width, channels = image_shape
+    offsets = _feature_offsets(features_per_dimension)
+    # The same palette for every file, regardless of the seed
+    palette = np.random.RandomState(0).randint(30, 256, size=(features_per_dimension[0], channels))
+
+    images = random_state.randint(-noise_level, noise_level + 1, size=(len(descriptions),) + tuple(image_shape),
+                                  dtype=np.int16)
+    images += SYNTHETIC_BACKGROUND
+
+    for image, description in zip(images, descriptions):
+        for obj in description:
+            if np.all(obj == DESCRIPTION_PADDING):
+                continue
+
+            # Each feature's position within its dimension, from 0 to 1, for (up to) the first three dimensions
+            styles = [0.0, 0.0, 0.0]
+            for dimension, feature in enumerate(obj[:3]):
+                if feature != DESCRIPTION_PADDING:
+                    styles[dimension] = (feature - offsets[dimension]) / max(1, features_per_dimension[dimension] - 1)
+
+            color = palette[int(round(styles[0] * (len(palette) - 1)))]
+            size = int(min(height, width) * (0.1 + 0.15 * styles[1]))
+            top = random_state.randint(0, height - size + 1)
+            left = random_state.randint(0, width - size + 1)
+            image[top:top + size, left:left + size] = (color * (1 - 0.4 * styles[2])).astype(np.int16)
+
+    return np.clip(images, 0, 255).astype(np.uint8)
+
+
+def create_synthetic_dataset(out_file, num_images, image_shape=SYNTHETIC_IMAGE_SHAPE,
+                             features_per_dimension=SYNTHETIC_FEATURES_PER_DIMENSION,
+                             positive_rates=SYNTHETIC_POSITIVE_RATE, images_per_chunk=1, compression=None,
+                             compression_level=1, noise_level=SYNTHETIC_NOISE_LEVEL, random_seed=33,
+                             chunk_size=GENERATION_CHUNK_SIZE):
+    """
+    Write a synthetic meta-learning HDF5 file, with the same datasets as the real one, so that every dataset class (and
+    create_normalized_datasets) loads it unchanged, and benchmarks can run without the real data: X (uint8 images),
+    Q (a one-hot query vector for each single-feature query, per image), y (the answer to each of those queries,
+    per image), and D (the descriptions, see synthetic_descriptions). The same arguments always write the same file.
+    :param out_file: The HDF5 file to write
+    :param num_images: How many images to generate
+    :param image_shape: The (height, width, channels) of the images; the real ones are 120 x 160 x 3
+    :param features_per_dimension: How many features exist in each dimension; default 10 each, as in the real data
+    :param positive_rates: The fraction of images with each feature, which is the fraction of positive answers to its
+        query: a float for every feature, or one per feature. default 0.3
+    :param images_per_chunk: How many images (rows) to store in each HDF5 chunk, in every dataset; default 1
+    :param compression: None, 'lzf', or 'gzip'
+    :param compression_level: The gzip compression level; ignored by the other compressors. default 1, the fastest
+    :param noise_level: The amplitude of the per-pixel noise in the images, which controls how well they compress
+    :param random_seed: The seed to generate the file from
+    :param chunk_size: How many images to generate at a time, bounding the memory used
+    :return: The per-query positive rates of the file written, as a list
+    """
+    if compression is not None and compression not in RECHUNK_COMPRESSIONS:
+        raise ValueError(f'Compression must be None or one of {RECHUNK_COMPRESSIONS}, not {compression}')
+
+    num_features = int(np.sum(features_per_dimension))
+    positive_rates = np.asarray(positive_rates, dtype=np.float64)
+    if positive_rates.ndim == 0:
+        positive_rates = np.full(num_features, positive_rates)
+
+    if positive_rates.shape != (num_features,):
+        raise ValueError(f'Expected a positive rate for each of the {num_features} features, not {len(positive_rates)}')
+
+    if np.any(positive_rates < 0) or np.any(positive_rates > 1):
+        raise ValueError(f'Positive rates must be between 0 and 1, not {positive_rates}')
+
+    random_state = np.random.RandomState(random_seed)
+    compression_opts = compression_level if compression == 'gzip' else None
+    shapes = dict(X=(num_images,) + tuple(image_shape), Q=(num_images, num_features, num_features),
+                  y=(num_images, num_features),
+                  D=(num_images, max(features_per_dimension), len(features_per_dimension)))
+    dtypes = dict(X=np.uint8, Q=np.uint8, y=np.uint8, D=np.int16)
+    queries = np.eye(num_features, dtype=np.uint8)
+    positives = np.zeros(num_features, dtype=np.int64)
+
+    with h5py.File(out_file, 'w') as target:
+        target.attrs['synthetic'] = json.dumps(dict(
+            image_shape=list(image_shape), features_per_dimension=list(features_per_dimension),
+            positive_rates=positive_rates.tolist(), noise_level=noise_level, random_seed=random_seed))
+
+        datasets = {name: target.create_dataset(name, shape=shape, dtype=dtypes[name],
+                                                chunks=(min(images_per_chunk, max(1, num_images)),) + shape[1:],
+                                                compression=compression, compression_opts=compression_opts)
+                    for name, shape in shapes.items()}
+
+        for start in range(0, num_images, chunk_size):
+            end = min(start + chunk_size, num_images)
+            descriptions = synthetic_descriptions(end - start, positive_rates, features_per_dimension, random_state)
+            answers = np.any(descriptions.reshape(end - start, -1, 1) == np.arange(num_features), axis=1)
+
+            datasets['D'][start:end] = descriptions
+            datasets['y'][start:end] = answers
+            datasets['Q'][start:end] = np.broadcast_to(queries, (end - start,) + queries.shape)
+            datasets['X'][start:end] = render_synthetic_images(descriptions, image_shape, features_per_dimension,
+                                                               noise_level, random_state)
+            positives += answers.sum(0)
+
+    print(f'Wrote {num_images} synthetic images of shape {tuple(image_shape)} to {out_file}, with chunks of {images_per_chunk} images and compression {compression}')
+    return (positives / max(1, num_images)).tolist()
@@ -0,0 +1,209 @@
+import numpy as np
+import functools
+import glob
+import json
+import time
+import os
+from contextlib import contextmanager
+
+import torch.utils.data
+
+
+TRACE_DIR_ENV = 'METALEARNING_TRACE_DIR'
+PROCESS_TRACE_PATTERN = 'process-{pid}.jsonl'
+EPOCH_TRACE_FILE = 'trace-epoch-{epoch:04d}.json'
+EPOCH_READ_LATENCY_FILE = 'read-latency-epoch-{epoch:04d}.json'
+READ_CATEGORY = 'read'
+READ_LATENCY_PERCENTILES = (50, 95, 99)
+
+# Read from the environment, so that DataLoader workers (spawned or forked) trace whenever the main process does
+_trace_dir = os.environ.get(TRACE_DIR_ENV) or None
+_process_trace = None
+_merged_offsets = {}
+
+
+def enable_tracing(trace_dir):
+    """
+    Start recording trace spans, in this process and in every process it starts afterwards (such as DataLoader
+    workers), to per-process files in trace_dir; `export_epoch_trace` merges them into a Chrome trace. Tracing can
+    also be enabled by setting the METALEARNING_TRACE_DIR environment variable.
+    :param trace_dir: The directory to write the traces to; created if it does not exist
+    """
+    global _trace_dir
+    os.makedirs(trace_dir, exist_ok=True)
+    os.environ[TRACE_DIR_ENV] = trace_dir
+    _trace_dir = trace_dir
+
+
+def tracing_enabled():
+    return _trace_dir is not None
+
+
+def _process_name():
+    worker_info = torch.utils.data.get_worker_info()
+    if worker_info is not None:
+        return f'DataLoader worker {worker_info.id} ({os.getpid()})'
+
+    return f'main ({os.getpid()})'
+
+
+class _ProcessTrace:
+    """
+    The spans recorded by a single process, appended (one JSON event per line) to its own file, and flushed after every
+    span: DataLoader workers exit without running exit handlers, so nothing can be left buffered.
+    """
+    def __init__(self, trace_dir):
+        self.pid = os.getpid()
+        self.trace_file = open(os.path.join(trace_dir, PROCESS_TRACE_PATTERN.format(pid=self.pid)), 'a')
+        self.named = False
+
+    def record(self, name, category, start, end, args):
+        lines = []
+        if not self.named:
+            # Named lazily, as a DataLoader worker only knows its id once it is running
+            lines.append(dict(name='process_name', ph='M', pid=self.pid, args=dict(name=_process_name())))
+            self.named = True
+
+        lines.append(dict(name=name, cat=category, ph='X', pid=self.pid, tid=0,
+                          ts=start * 1e6, dur=(end - start) * 1e6, args=args))
+        self.trace_file.write(''.join(json.dumps(line) + '\n' for line in lines))
+        self.trace_file.flush()
+
+
+def record_span(name, category, start, end, **args):
+    """
+    Record a span that has already ended.
+    :param name: The name of the span
+    :param category: Its category, e.g. 'read' for file reads
+    :param start: When it started, in seconds since the epoch (time.time())
+    :param end: When it ended, in the same units
+    :param args: Any additional values to show with the span
+    """
+    global _process_trace
+    if _trace_dir is None:
+        return
+
+    # A forked worker inherits its parent's trace, but must write to its own file
+    if _process_trace is None or _process_trace.pid != os.getpid():
+        _process_trace = _ProcessTrace(_trace_dir)
+
+    _process_trace.record(name, category, start, end, args)
+
+
+@contextmanager
+def trace_span(name, category, **args):
+    """
+    Record the code run under this context manager as a span, if tracing is enabled.
+    """
+    if _trace_dir is None:
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+
+    finally:
+        record_span(name, category, start, time.time(), **args)
+
+
+def traced(name, category):
+    """
+    Decorate a function or method to record each call as a span, if tracing is enabled.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _trace_dir is None:
+                return function(*args, **kwargs)
+
+            with trace_span(name, category):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _read_new_events(trace_dir):
+    """
+    Read the events appended to each process's trace file since the last time they were read, up to the last complete
+    line, so that processes still writing (such as persistent workers) never lose events.
+    """
+    events = []
+    for path in sorted(glob.glob(os.path.join(trace_dir, PROCESS_TRACE_PATTERN.format(pid='*')))):
+        with open(path, 'rb') as trace_file:
+            trace_file.seek(_merged_offsets.get(path, 0))
+            data = trace_file.read()
+
+        complete = data[:data.rfind(b'\n') + 1]
+        _merged_offsets[path] = _merged_offsets.get(path, 0) + len(complete)
+        events.extend(json.loads(line) for line in complete.splitlines() if line)
+
+    return events
+
+
+def read_latency_histogram(durations_us, percentiles=READ_LATENCY_PERCENTILES):
+    """
+    Summarize read latencies in a histogram of power-of-two buckets.
+    :param durations_us: The latencies, in microseconds
+    :param percentiles: Which percentiles to report
+    :return: A dict of the number of reads, the percentiles (keyed 'p50_us', ...), and the histogram, as a list of
+        upper bucket bounds (in microseconds) and a list of the number of reads in each bucket
+    """
+    durations_us = np.asarray(durations_us, dtype=np.float64)
+    if len(durations_us) == 0:
+        return dict(count=0)
+
+    bucket_upper_us = 2.0 ** np.arange(0, int(np.ceil(np.log2(max(durations_us.max(), 1)))) + 1)
+    counts = np.bincount(np.searchsorted(bucket_upper_us, durations_us), minlength=len(bucket_upper_us))
+
+    histogram = dict(count=len(durations_us), bucket_upper_us=bucket_upper_us.tolist(),
+                     counts=counts[:len(bucket_upper_us)].tolist())
+    histogram.update({f'p{percentile}_us': float(np.percentile(durations_us, percentile))
+                      for percentile in percentiles})
+    return histogram
+
+
+def export_epoch_trace(epoch, trace_dir=None):
+    """
+    Merge the spans every process recorded since the last export into a single Chrome trace (which chrome://tracing
+    and Perfetto open), along with a histogram of the latencies of the file reads, both named after the epoch.
+    :param epoch: The epoch number
+    :param trace_dir: The directory the spans were recorded to; defaults to the one tracing was enabled with
+    :return: The path to the trace, or None if tracing is not enabled
+    """
+    trace_dir = trace_dir or _trace_dir
+    if trace_dir is None:
+        return None
+
+    events = _read_new_events(trace_dir)
+    spans = sorted((event for event in events if event['ph'] == 'X'), key=lambda event: event['ts'])
+    # Process names are only recorded once per process, so they are repeated in every epoch's trace they appear in
+    traced_pids = set(event['pid'] for event in spans)
+    metadata = {event['pid']: event for event in _all_process_names(trace_dir) if event['pid'] in traced_pids}
+
+    trace_path = os.path.join(trace_dir, EPOCH_TRACE_FILE.format(epoch=epoch))
+    with open(trace_path, 'w') as trace_file:
+        json.dump(dict(traceEvents=list(metadata.values()) + spans, displayTimeUnit='ms'), trace_file)
+
+    histogram = read_latency_histogram([event['dur'] for event in spans if event['cat'] == READ_CATEGORY])
+    with open(os.path.join(trace_dir, EPOCH_READ_LATENCY_FILE.format(epoch=epoch)), 'w') as histogram_file:
+        json.dump(histogram, histogram_file, indent=2)
+
+    if histogram['count'] > 0:
+        print(f'Epoch {epoch} trace: {len(spans)} spans, {histogram["count"]} reads, p50 {histogram["p50_us"]:.0f} us, p95 {histogram["p95_us"]:.0f} us, written to {trace_path}')
+
+    return trace_path
+
+
+def _all_process_names(trace_dir):
+    names = []
+    for path in sorted(glob.glob(os.path.join(trace_dir, PROCESS_TRACE_PATTERN.format(pid='*')))):
+        with open(path) as trace_file:
+            for line in trace_file:
+                if '"process_name"' in line:
+                    names.append(json.loads(line))
+                    break
+
+    return names
@@ -0,0 +1,145 @@
+import numpy as np
+import h5py
+import json
+import shutil
+import tempfile
+import os
+from torchvision import transforms
+
+from .manifest import dataset_content_hash
+from .storage import MEMMAP_HEADER_FILE, CONVERSION_CHUNK_SIZE, open_dataset_file, is_memmap_dir
+
+
+VARIANT_FORMATS = ('memmap', 'hdf5')
+
+
+def resize_images(images, downsample_size):
+    """
+    Resize a block of raw images exactly as the per-example pipelines of `create_normalized_datasets` do (through PIL,
+    with transforms.Resize), keeping them as uint8 images, so that converting the result to tensors gives the same
+    values as resizing on every read.
+    :param images: The images, as a [N, H, W, C] uint8 array
+    :param downsample_size: The (height, width) to resize to
+    :return: The resized images, as a [N, height, width, C] uint8 array
+    """
+    to_pil = transforms.ToPILImage()
+    resize = transforms.Resize(downsample_size)
+    return np.stack([np.asarray(resize(to_pil(image))) for image in images])
+
+
+def resized_variant_path(in_file, downsample_size, variant_format='memmap', out_dir=None):
+    """
+    Where the resized variant of a dataset is stored: named after the dataset, its content hash, and the target size,
+    so that a variant is reused by every later run with the same size, and never by runs on a regenerated dataset.
+    :param in_file: The dataset (an HDF5 file, memory-mapped dataset directory, or shard index)
+    :param downsample_size: The (height, width) the variant's images are resized to
+    :param variant_format: 'memmap' for a memory-mapped dataset directory, or 'hdf5' for an HDF5 file
+    :param out_dir: The directory to store the variant in; defaults to the directory of the dataset
+    :return: The path of the variant
+    """
+    if variant_format not in VARIANT_FORMATS:
+        raise ValueError(f'The variant format must be one of {VARIANT_FORMATS}, not {variant_format}')
+
+    source = os.path.abspath(in_file).rstrip(os.sep)
+    if out_dir is None:
+        out_dir = os.path.dirname(source)
+
+    base_name = os.path.splitext(os.path.basename(source))[0]
+    height, width = downsample_size
+    name = f'{base_name}_{height}x{width}_{dataset_content_hash(in_file)[:16]}'
+    return os.path.join(out_dir, name if variant_format == 'memmap' else name + '.h5')
+
+
+def _write_memmap_variant(in_file, source, out_path, downsample_size, chunk_size):
+    header = dict(source=os.path.abspath(in_file), downsample_size=list(downsample_size), datasets={})
+
+    for name in source.keys():
+        data = source[name]
+        shape = tuple(data.shape)
+        if name == 'X':
+            shape = (shape[0],) + tuple(downsample_size) + shape[3:]
+
+        array_file = f'{name}.npy'
+        out = np.lib.format.open_memmap(os.path.join(out_path, array_file), mode='w+', dtype=data.dtype, shape=shape)
+
+        for start in range(0, shape[0], chunk_size):
+            end = min(start + chunk_size, shape[0])
+            block = np.asarray(data[start:end])
+            out[start:end] = resize_images(block, downsample_size) if name == 'X' else block
+
+        out.flush()
+        del out
+
+        header['datasets'][name] = dict(file=array_file, shape=list(shape), dtype=np.dtype(data.dtype).str)
+
+    with open(os.path.join(out_path, MEMMAP_HEADER_FILE), 'w') as header_file:
+        json.dump(header, header_file, indent=2)
+
+
+def _write_hdf5_variant(source, out_path, downsample_size, chunk_size):
+    with h5py.File(out_path, 'w') as target:
+        for name in source.keys():
+            data = source[name]
+            shape = tuple(data.shape)
+            if name == 'X':
+                shape = (shape[0],) + tuple(downsample_size) + shape[3:]
+
+            # One image per chunk, which suits the random per-example reads of training
+            out = target.create_dataset(name, shape=shape, dtype=data.dtype, chunks=(1,) + shape[1:])
+
+            for start in range(0, shape[0], chunk_size):
+                end = min(start + chunk_size, shape[0])
+                block = np.asarray(data[start:end])
+                out[start:end] = resize_images(block, downsample_size) if name == 'X' else block
+
+
+def materialize_resized_variant(in_file, downsample_size, variant_format='memmap', out_dir=None,
+                                chunk_size=CONVERSION_CHUNK_SIZE):
+    """
+    Write a copy of a dataset with its images resized to downsample_size, unless one already exists, so that runs
+    which downsample read the smaller images directly, instead of resizing every example on every epoch. The other
+    datasets in the file (Q, y, and D) are copied unchanged. The variant is written under a temporary name and moved
+    into place when complete, so runs starting at once never read a partial variant.
+    :param in_file: The dataset (an HDF5 file, memory-mapped dataset directory, or shard index)
+    :param downsample_size: The (height, width) to resize the images to
+    :param variant_format: 'memmap' for a memory-mapped dataset directory, or 'hdf5' for an HDF5 file
+    :param out_dir: The directory to store the variant in; defaults to the directory of the dataset
+    :param chunk_size: How many rows to copy at a time, bounding the memory used
+    :return: The path of the variant, which any of the datasets can read from
+    """
+    out_path = resized_variant_path(in_file, downsample_size, variant_format, out_dir)
+    if os.path.exists(out_path):
+        print(f'Reusing the resized variant {out_path}')
+        return out_path
+
+    out_dir = os.path.dirname(out_path)
+    os.makedirs(out_dir, exist_ok=True)
+    print(f'Writing a variant of {in_file} resized to {tuple(downsample_size)} to {out_path}')
+
+    with open_dataset_file(in_file) as source:
+        if variant_format == 'memmap':
+            temp_path = tempfile.mkdtemp(dir=out_dir, prefix=os.path.basename(out_path) + '.')
+            try:
+                os.chmod(temp_path, 0o755)
+                _write_memmap_variant(in_file, source, temp_path, downsample_size, chunk_size)
+                os.rename(temp_path, out_path)
+
+            except BaseException as e:
+                shutil.rmtree(temp_path, ignore_errors=True)
+                # Renaming fails if another run finished writing the same variant first, which we can then use
+                if not (isinstance(e, OSError) and is_memmap_dir(out_path)):
+                    raise
+
+        else:
+            descriptor, temp_path = tempfile.mkstemp(dir=out_dir, prefix=os.path.basename(out_path) + '.')
+            os.close(descriptor)
+            try:
+                os.chmod(temp_path, 0o644)
+                _write_hdf5_variant(source, temp_path, downsample_size, chunk_size)
+                os.replace(temp_path, out_path)
+
+            except BaseException:
+                os.remove(temp_path)
+                raise
+
+    return out_path